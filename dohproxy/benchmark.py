@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Measure how many queries per second DNSClient.query_wire goes through, against
+an in-process upstream answering every query at once.
+
+Modes differ in how the query of the client is forwarded: "wire" forwards
+the bytes received from the client, "message" serializes the parsed query
+and "copy" also parses it again, as DNSClient.query used to. Each mode is
+run on every installed event loop.
+
+    python -m dohproxy.benchmark --requests 20000 --concurrency 100
+"""
+import argparse
+import asyncio
+import time
+
+import dns.message
+from dohproxy import utils
+from dohproxy.server_protocol import DNSClient, UDPSocketPool
+
+
+class EchoResolver(asyncio.DatagramProtocol):
+    """Answer every query with itself, flagged as a response."""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        data = bytearray(data)
+        data[2] |= 0x80
+        self.transport.sendto(bytes(data), addr)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--requests",
+        default=20000,
+        type=int,
+        help="Number of queries per mode. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default=100,
+        type=int,
+        help="Number of queries in flight at once. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--rounds",
+        default=3,
+        type=int,
+        help="Number of runs of each mode, the best one is reported. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--ecs", action="store_true", help="Add EDNS Client Subnet to queries.",
+    )
+    parser.add_argument(
+        "--event-loop",
+        default=list(utils.EVENT_LOOPS),
+        nargs="+",
+        choices=utils.EVENT_LOOPS,
+        help="Event loops to run on. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--level", default="ERROR", help="log level [%(default)s]",
+    )
+    return parser.parse_args(args)
+
+
+def copy_wire(dnsq, body):
+    """What queries went through before they were forwarded in wire format:
+    a parse and serialization of the query on top of the frontend one.
+    """
+    return dns.message.from_wire(dnsq.to_wire()).to_wire()
+
+
+MODES = {
+    "copy": copy_wire,
+    "message": lambda dnsq, body: None,
+    "wire": lambda dnsq, body: body,
+}
+
+
+async def run(dnsclient, mode, args):
+    # Distinct names, so that nothing is coalesced. The queries are built
+    # beforehand, as the frontends would have parsed them already.
+    bodies = [
+        dns.message.make_query("{}.example.com".format(i), "A").to_wire()
+        for i in range(args.requests)
+    ]
+    queries = iter([(dns.message.from_wire(body), body) for body in bodies])
+
+    async def worker():
+        for dnsq, body in queries:
+            await dnsclient.query_wire(
+                dnsq,
+                "192.0.2.1",
+                timeout=5,
+                ecs=args.ecs,
+                wire=MODES[mode](dnsq, body),
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    return args.requests / (time.perf_counter() - start)
+
+
+async def benchmark(args):
+    loop = asyncio.get_event_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        EchoResolver, local_addr=("127.0.0.1", 0)
+    )
+    port = transport.get_extra_info("sockname")[1]
+    logger = utils.configure_logger("benchmark", args.level)
+    dnsclient = DNSClient("127.0.0.1", port, logger=logger)
+    rates = {mode: 0 for mode in MODES}
+    try:
+        for _ in range(args.rounds):
+            for mode in MODES:
+                rates[mode] = max(rates[mode], await run(dnsclient, mode, args))
+        for mode, rate in rates.items():
+            print("{:<8} {:>10.0f} queries/s".format(mode, rate))
+    finally:
+        UDPSocketPool.get("127.0.0.1", port, 1).close()
+        transport.close()
+
+
+def main():
+    args = parse_args()
+    for name in args.event_loop:
+        if utils.set_event_loop_policy(name) != name:
+            print("{}: not installed, skipped".format(name))
+            continue
+        print("{}:".format(name))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(benchmark(args))
+        finally:
+            loop.close()
+
+
+if __name__ == "__main__":
+    main()
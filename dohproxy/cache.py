@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import array
+import collections
+import ipaddress
+import struct
+import sys
+import time
+
+import dns.edns
+import dns.flags
+import dns.rcode
+from dohproxy import dnswire, utils
+
+
+class CacheEntry:
+    """A cached answer, in wire format, with the offsets of its TTL fields
+    to age them in place.
+    """
+
+    __slots__ = (
+        "wire",
+        "ttl_offsets",
+        "rdlength_offset",
+        "time_stamp",
+        "expire",
+        "hits",
+        "prefetching",
+        "size",
+    )
+
+    def __init__(self, wire, ttl_offsets, rdlength_offset, time_stamp, expire):
+        """
+        :param wire: the answer, as bytes, without ECS option.
+        :param ttl_offsets: the offsets of the TTL fields of its records, as
+            an array.
+        :param rdlength_offset: the offset of the RDLENGTH field of its OPT
+            record when it is the last record, for the ECS option to be
+            appended to it, or None.
+        """
+        self.wire = wire
+        self.ttl_offsets = ttl_offsets
+        self.rdlength_offset = rdlength_offset
+        self.time_stamp = time_stamp
+        self.expire = expire
+        # Number of times the entry was served, and whether it is being
+        # refreshed, see prefetch_due().
+        self.hits = 0
+        self.prefetching = False
+        # Approximate memory used by the entry, see DNSCache.size.
+        self.size = (
+            sys.getsizeof(self) + sys.getsizeof(wire) + sys.getsizeof(ttl_offsets)
+        )
+
+
+class DNSCache:
+    """An in-process LRU cache of DNS answers, expiring with the TTL of their
+    records.
+
+    Negative answers, NXDOMAIN and NODATA, are cached as well, for the TTL
+    derived from the SOA of their authority section (RFC 2308).
+
+    Answers are keyed on the question plus what changes the answer: the RD,
+    DO and CD flags and the EDNS Client Subnet (ECS) sent upstream, if any.
+    An answer to a query with ECS is stored for the subnet of its SCOPE
+    PREFIX-LENGTH, and serves the queries from within that subnet. A scope
+    of /0 makes it a global answer (RFC 7871 section 7.3).
+
+    Expired answers may be kept for a while longer, to be served stale when
+    the upstreams cannot answer (RFC 8767), see get_stale().
+
+    Answers are kept in wire format along with the offsets of their TTLs, so
+    that a hit is a copy of the bytes with the TTLs rewritten in place.
+    """
+
+    # TTL of the records of an answer served stale, as recommended by
+    # RFC 8767.
+    STALE_TTL = 30
+    # Popular entries are refreshed during this last fraction of their TTL,
+    # see prefetch_due().
+    PREFETCH_FRACTION = 0.1
+
+    def __init__(
+        self,
+        size,
+        stale_window=0,
+        prefetch_min_hits=0,
+        negative_ttl_max=None,
+        max_subnets=32,
+    ):
+        """
+        :param size: maximum memory used by the answers kept, in bytes.
+        :param stale_window: how long expired answers are kept to be served
+            stale, in seconds.
+        :param prefetch_min_hits: number of hits after which an entry is
+            worth refreshing before it expires. 0 disables prefetching.
+        :param negative_ttl_max: maximum time negative answers are cached,
+            in seconds.
+        :param max_subnets: maximum number of ECS subnets an answer is kept
+            for, per question. The least recently stored go first.
+        """
+        self.size = size
+        self.negative_ttl_max = negative_ttl_max
+        self.stale_window = stale_window
+        self.prefetch_min_hits = prefetch_min_hits
+        self.max_subnets = max_subnets
+        # Entries are keyed on the query key without its ECS, plus the subnet
+        # the answer is scoped to, or None for a global answer.
+        self.entries = collections.OrderedDict()
+        # The subnets stored for each query key without its ECS, in the order
+        # they were stored.
+        self.subnets = {}
+        # Sum of the sizes of the entries.
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+    @staticmethod
+    def make_key(dnsq, subnet=None):
+        """Build the cache key of a query, as it is sent upstream. Its EDNS
+        version is part of it, as answers only have an OPT record when their
+        query had one.
+        :param dnsq: a dns.message.Message.
+        :param subnet: the EDNS Client Subnet added to the query upstream, if
+            any, as an ipaddress network.
+        :return: a hashable key.
+        """
+        ecs = None
+        edns = dnsq.edns
+        if subnet is not None:
+            ecs = (subnet.network_address.compressed, subnet.prefixlen)
+            # Added along with an OPT record when the query had none.
+            edns = max(edns, 0)
+        for option in dnsq.options:
+            if isinstance(option, dns.edns.ECSOption):
+                ecs = (option.address, option.srclen)
+        return (
+            utils.dns_question_key(dnsq),
+            dnsq.flags & (dns.flags.RD | dns.flags.CD),
+            dnsq.ednsflags & dns.flags.DO,
+            edns,
+            ecs,
+        )
+
+    @staticmethod
+    def answer_ttl(dnsr, negative_ttl_max=None):
+        """Return how long an answer may be cached, or None if it may not.
+        :param dnsr: a dnswire.WireMessage.
+        """
+        if dnsr.flags & dns.flags.TC:
+            return None
+        if dnsr.rcode() == dns.rcode.NOERROR and dnsr.ancount:
+            if dnsr.authority_ttl is None:
+                return dnsr.answer_ttl
+            return min(dnsr.answer_ttl, dnsr.authority_ttl)
+        return dnsr.negative_ttl(negative_ttl_max)
+
+    def _candidates(self, key):
+        """Yield the keys of the entries which may answer a query key, the
+        most specific first.
+        """
+        base, ecs = key[:-1], key[-1]
+        if ecs is not None and base in self.subnets:
+            address = ipaddress.ip_address(ecs[0])
+            subnets = [
+                subnet
+                for subnet in self.subnets[base]
+                if subnet.prefixlen <= ecs[1] and address in subnet
+            ]
+            for subnet in sorted(subnets, key=lambda s: s.prefixlen, reverse=True):
+                yield base + (subnet,)
+        yield base + (None,)
+
+    def _lookup(self, key, window=0):
+        """Return the key and entry answering a query key, expired for no
+        more than window seconds, or (None, None).
+        """
+        now = time.monotonic()
+        for entry_key in list(self._candidates(key)):
+            entry = self.entries.get(entry_key)
+            if entry is None:
+                continue
+            if entry.expire + self.stale_window <= now:
+                self._remove(entry_key)
+            elif entry.expire + window > now:
+                return entry_key, entry
+        return None, None
+
+    def _remove(self, entry_key):
+        self.bytes -= self.entries.pop(entry_key).size
+        base, subnet = entry_key[:-1], entry_key[-1]
+        if subnet is not None:
+            del self.subnets[base][subnet]
+            if not self.subnets[base]:
+                del self.subnets[base]
+
+    @staticmethod
+    def _copy(entry_key, entry, ecs, age=0, max_ttl=None):
+        """Copy the answer of an entry, with its TTLs decremented by age or
+        capped to max_ttl.
+        :param ecs: the ECS of the query key it answers, added to the answer
+            with the scope of the entry, or None.
+        :return: a dnswire.WireMessage.
+        """
+        wire = bytearray(entry.wire)
+        if max_ttl is None:
+            dnswire.age_ttls(wire, entry.ttl_offsets, age)
+        else:
+            dnswire.cap_ttls(wire, entry.ttl_offsets, max_ttl)
+        if ecs is not None and entry.rdlength_offset is not None:
+            subnet = entry_key[-1]
+            data = dnswire.ecs_option_data(
+                ipaddress.ip_network("{}/{}".format(*ecs), strict=False),
+                scope=0 if subnet is None else subnet.prefixlen,
+            )
+            dnswire.append_edns_option(
+                wire, entry.rdlength_offset, dns.edns.ECS, data
+            )
+        return dnswire.WireMessage(wire)
+
+    def get(self, key, with_ecs=True):
+        """Look up an answer.
+        :param with_ecs: whether the answer should carry the ECS option of
+            the query key, if any.
+        :return: a copy of the cached answer, as a dnswire.WireMessage, with
+            its TTLs decremented by the time spent in cache, or None on a
+            miss.
+        """
+        entry_key, entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry.hits += 1
+        self.entries.move_to_end(entry_key)
+        age = int(time.monotonic() - entry.time_stamp)
+        return self._copy(
+            entry_key, entry, key[-1] if with_ecs else None, age=age
+        )
+
+    def get_stale(self, key, with_ecs=True):
+        """Look up an answer, even expired if it is within the stale window.
+        :return: a copy of the cached answer, as a dnswire.WireMessage, with
+            its TTLs capped to STALE_TTL, or None.
+        """
+        entry_key, entry = self._lookup(key, self.stale_window)
+        if entry is None:
+            return None
+        self.stale_hits += 1
+        return self._copy(
+            entry_key, entry, key[-1] if with_ecs else None, max_ttl=self.STALE_TTL
+        )
+
+    def prefetch_due(self, key):
+        """Tell whether the entry answering a query key is popular and close
+        enough to its expiry to be refreshed now. It is then only reported
+        once.
+        """
+        if not self.prefetch_min_hits:
+            return False
+        _, entry = self._lookup(key)
+        if entry is None or entry.prefetching:
+            return False
+        if entry.hits < self.prefetch_min_hits:
+            return False
+        ttl = entry.expire - entry.time_stamp
+        if time.monotonic() < entry.expire - ttl * self.PREFETCH_FRACTION:
+            return False
+        entry.prefetching = True
+        return True
+
+    @staticmethod
+    def answer_subnet(key, dnsr):
+        """Return the subnet an answer to a query key applies to, or None if
+        it applies to every client.
+        """
+        ecs = key[-1]
+        if ecs is None:
+            return None
+        scopelen = 0
+        data = dnsr.option(dns.edns.ECS)
+        if data is not None and len(data) >= 4:
+            # A scope longer than the source prefix still only tells about
+            # the source prefix.
+            scopelen = min(data[3], ecs[1])
+        if not scopelen:
+            return None
+        return ipaddress.ip_network(
+            "{}/{}".format(ecs[0], scopelen), strict=False
+        )
+
+    def put(self, key, dnsr):
+        """Store a copy of an answer, if it is cacheable.
+        :param dnsr: a dnswire.WireMessage.
+        :return: Whether the answer was stored (bool)
+        """
+        ttl = self.answer_ttl(dnsr, self.negative_ttl_max)
+        if not ttl:
+            return False
+        now = time.monotonic()
+        base, subnet = key[:-1], self.answer_subnet(key, dnsr)
+        dnsr = dnsr.without_option(dns.edns.ECS)
+        wire = bytearray(dnsr.wire)
+        if not dnsr.ancount and dnsr.soa_ttl_offset is not None:
+            # The SOA TTL of a negative answer is its negative TTL, so that
+            # it ages along with the entry (RFC 2308 section 5).
+            struct.pack_into("!I", wire, dnsr.soa_ttl_offset, ttl)
+        rdlength_offset = None
+        if dnsr.opt is not None and dnsr.opt[2] == len(wire):
+            rdlength_offset = dnsr.opt[1] - 2
+        entry = CacheEntry(
+            bytes(wire),
+            array.array("H", dnsr.ttl_offsets),
+            rdlength_offset,
+            now,
+            now + ttl,
+        )
+        entry_key = base + (subnet,)
+        if entry_key in self.entries:
+            self._remove(entry_key)
+        self.entries[entry_key] = entry
+        self.bytes += entry.size
+        if subnet is not None:
+            subnets = self.subnets.setdefault(base, collections.OrderedDict())
+            subnets[subnet] = None
+            subnets.move_to_end(subnet)
+            while len(subnets) > self.max_subnets:
+                self._remove(base + (next(iter(subnets)),))
+                self.evictions += 1
+        while self.bytes > self.size:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        return entry_key in self.entries
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+        }
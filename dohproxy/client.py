@@ -46,9 +46,11 @@ def build_query(args):
 
 def main_sync(args):
     logger = utils.configure_logger("doh-client", level=args.level)
+    utils.set_event_loop_policy(args.event_loop, logger)
     client = Client(args=args, logger=logger)
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     loop.run_until_complete(client.make_request(None, build_query(args)))
 
 
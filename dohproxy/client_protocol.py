@@ -14,7 +14,7 @@ import urllib.parse
 import aioh2
 import dns.message
 import priority
-from dohproxy import constants, utils
+from dohproxy import utils
 
 
 class StubServerProtocol:
@@ -102,25 +102,12 @@ class StubServerProtocol:
         with await self._lock:
             client = await self.get_client()
 
-        path = self.args.uri
         qid = dnsq.id
         dnsq.id = 0
-        body = b""
-
-        headers = [
-            (":authority", self.args.domain),
-            (":method", self.args.post and "POST" or "GET"),
-            (":scheme", "https"),
-            ("Accept", constants.DOH_MEDIA_TYPE),
-        ]
-        if self.args.post:
-            headers.append(("content-type", constants.DOH_MEDIA_TYPE))
-            body = dnsq.to_wire()
-        else:
-            path = self._make_get_path(dnsq.to_wire())
-
-        headers.insert(0, (":path", path))
-        headers.extend([("content-length", str(len(body)))])
+        headers, body = utils.build_doh_request(
+            self.args.domain, self.args.uri, dnsq.to_wire(), post=self.args.post
+        )
+        self.logger.debug("Request headers: {}".format(headers))
         # Start request with headers
         # FIXME: Find a better way to close old streams. See GH#11
         try:
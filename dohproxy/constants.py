@@ -12,3 +12,19 @@ DOH_MEDIA_TYPE = "application/dns-message"
 DOH_DNS_PARAM = "dns"
 DOH_H2_NPN_PROTOCOLS = ["h2"]
 DOH_CIPHERS = "ECDHE+AESGCM"
+DNS_EDNS_NSID = 3
+DNS_EDNS_COOKIE = 10
+DNS_EDNS_TCP_KEEPALIVE = 11
+DNS_EDNS_PADDING = 12
+# EDNS options about the transport or the server a client talks to, which
+# must not be shared with other clients along with the answer they came in.
+DNS_EDNS_HOP_BY_HOP_OPTIONS = (
+    DNS_EDNS_NSID,
+    DNS_EDNS_COOKIE,
+    DNS_EDNS_TCP_KEEPALIVE,
+    DNS_EDNS_PADDING,
+)
+DNS_OVER_TLS_PORT = 853
+# UDP payload size advertised in the OPT records we add, see RFC 8020 and
+# the DNS flag day 2020.
+DNS_EDNS_PAYLOAD = 1232
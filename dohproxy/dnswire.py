@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Helpers working on DNS messages in wire format, to forward them without
+parsing them into dns.message.Message objects and back.
+
+They raise dns.exception.FormError on malformed messages, as
+dns.message.from_wire does.
+"""
+import struct
+
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from dohproxy import constants
+
+DNS_HEADER_LENGTH = 12
+DNS_TYPE_OPT = 41
+
+_HEADER = struct.Struct("!6H")
+_RR = struct.Struct("!HHIH")
+_TTL = struct.Struct("!I")
+
+
+def skip_name(wire, offset):
+    """Return the offset of the end of the domain name at offset."""
+    try:
+        while True:
+            length = wire[offset]
+            if length & 0xC0 == 0xC0:
+                return offset + 2
+            offset += length + 1
+            if length == 0:
+                return offset
+    except IndexError:
+        raise dns.exception.FormError("Truncated domain name")
+
+
+def find_opt(wire):
+    """Locate the OPT record of a message.
+    :return: the offsets of the start and end of the OPT record, or None.
+    """
+    try:
+        qdcount, ancount, nscount, arcount = struct.unpack_from("!4H", wire, 4)
+        offset = DNS_HEADER_LENGTH
+        for _ in range(qdcount):
+            offset = skip_name(wire, offset) + 4
+        for i in range(ancount + nscount + arcount):
+            start = offset
+            offset = skip_name(wire, offset)
+            rdtype, _, _, rdlength = _RR.unpack_from(wire, offset)
+            offset += _RR.size + rdlength
+            if i >= ancount + nscount and rdtype == DNS_TYPE_OPT:
+                if offset > len(wire):
+                    raise dns.exception.FormError("Truncated OPT record")
+                return start, offset
+    except struct.error:
+        raise dns.exception.FormError("Truncated message")
+    return None
+
+
+def _question(view):
+    """Return the question key of a message and the offset following its
+    question section.
+    """
+    qdcount = struct.unpack_from("!H", view, 4)[0]
+    offset = DNS_HEADER_LENGTH
+    question = ()
+    for i in range(qdcount):
+        end = skip_name(view, offset)
+        rdtype, rdclass = struct.unpack_from("!HH", view, end)
+        if i == 0:
+            question = (bytes(view[offset:end]).lower(), rdtype, rdclass)
+        offset = end + 4
+    return question, offset
+
+
+def question_key(wire):
+    """Return a hashable key for the question of a message: its name in
+    wire format lowercased, type and class. Returns an empty tuple when the
+    message has no question.
+    """
+    try:
+        with memoryview(wire) as view:
+            return _question(view)[0]
+    except struct.error:
+        raise dns.exception.FormError("Truncated message")
+
+
+def edns_option_codes(wire, opt):
+    """Return the codes of the options in the OPT record at opt, as
+    returned by find_opt().
+    """
+    start, end = opt
+    offset = skip_name(wire, start) + _RR.size
+    codes = []
+    while offset + 4 <= end:
+        code, length = struct.unpack_from("!HH", wire, offset)
+        codes.append(code)
+        offset += 4 + length
+    return codes
+
+
+def add_edns_option(wire, code, data, payload=constants.DNS_EDNS_PAYLOAD):
+    """Return a copy of a message with an EDNS option added. An OPT record
+    is added, with payload as UDP payload size, if the message has none.
+    :return: the new message (bytes), or None if the OPT record is not the
+        last record of the message, as when it is followed by a TSIG.
+    """
+    option = struct.pack("!HH", code, len(data)) + data
+    opt = find_opt(wire)
+    if opt is None:
+        arcount = struct.unpack_from("!H", wire, 10)[0]
+        if arcount:
+            return None
+        return (
+            wire[:10]
+            + struct.pack("!H", 1)
+            + wire[DNS_HEADER_LENGTH:]
+            + b"\x00"
+            + _RR.pack(DNS_TYPE_OPT, payload, 0, len(option))
+            + option
+        )
+    start, end = opt
+    if end != len(wire):
+        return None
+    offset = skip_name(wire, start) + _RR.size - 2
+    rdlength = struct.unpack_from("!H", wire, offset)[0]
+    return (
+        wire[:offset]
+        + struct.pack("!H", rdlength + len(option))
+        + wire[offset + 2 :]
+        + option
+    )
+
+
+def ecs_option_data(subnet, scope=0):
+    """Return the data of an EDNS Client Subnet option (RFC 7871).
+    :param subnet: an ipaddress.IPv4Network or ipaddress.IPv6Network.
+    :param scope: the SCOPE PREFIX-LENGTH, 0 in queries.
+    """
+    family = 1 if subnet.version == 4 else 2
+    address = subnet.network_address.packed[: (subnet.prefixlen + 7) // 8]
+    return struct.pack("!HBB", family, subnet.prefixlen, scope) + address
+
+
+def append_edns_option(wire, rdlength_offset, code, data):
+    """Append an EDNS option to a message in a bytearray, in place. Its OPT
+    record must be the last record of the message.
+    :param rdlength_offset: the offset of the RDLENGTH field of the OPT
+        record.
+    """
+    option = struct.pack("!HH", code, len(data)) + data
+    rdlength = struct.unpack_from("!H", wire, rdlength_offset)[0]
+    struct.pack_into("!H", wire, rdlength_offset, rdlength + len(option))
+    wire += option
+
+
+def age_ttls(wire, offsets, seconds):
+    """Decrement the TTLs at offsets of a message in a bytearray by seconds,
+    down to 0, in place.
+    """
+    for offset in offsets:
+        ttl = _TTL.unpack_from(wire, offset)[0]
+        _TTL.pack_into(wire, offset, max(ttl - seconds, 0))
+
+
+def cap_ttls(wire, offsets, max_ttl):
+    """Lower the TTLs at offsets of a message in a bytearray to max_ttl, in
+    place.
+    """
+    for offset in offsets:
+        ttl = _TTL.unpack_from(wire, offset)[0]
+        _TTL.pack_into(wire, offset, min(ttl, max_ttl))
+
+
+def set_payload(wire, payload):
+    """Return a copy of a message with the UDP payload size of its OPT
+    record set to payload, or the message itself if it has no OPT record or
+    already advertises payload.
+    """
+    opt = find_opt(wire)
+    if opt is None:
+        return wire
+    offset = skip_name(wire, opt[0]) + 2
+    if struct.unpack_from("!H", wire, offset)[0] == payload:
+        return wire
+    return wire[:offset] + struct.pack("!H", payload) + wire[offset + 2 :]
+
+
+def set_id(wire, qid):
+    """Return a copy of a message with its ID set to qid."""
+    return struct.pack("!H", qid) + wire[2:]
+
+
+class WireMessage:
+    """A DNS message in wire format, scanned once for the fields the proxy
+    looks at: ID, flags, rcode, question, TTLs and EDNS options. It is only
+    parsed by dnspython on demand, see message().
+    """
+
+    __slots__ = (
+        "wire",
+        "id",
+        "flags",
+        "ancount",
+        "nscount",
+        "arcount",
+        "question",
+        "ttl_offsets",
+        "answer_ttl",
+        "authority_ttl",
+        "soa_ttl",
+        "soa_ttl_offset",
+        "soa_minimum",
+        "opt",
+        "payload",
+        "ednsflags",
+        "options",
+        "_message",
+    )
+
+    def __init__(self, wire):
+        """
+        :param wire: the message, as bytes or as a bytearray, which the
+            WireMessage takes over. It is scanned in place, and bytes are
+            only copied when the message is modified, see set_id().
+        """
+        self.wire = wire
+        self._message = None
+        try:
+            with memoryview(self.wire) as view:
+                self._scan(view)
+        except struct.error:
+            raise dns.exception.FormError("Truncated message")
+
+    def _scan(self, view):
+        (
+            self.id,
+            self.flags,
+            _,
+            self.ancount,
+            self.nscount,
+            self.arcount,
+        ) = _HEADER.unpack_from(view)
+        self.question, offset = _question(view)
+        # Offsets of the TTL fields of every record but OPT.
+        self.ttl_offsets = []
+        self.answer_ttl = None
+        self.authority_ttl = None
+        self.soa_ttl = None
+        self.soa_ttl_offset = None
+        self.soa_minimum = None
+        # Offsets of the start, RDATA and end of the OPT record.
+        self.opt = None
+        self.payload = 0
+        self.ednsflags = 0
+        # EDNS option code -> offset and length of its data
+        self.options = {}
+        authority = self.ancount + self.nscount
+        for i in range(authority + self.arcount):
+            start = offset
+            offset = skip_name(view, offset)
+            rdtype, rdclass, ttl, rdlength = _RR.unpack_from(view, offset)
+            rdata = offset + _RR.size
+            end = rdata + rdlength
+            if end > len(view):
+                raise dns.exception.FormError("Truncated record")
+            if rdtype == DNS_TYPE_OPT and i >= authority:
+                self.opt = (start, rdata, end)
+                self.payload = rdclass
+                self.ednsflags = ttl
+                self._scan_options(view, rdata, end)
+            else:
+                self.ttl_offsets.append(offset + 4)
+                if i < self.ancount:
+                    if self.answer_ttl is None or ttl < self.answer_ttl:
+                        self.answer_ttl = ttl
+                elif i < authority:
+                    if self.authority_ttl is None or ttl < self.authority_ttl:
+                        self.authority_ttl = ttl
+                    if rdtype == dns.rdatatype.SOA and self.soa_ttl is None:
+                        self.soa_ttl = ttl
+                        self.soa_ttl_offset = offset + 4
+                        self.soa_minimum = struct.unpack_from("!I", view, end - 4)[0]
+            offset = end
+
+    def _scan_options(self, view, offset, end):
+        while offset + 4 <= end:
+            code, length = struct.unpack_from("!HH", view, offset)
+            self.options[code] = (offset + 4, length)
+            offset += 4 + length
+
+    def __eq__(self, other):
+        return isinstance(other, WireMessage) and self.wire == other.wire
+
+    @property
+    def edns(self):
+        """The EDNS version, or -1 if the message has no OPT record."""
+        if self.opt is None:
+            return -1
+        return (self.ednsflags >> 16) & 0xFF
+
+    def rcode(self):
+        return dns.rcode.from_flags(self.flags, self.ednsflags)
+
+    def option(self, code):
+        """Return the data of an EDNS option, or None."""
+        if code not in self.options:
+            return None
+        offset, length = self.options[code]
+        return bytes(self.wire[offset : offset + length])
+
+    def negative_ttl(self, max_ttl=None):
+        """How long a negative answer, NXDOMAIN or NODATA, may be cached: the
+        minimum of the TTL and MINIMUM field of the SOA in the authority
+        section (RFC 2308), capped by max_ttl.
+        :return: the TTL, or None for other answers and for negative answers
+            without a SOA.
+        """
+        rcode = self.rcode()
+        if rcode == dns.rcode.NOERROR:
+            if self.ancount:
+                return None
+        elif rcode != dns.rcode.NXDOMAIN:
+            return None
+        if self.soa_ttl is None:
+            return None
+        ttl = min(self.soa_ttl, self.soa_minimum)
+        if max_ttl is not None:
+            ttl = min(ttl, max_ttl)
+        return ttl
+
+    def max_age(self, negative_ttl_max=None):
+        """The max-age of the cache-control header of the answer: the lowest
+        TTL of the answer section, or the negative TTL.
+        :return: the max-age, or None if the answer should not be cached.
+        """
+        if self.ancount:
+            return self.answer_ttl
+        return self.negative_ttl(negative_ttl_max)
+
+    def set_id(self, qid):
+        """Set the message ID, in place."""
+        if qid == self.id:
+            return
+        if not isinstance(self.wire, bytearray):
+            self.wire = bytearray(self.wire)
+        struct.pack_into("!H", self.wire, 0, qid)
+        self.id = qid
+        self._message = None
+
+    def without_option(self, code):
+        """Return a copy of the message without an EDNS option, or the
+        message itself if it does not have it.
+        """
+        return self.without_options((code,))
+
+    def without_options(self, codes):
+        """Return a copy of the message without some EDNS options, or the
+        message itself if it has none of them.
+        :param codes: an iterable of EDNS option codes.
+        """
+        ranges = []
+        for code in codes:
+            if code in self.options:
+                offset, length = self.options[code]
+                ranges.append((offset - 4, offset + length))
+        if not ranges:
+            return self
+        start, rdata, end = self.opt
+        wire = bytearray(self.wire)
+        removed = 0
+        for range_start, range_end in sorted(ranges, reverse=True):
+            del wire[range_start:range_end]
+            removed += range_end - range_start
+        struct.pack_into("!H", wire, rdata - 2, end - rdata - removed)
+        return WireMessage(wire)
+
+    def without_opt(self):
+        """Return a copy of the message without its OPT record, or the message
+        itself if it does not have one.
+        """
+        if self.opt is None:
+            return self
+        wire = bytearray(self.wire)
+        del wire[self.opt[0] : self.opt[2]]
+        struct.pack_into("!H", wire, 10, self.arcount - 1)
+        return WireMessage(wire)
+
+    def to_wire(self):
+        return bytes(self.wire)
+
+    def message(self):
+        """Return the message parsed by dnspython. Do not modify it."""
+        if self._message is None:
+            self._message = dns.message.from_wire(bytes(self.wire))
+        return self._message
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import dns.exception
+import dns.name
+from dohproxy import utils
+
+# Key of the upstreams of a rule in its trie node, which no label can clash
+# with.
+_UPSTREAMS = None
+
+
+class ForwardingTable:
+    """Upstream resolvers to forward queries to by domain suffix, as in
+    conditional forwarding.
+
+    Rules are kept in a trie of the labels of their suffix, from the root
+    down, so a lookup walks the labels of a name once, whatever the number
+    of rules. The longest matching suffix wins.
+
+    Rules are read from a file, one per line: a suffix followed by its
+    upstream resolvers, in the --upstream-resolver format. Empty lines and
+    comments starting with # are ignored:
+
+        corp.example       10.0.0.53 10.0.1.53:5353
+        10.in-addr.arpa    tls://10.0.0.53
+    """
+
+    def __init__(self, path=None, logger=None):
+        """
+        :param path: the file to load the rules from, see load().
+        """
+        self.path = path
+        if logger is None:
+            logger = utils.configure_logger("ForwardingTable", "DEBUG")
+        self.logger = logger
+        self.rules = 0
+        self.reloads = 0
+        self._trie = {}
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def _labels(name):
+        """Return the lowercased labels of a name, from the root down."""
+        if not isinstance(name, dns.name.Name):
+            name = dns.name.from_text(name)
+        labels = name.labels
+        if name.is_absolute():
+            labels = labels[:-1]
+        return [label.lower() for label in reversed(labels)]
+
+    def add(self, suffix, upstreams):
+        """Forward the names under suffix to upstreams.
+        :param suffix: a domain name, "." for every name.
+        :param upstreams: a list of upstream resolvers, as given to DNSClient.
+        """
+        if self._insert(self._trie, suffix, upstreams):
+            self.rules += 1
+
+    def _insert(self, trie, suffix, upstreams):
+        """Add a rule to trie.
+        :return: whether suffix had no rule yet.
+        """
+        for upstream in upstreams:
+            utils.parse_upstream_url(upstream, 53)
+        node = trie
+        for label in self._labels(suffix):
+            node = node.setdefault(label, {})
+        new = _UPSTREAMS not in node
+        node[_UPSTREAMS] = tuple(upstreams)
+        return new
+
+    def lookup(self, name):
+        """Return the upstreams of the longest suffix of name with a rule, or
+        None.
+        :param name: a dns.name.Name.
+        """
+        node = self._trie
+        upstreams = node.get(_UPSTREAMS)
+        for label in self._labels(name):
+            node = node.get(label)
+            if node is None:
+                break
+            upstreams = node.get(_UPSTREAMS, upstreams)
+        return upstreams
+
+    def load(self):
+        """Replace the rules with those of the file.
+        :raise OSError: when the file cannot be read.
+        :raise ValueError: on a malformed rule, the rules are then unchanged.
+        """
+        trie = {}
+        rules = 0
+        with open(self.path) as f:
+            for lineno, line in enumerate(f, 1):
+                fields = line.partition("#")[0].split()
+                if not fields:
+                    continue
+                if len(fields) < 2:
+                    raise ValueError(
+                        "{}:{}: no upstream for {}".format(self.path, lineno, fields[0])
+                    )
+                try:
+                    rules += self._insert(trie, fields[0], fields[1:])
+                except (ValueError, dns.exception.DNSException) as e:
+                    raise ValueError("{}:{}: {}".format(self.path, lineno, e))
+        # Swapped at once, so lookups never see half of the rules.
+        self._trie = trie
+        self.rules = rules
+
+    def reload(self):
+        """Reload the rules from the file, keeping the current ones if it is
+        unreadable or malformed.
+        """
+        try:
+            self.load()
+        except (OSError, ValueError) as e:
+            self.logger.error("Not reloading forwarding rules: {}".format(e))
+            return
+        self.reloads += 1
+        self.logger.info(
+            "Reloaded {} forwarding rules from {}".format(self.rules, self.path)
+        )
+
+    def stats(self):
+        return {"rules": self.rules, "reloads": self.reloads}
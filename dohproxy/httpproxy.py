@@ -7,6 +7,12 @@
 # LICENSE file in the root directory of this source tree.
 #
 import asyncio
+import logging
+import os
+import signal
+import socket
+import stat
+import sys
 import time
 from argparse import ArgumentParser, Namespace
 
@@ -14,12 +20,13 @@ import aiohttp.web
 import aiohttp_remotes
 import dns.message
 import dns.rcode
-from dohproxy import constants, utils
+from dohproxy import constants, dnswire, utils, workers
 from dohproxy.server_protocol import (
     DNSClient,
     DOHDNSException,
     DOHParamsException,
 )
+from dohproxy.upstream import UpstreamOverloaded
 from multidict import CIMultiDict
 
 
@@ -33,7 +40,19 @@ def parse_args(args=None):
             If you do not want to add a trusted trusted reverse proxy, \
             just specify this flag with empty parameters.",
     )
-    return parser, parser.parse_args(args=args)
+    parser.add_argument(
+        "--listen-unix",
+        help="A Unix domain socket to listen on, for a reverse proxy on the "
+        "same host. Then --listen-address is only listened on if given.",
+    )
+    args = parser.parse_args(args=args)
+    # The default is the very list object, a given --listen-address is not.
+    if (
+        args.listen_unix is not None
+        and args.listen_address is parser.get_default("listen_address")
+    ):
+        args.listen_address = []
+    return parser, args
 
 
 async def doh1handler(request):
@@ -64,7 +83,23 @@ async def doh1handler(request):
             clientip, request.remote, utils.dnsquery2log(dnsq)
         )
     )
-    return await request.app.resolve(request, dnsq)
+    return await request.app.resolve(request, dnsq, wire=body)
+
+
+async def statshandler(request):
+    return aiohttp.web.json_response(workers.instance_stats(DNSClient.stats()))
+
+
+async def reload_on_sighup(app):
+    asyncio.get_event_loop().add_signal_handler(
+        signal.SIGHUP, DNSClient.FORWARDING.reload
+    )
+
+
+async def publish_stats(app):
+    task = asyncio.ensure_future(workers.publish_stats(DNSClient.stats))
+    yield
+    task.cancel()
 
 
 class DOHApplication(aiohttp.web.Application):
@@ -75,36 +110,59 @@ class DOHApplication(aiohttp.web.Application):
     def set_ecs(self, ecs):
         self.ecs = ecs
 
-    async def resolve(self, request, dnsq):
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    async def resolve(self, request, dnsq, wire=None):
         self.time_stamp = time.time()
         clientip = request.remote
-        dnsclient = DNSClient(
-            self.upstream_resolver, self.upstream_port, logger=self.logger
+        dnsclient = DNSClient.for_query(
+            dnsq, self.upstream_resolver, self.upstream_port, logger=self.logger
         )
-        dnsr = await dnsclient.query(dnsq, clientip, ecs=self.ecs)
+        try:
+            dnsr = await dnsclient.query_wire(
+                dnsq, clientip, timeout=self.timeout, ecs=self.ecs, wire=wire
+            )
+        except UpstreamOverloaded:
+            self.logger.info(
+                "[HTTPS] {} {} (SHED)".format(clientip, utils.dnsquery2log(dnsq))
+            )
+            if DNSClient.SHED_RETRY_AFTER is None:
+                return self.on_answer(request, dnsq=dnsq, rcode=DNSClient.SHED_RCODE)
+            return aiohttp.web.Response(
+                status=503,
+                body=b"Service Unavailable",
+                headers={"Retry-After": str(DNSClient.SHED_RETRY_AFTER)},
+            )
 
         if dnsr is None:
             return self.on_answer(request, dnsq=dnsq)
         else:
             return self.on_answer(request, dnsr=dnsr)
 
-    def on_answer(self, request, dnsr=None, dnsq=None):
+    def on_answer(self, request, dnsr=None, dnsq=None, rcode=dns.rcode.SERVFAIL):
         headers = CIMultiDict()
 
         if dnsr is None:
-            dnsr = dns.message.make_response(dnsq)
-            dnsr.set_rcode(dns.rcode.SERVFAIL)
-        elif len(dnsr.answer):
-            ttl = min(r.ttl for r in dnsr.answer)
-            headers["cache-control"] = "max-age={}".format(ttl)
-
-        clientip = utils.get_client_ip(request.transport)
-        interval = int((time.time() - self.time_stamp) * 1000)
-        self.logger.info(
-            "[HTTPS] {} (Original IP: {}) {} {}ms".format(
-                clientip, request.remote, utils.dnsans2log(dnsr), interval
+            failure = dns.message.make_response(dnsq)
+            failure.set_rcode(rcode)
+            dnsr = dnswire.WireMessage(failure.to_wire())
+        else:
+            ttl = dnsr.max_age(DNSClient.NEGATIVE_TTL_MAX)
+            if ttl is not None:
+                headers["cache-control"] = "max-age={}".format(ttl)
+
+        if self.logger.isEnabledFor(logging.INFO):
+            clientip = utils.get_client_ip(request.transport)
+            interval = int((time.time() - self.time_stamp) * 1000)
+            self.logger.info(
+                "[HTTPS] {} (Original IP: {}) {} {}ms".format(
+                    clientip,
+                    request.remote,
+                    utils.dnsans2log(dnsr.message()),
+                    interval,
+                )
             )
-        )
         if request.method == "HEAD":
             body = b""
         else:
@@ -137,8 +195,16 @@ def get_app(args):
     app = DOHApplication(logger=logger, debug=args.debug)
     app.set_upstream_resolver(args.upstream_resolver, args.upstream_port)
     app.set_ecs(args.ecs)
+    app.set_timeout(args.upstream_timeout)
+    DNSClient.configure(args)
     app.router.add_get(args.uri, doh1handler)
     app.router.add_post(args.uri, doh1handler)
+    if args.stats_uri is not None:
+        app.router.add_get(args.stats_uri, statshandler)
+    if DNSClient.FORWARDING is not None:
+        app.on_startup.append(reload_on_sighup)
+    if args.stats_uri is not None and workers._stats_dir is not None:
+        app.cleanup_ctx.append(publish_stats)
 
     # Get trusted reverse proxies and format it for aiohttp_remotes setup
     if len(args.trusted) == 0:
@@ -150,15 +216,70 @@ def get_app(args):
     return app
 
 
-def main():
-    parser, args = parse_args()
-    app = get_app(args)
+def bind_unix_socket(path):
+    """Bind a Unix domain socket, replacing a stale one left at path.
+    :return: the socket, to listen on.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    return sock
 
-    ssl_context = setup_ssl(parser, args)
+
+def serve(args, ssl_context, sock=None, reuse_port=False):
+    """Serve until SIGTERM or Ctrl+C.
+    :param sock: a bound socket to listen on too.
+    :param reuse_port: bind the listening addresses with SO_REUSEPORT, for
+        other worker processes to bind them too.
+    """
+    # Created from the policy of --event-loop, get_app needs one.
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    app = get_app(args)
+    if "all" in args.listen_address:
+        listen_addresses = utils.get_system_addresses()
+    else:
+        listen_addresses = args.listen_address
     aiohttp.web.run_app(
-        app, host=args.listen_address, port=args.port, ssl_context=ssl_context
+        app,
+        # Without addresses, aiohttp would listen on all of them at port.
+        host=listen_addresses or None,
+        port=args.port if listen_addresses else None,
+        sock=sock,
+        ssl_context=ssl_context,
+        reuse_port=reuse_port,
+        shutdown_timeout=args.upstream_timeout,
     )
 
 
+def main():
+    parser, args = parse_args()
+    ssl_context = setup_ssl(parser, args)
+    logger = utils.configure_logger("doh-httpproxy", args.level)
+    utils.set_event_loop_policy(args.event_loop, logger)
+
+    # Bound before starting workers, which then all accept on it.
+    sock = None
+    if args.listen_unix is not None:
+        sock = bind_unix_socket(args.listen_unix)
+    try:
+        if args.workers > 1:
+            supervisor = workers.Supervisor(
+                args.workers,
+                lambda: serve(args, ssl_context, sock=sock, reuse_port=True),
+                logger,
+                cpu_affinity=args.worker_cpu_affinity,
+            )
+            sys.exit(supervisor.run())
+        serve(args, ssl_context, sock=sock)
+    finally:
+        if sock is not None:
+            sock.close()
+            os.remove(args.listen_unix)
+
+
 if __name__ == "__main__":
     main()
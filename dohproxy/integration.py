@@ -266,6 +266,8 @@ def main():
     )
 
     args = parser.parse_args()
+    utils.set_event_loop_policy(args.event_loop)
+    asyncio.set_event_loop(asyncio.new_event_loop())
     # HACK: pass arguments to `ServerIntegrationBaseClassTest` so we can access
     # them within the tests.
     ServerIntegrationBaseClassTest.ARGS = args
@@ -8,29 +8,51 @@
 #
 import asyncio
 import collections
-import io
+import json
+import logging
+import signal
+import sys
 import time
 from typing import List, Tuple
 
 import dns.message
 import dns.rcode
-from dohproxy import constants, utils
+from dohproxy import constants, dnswire, utils, workers
 from dohproxy.server_protocol import (
     DNSClient,
     DOHDNSException,
     DOHParamsException,
 )
+from dohproxy.upstream import UpstreamOverloaded
 from h2.config import H2Configuration
 from h2.connection import H2Connection
+from h2.errors import ErrorCodes
 from h2.events import (
     ConnectionTerminated,
     DataReceived,
+    RemoteSettingsChanged,
     RequestReceived,
     StreamEnded,
+    StreamReset,
+    WindowUpdated,
 )
-from h2.exceptions import ProtocolError
+from h2.exceptions import ProtocolError, StreamClosedError
+from h2.settings import SettingCodes, Settings
 
-RequestData = collections.namedtuple("RequestData", ["headers", "data"])
+
+class StreamState:
+    """A request, from its headers to its answer."""
+
+    __slots__ = ("method", "path", "content_type", "data", "start")
+
+    def __init__(self, method, path, content_type):
+        self.method = method
+        self.path = path
+        self.content_type = content_type
+        # The body of a POST.
+        self.data = bytearray()
+        # When the request was complete, for the latency of its answer.
+        self.start = None
 
 
 def parse_args():
@@ -39,6 +61,28 @@ def parse_args():
 
 
 class H2Protocol(asyncio.Protocol):
+    """Answer DOH requests over HTTP/2.
+
+    Output is not written as it is produced, but flushed once per loop
+    iteration, so that the answers to a batch of requests, and those
+    finishing together, go out in as few TLS records and syscalls as
+    possible. Answer bodies which do not fit in the flow control windows
+    yet wait for WINDOW_UPDATE, and nothing is written while the transport
+    is paused.
+
+    The state of a stream is freed once it is answered or reset, and the
+    number of streams, the size of their headers and that of their bodies
+    are capped, so that the memory of a connection does not grow with the
+    number of requests it has made.
+    """
+
+    # Streams answered concurrently, advertised to the client.
+    MAX_CONCURRENT_STREAMS = 100
+    # Size of the headers of a request, advertised to the client.
+    MAX_HEADER_LIST_SIZE = 16384
+    # Size of the body of a POST, no DNS message is larger.
+    MAX_BODY_SIZE = 65535
+
     def __init__(
         self,
         upstream_resolver=None,
@@ -47,51 +91,150 @@ class H2Protocol(asyncio.Protocol):
         logger=None,
         debug=False,
         ecs=False,
+        stats_uri=None,
+        timeout=DNSClient.DEFAULT_TIMEOUT,
     ):
         config = H2Configuration(client_side=False, header_encoding="utf-8")
         self.conn = H2Connection(config=config)
+        self.conn.local_settings = Settings(
+            client=False,
+            initial_values={
+                SettingCodes.MAX_CONCURRENT_STREAMS: self.MAX_CONCURRENT_STREAMS,
+                SettingCodes.MAX_HEADER_LIST_SIZE: self.MAX_HEADER_LIST_SIZE,
+            },
+        )
+        # h2 only applies the limit to its HPACK decoder when a change of
+        # the settings is acknowledged, and these are the initial ones.
+        self.conn.decoder.max_header_list_size = self.MAX_HEADER_LIST_SIZE
         self.logger = logger
         if logger is None:
             self.logger = utils.configure_logger("doh-proxy", "DEBUG")
         self.transport = None
         self.debug = debug
         self.ecs = ecs
+        # stream ID -> StreamState, of the streams not answered yet.
         self.stream_data = {}
+        # Bodies of the answers waiting for flow control windows.
+        self.pending_data = collections.OrderedDict()
+        self.flush_handle = None
+        self.paused = False
         self.upstream_resolver = upstream_resolver
         self.upstream_port = upstream_port
-        self.time_stamp = 0
         self.uri = constants.DOH_URI if uri is None else uri
+        self.stats_uri = stats_uri
+        self.timeout = timeout
         assert upstream_resolver is not None, "An upstream resolver must be provided"
         assert upstream_port is not None, "An upstream resolver port must be provided"
 
     def connection_made(self, transport: asyncio.Transport):  # type: ignore
         self.transport = transport
         self.conn.initiate_connection()
-        self.transport.write(self.conn.data_to_send())
+        self.schedule_flush()
+
+    def connection_lost(self, exc):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.stream_data.clear()
+        self.pending_data.clear()
+
+    def pause_writing(self):
+        # Stop reading too, so that a client not reading its answers cannot
+        # pile up more of them.
+        self.paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self.transport.resume_reading()
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """Write the output of the connection at the end of this loop
+        iteration, along with any other produced until then.
+        """
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if self.paused or self.transport.is_closing():
+            return
+        data = self.conn.data_to_send()
+        if data:
+            self.transport.write(data)
 
     def data_received(self, data: bytes):
         try:
             events = self.conn.receive_data(data)
         except ProtocolError:
-            self.transport.write(self.conn.data_to_send())
+            self.flush()
             self.transport.close()
-        else:
-            self.transport.write(self.conn.data_to_send())
-            for event in events:
-                if isinstance(event, RequestReceived):
-                    self.request_received(event.headers, event.stream_id)
-                elif isinstance(event, DataReceived):
-                    self.receive_data(event.data, event.stream_id)
-                elif isinstance(event, StreamEnded):
-                    self.stream_complete(event.stream_id)
-                elif isinstance(event, ConnectionTerminated):
-                    self.transport.close()
-
-                self.transport.write(self.conn.data_to_send())
+            return
+        for event in events:
+            if isinstance(event, RequestReceived):
+                self.request_received(event.headers, event.stream_id)
+            elif isinstance(event, DataReceived):
+                self.receive_data(event.data, event.stream_id)
+                # Buffered, up to MAX_BODY_SIZE, so the window can be
+                # given back at once.
+                self.conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+            elif isinstance(event, StreamEnded):
+                self.stream_complete(event.stream_id)
+            elif isinstance(event, StreamReset):
+                self.stream_data.pop(event.stream_id, None)
+                self.pending_data.pop(event.stream_id, None)
+            elif isinstance(event, (WindowUpdated, RemoteSettingsChanged)):
+                self.send_pending_data()
+            elif isinstance(event, ConnectionTerminated):
+                self.flush()
+                self.transport.close()
+                return
+        self.schedule_flush()
+
+    def send_response(self, stream_id: int, headers, body: bytes):
+        """Send an answer, its body as the flow control windows allow, and
+        free the state of its stream.
+        """
+        self.stream_data.pop(stream_id, None)
+        self.conn.send_headers(stream_id, headers, end_stream=not body)
+        if body:
+            self.pending_data[stream_id] = body
+            self.send_pending_data()
+        self.schedule_flush()
+
+    def send_pending_data(self):
+        """Send what fits in the flow control windows of the bodies waiting
+        for them, in the order of the answers.
+        """
+        for stream_id, body in list(self.pending_data.items()):
+            try:
+                window = self.conn.local_flow_control_window(stream_id)
+            except StreamClosedError:
+                del self.pending_data[stream_id]
+                continue
+            size = min(window, len(body), self.conn.max_outbound_frame_size)
+            if size <= 0:
+                continue
+            end_stream = size == len(body)
+            self.conn.send_data(stream_id, body[:size], end_stream=end_stream)
+            if end_stream:
+                del self.pending_data[stream_id]
+            else:
+                self.pending_data[stream_id] = body[size:]
+        self.schedule_flush()
 
     def request_received(self, headers: List[Tuple[str, str]], stream_id: int):
-        _headers = collections.OrderedDict(headers)
-        method = _headers[":method"]
+        method = path = content_type = None
+        for name, value in headers:
+            if name == ":method":
+                method = value
+            elif name == ":path":
+                path = value
+            elif name == "content-type":
+                content_type = value
 
         # We only support GET and POST.
         if method not in ["GET", "POST", "HEAD"]:
@@ -99,24 +242,26 @@ class H2Protocol(asyncio.Protocol):
             return
 
         # Store off the request data.
-        request_data = RequestData(_headers, io.BytesIO())
-        self.stream_data[stream_id] = request_data
+        self.stream_data[stream_id] = StreamState(method, path, content_type)
 
     def stream_complete(self, stream_id: int):
         """
         When a stream is complete, we can send our response.
         """
         try:
-            request_data = self.stream_data[stream_id]
+            stream = self.stream_data[stream_id]
         except KeyError:
             # Just return, we probably 405'd this already
             return
 
-        headers = request_data.headers
-        method = request_data.headers[":method"]
+        method = stream.method
 
         # Handle the actual query
-        path, params = utils.extract_path_params(headers[":path"])
+        path, params = utils.extract_path_params(stream.path)
+
+        if self.stats_uri is not None and path == self.stats_uri:
+            self.return_stats(stream_id)
+            return
 
         if path != self.uri:
             self.return_404(stream_id)
@@ -129,8 +274,8 @@ class H2Protocol(asyncio.Protocol):
                 self.return_400(stream_id, body=e.body())
                 return
         elif method == "POST":
-            body = request_data.data.getvalue()
-            ct = headers.get("content-type")
+            body = bytes(stream.data)
+            ct = stream.content_type
         else:
             self.return_501(stream_id)
             return
@@ -148,14 +293,14 @@ class H2Protocol(asyncio.Protocol):
 
         clientip = utils.get_client_ip(self.transport)
         self.logger.info("[HTTPS] {} {}".format(clientip, utils.dnsquery2log(dnsq)))
-        self.time_stamp = time.time()
-        asyncio.ensure_future(self.resolve(dnsq, stream_id))
+        stream.start = time.time()
+        asyncio.ensure_future(self.resolve(dnsq, stream_id, wire=body))
 
-    def on_answer(self, stream_id, dnsr=None, dnsq=None):
+    def on_answer(self, stream_id, dnsr=None, dnsq=None, rcode=dns.rcode.SERVFAIL):
         try:
-            request_data = self.stream_data[stream_id]
+            stream = self.stream_data[stream_id]
         except KeyError:
-            # Just return, we probably 405'd this already
+            # Just return, the stream was reset or the connection lost
             return
 
         response_headers = [
@@ -164,40 +309,69 @@ class H2Protocol(asyncio.Protocol):
             ("server", "asyncio-h2"),
         ]
         if dnsr is None:
-            dnsr = dns.message.make_response(dnsq)
-            dnsr.set_rcode(dns.rcode.SERVFAIL)
-        elif len(dnsr.answer):
-            ttl = min(r.ttl for r in dnsr.answer)
-            response_headers.append(("cache-control", "max-age={}".format(ttl)))
+            failure = dns.message.make_response(dnsq)
+            failure.set_rcode(rcode)
+            dnsr = dnswire.WireMessage(failure.to_wire())
+        else:
+            ttl = dnsr.max_age(DNSClient.NEGATIVE_TTL_MAX)
+            if ttl is not None:
+                response_headers.append(("cache-control", "max-age={}".format(ttl)))
 
-        clientip = utils.get_client_ip(self.transport)
-        interval = int((time.time() - self.time_stamp) * 1000)
-        self.logger.info(
-            "[HTTPS] {} {} {}ms".format(clientip, utils.dnsans2log(dnsr), interval)
-        )
-        if request_data.headers[":method"] == "HEAD":
+        if self.logger.isEnabledFor(logging.INFO):
+            clientip = utils.get_client_ip(self.transport)
+            interval = int((time.time() - stream.start) * 1000)
+            self.logger.info(
+                "[HTTPS] {} {} {}ms".format(
+                    clientip, utils.dnsans2log(dnsr.message()), interval
+                )
+            )
+        if stream.method == "HEAD":
             body = b""
         else:
             body = dnsr.to_wire()
         response_headers.append(("content-length", str(len(body))))
+        self.send_response(stream_id, response_headers, body)
 
-        self.conn.send_headers(stream_id, response_headers)
-        self.conn.send_data(stream_id, body, end_stream=True)
-        self.transport.write(self.conn.data_to_send())
-
-    async def resolve(self, dnsq, stream_id):
+    async def resolve(self, dnsq, stream_id, wire=None):
         clientip = utils.get_client_ip(self.transport)
-        dnsclient = DNSClient(
-            self.upstream_resolver, self.upstream_port, logger=self.logger
+        dnsclient = DNSClient.for_query(
+            dnsq, self.upstream_resolver, self.upstream_port, logger=self.logger
         )
-        dnsr = await dnsclient.query(dnsq, clientip, ecs=self.ecs)
+        try:
+            dnsr = await dnsclient.query_wire(
+                dnsq, clientip, timeout=self.timeout, ecs=self.ecs, wire=wire
+            )
+        except UpstreamOverloaded:
+            self.logger.info(
+                "[HTTPS] {} {} (SHED)".format(clientip, utils.dnsquery2log(dnsq))
+            )
+            if DNSClient.SHED_RETRY_AFTER is None:
+                self.on_answer(stream_id, dnsq=dnsq, rcode=DNSClient.SHED_RCODE)
+            elif stream_id in self.stream_data:
+                self.return_503(stream_id, DNSClient.SHED_RETRY_AFTER)
+            return
 
         if dnsr is None:
             self.on_answer(stream_id, dnsq=dnsq)
         else:
             self.on_answer(stream_id, dnsr=dnsr)
 
-    def return_XXX(self, stream_id: int, status: int, body: bytes = b""):
+    def return_stats(self, stream_id: int):
+        """
+        Return the process-wide counters as JSON.
+        """
+        body = json.dumps(workers.instance_stats(DNSClient.stats())).encode("utf-8")
+        response_headers = (
+            (":status", "200"),
+            ("content-type", "application/json"),
+            ("content-length", str(len(body))),
+            ("server", "asyncio-h2"),
+        )
+        self.send_response(stream_id, response_headers, body)
+
+    def return_XXX(
+        self, stream_id: int, status: int, body: bytes = b"", headers=()
+    ):
         """
         Wrapper to return a status code and some optional content.
         """
@@ -205,9 +379,8 @@ class H2Protocol(asyncio.Protocol):
             (":status", str(status)),
             ("content-length", str(len(body))),
             ("server", "asyncio-h2"),
-        )
-        self.conn.send_headers(stream_id, response_headers)
-        self.conn.send_data(stream_id, body, end_stream=True)
+        ) + tuple(headers)
+        self.send_response(stream_id, response_headers, body)
 
     def return_400(self, stream_id: int, body: bytes = b""):
         """
@@ -239,6 +412,31 @@ class H2Protocol(asyncio.Protocol):
         """
         self.return_XXX(stream_id, 415, body=b"Unsupported content type")
 
+    def return_503(self, stream_id: int, retry_after: int):
+        """
+        The upstream resolvers are overloaded, ask the client to come back
+        later.
+        """
+        self.return_XXX(
+            stream_id,
+            503,
+            body=b"Service Unavailable",
+            headers=(("retry-after", str(retry_after)),),
+        )
+
+    def return_413(self, stream_id: int):
+        """
+        The body of the request is larger than any DNS message. The stream is
+        then reset for the client to stop sending it (RFC 7540 8.1): with
+        NO_ERROR once the response is sent, with CANCEL if flow control still
+        holds it back.
+        """
+        self.return_XXX(stream_id, 413, body=b"Payload Too Large")
+        if self.pending_data.pop(stream_id, None) is None:
+            self.conn.reset_stream(stream_id, ErrorCodes.NO_ERROR)
+        else:
+            self.conn.reset_stream(stream_id, ErrorCodes.CANCEL)
+
     def return_501(self, stream_id: int):
         """
         We don't support the given method.
@@ -251,24 +449,35 @@ class H2Protocol(asyncio.Protocol):
         expecting data on, save it off. Otherwise, reset the stream.
         """
         try:
-            stream_data = self.stream_data[stream_id]
+            stream = self.stream_data[stream_id]
         except KeyError:
             # Unknown stream, log and ignore (the stream may already be ended)
             clientip = utils.get_client_ip(self.transport)
             self.logger.info("[HTTPS] %s Unknown stream %d", clientip, stream_id)
-        else:
-            stream_data.data.write(data)
+            return
+        if len(stream.data) + len(data) > self.MAX_BODY_SIZE:
+            self.return_413(stream_id)
+            return
+        stream.data += data
 
 
-def main():
-    args = parse_args()
-    logger = utils.configure_logger("doh-proxy", args.level)
+def serve(args, logger, reuse_port=False):
+    """Serve until SIGTERM or Ctrl+C.
+    :param reuse_port: bind the listening addresses with SO_REUSEPORT, for
+        other worker processes to bind them too.
+    """
     ssl_ctx = utils.create_ssl_context(args, http2=True)
-    loop = asyncio.get_event_loop()
+    DNSClient.configure(args)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if DNSClient.FORWARDING is not None:
+        loop.add_signal_handler(signal.SIGHUP, DNSClient.FORWARDING.reload)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
     if "all" in args.listen_address:
         listen_addresses = utils.get_system_addresses()
     else:
         listen_addresses = args.listen_address
+    servers = []
     for addr in listen_addresses:
         coro = loop.create_server(
             lambda: H2Protocol(
@@ -278,25 +487,57 @@ def main():
                 logger=logger,
                 debug=args.debug,
                 ecs=args.ecs,
+                stats_uri=args.stats_uri,
+                timeout=args.upstream_timeout,
             ),
             host=addr,
             port=args.port,
             ssl=ssl_ctx,
+            reuse_port=reuse_port,
         )
         server = loop.run_until_complete(coro)
+        servers.append(server)
 
         # Serve requests until Ctrl+C is pressed
         logger.info("Serving on {}".format(server))
+    tasks = []
+    if workers._stats_dir is not None and args.stats_uri is not None:
+        tasks.append(asyncio.ensure_future(workers.publish_stats(DNSClient.stats)))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
-    # Close the server
-    server.close()
-    loop.run_until_complete(server.wait_closed())
+    # Close the servers, and let the queries in flight finish
+    for server in servers:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+    for task in tasks:
+        task.cancel()
+    try:
+        all_tasks = asyncio.all_tasks
+    except AttributeError:  # Python < 3.7
+        all_tasks = asyncio.Task.all_tasks
+    pending = [task for task in all_tasks(loop) if not task.done()]
+    if pending:
+        loop.run_until_complete(asyncio.wait(pending, timeout=args.upstream_timeout))
     loop.close()
 
 
+def main():
+    args = parse_args()
+    logger = utils.configure_logger("doh-proxy", args.level)
+    utils.set_event_loop_policy(args.event_loop, logger)
+    if args.workers > 1:
+        supervisor = workers.Supervisor(
+            args.workers,
+            lambda: serve(args, logger, reuse_port=True),
+            logger,
+            cpu_affinity=args.worker_cpu_affinity,
+        )
+        sys.exit(supervisor.run())
+    serve(args, logger)
+
+
 if __name__ == "__main__":
     main()
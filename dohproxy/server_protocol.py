@@ -7,13 +7,29 @@
 # LICENSE file in the root directory of this source tree.
 #
 import asyncio
+import collections
+import functools
+import logging
+import ssl
 import struct
 import time
 
 import dns.edns
 import dns.entropy
+import dns.exception
 import dns.message
-from dohproxy import utils
+import dns.rcode
+import h2.exceptions
+from dohproxy import constants, dnswire, utils
+from dohproxy.cache import DNSCache
+from dohproxy.forwarding import ForwardingTable
+from dohproxy.upstream import UpstreamHealth, UpstreamLimit, UpstreamOverloaded
+
+try:
+    import aioh2
+except ImportError as e:
+    # Optional module, needed to query upstreams over HTTPS
+    aioh2 = e
 
 
 class DOHException(Exception):
@@ -32,164 +48,1453 @@ class DOHDNSException(DOHException):
 class DNSClient:
 
     DEFAULT_TIMEOUT = 10
+    # Process-wide settings, see configure().
+    UDP_POOL_SIZE = 4
+    TCP_POOL_SIZE = 2
+    TCP_IDLE_TIMEOUT = 10
+    CACHE = None
+    # Upstream resolvers of some domains, see for_query().
+    FORWARDING = None
+    # Maximum TTL of negative answers, in the cache and in the cache-control
+    # header of the frontends.
+    NEGATIVE_TTL_MAX = 3600
+    # How long to wait for the upstreams before serving a stale answer from
+    # CACHE, when it keeps them.
+    STALE_ANSWER_TIMEOUT = 1.8
+    # Maximum number of cache entries refreshed at once, when CACHE
+    # prefetches them.
+    PREFETCH_CONCURRENCY = 4
+    HEDGE = False
+    HEDGE_PERCENTILE = 95
+    # Number of rounds of UDP transmissions to the upstreams before falling
+    # back to TCP.
+    UDP_TRANSMISSIONS = 3
+    # UDP retransmissions in flight are capped to this fraction of the UDP
+    # queries in flight, or to RETRANSMIT_BUDGET_MIN if that is more, so that
+    # they do not pile onto an overloaded upstream.
+    RETRANSMIT_BUDGET = 0.2
+    RETRANSMIT_BUDGET_MIN = 10
+    _udp_queries = 0
+    _retransmissions = 0
+    # Questions, with the DO bit of their query, whose answer came back
+    # truncated recently, and are sent straight over TCP: key -> expiry
+    # time, oldest first. See remember_truncated().
+    TRUNCATED_MEMORY_SIZE = 10000
+    TRUNCATED_MEMORY_TTL = 600
+    _truncated = collections.OrderedDict()
+    # How the frontends answer queries shed by UpstreamLimit: with this
+    # rcode, or with HTTP 503 and this Retry-After, in seconds, when set.
+    SHED_RCODE = dns.rcode.SERVFAIL
+    SHED_RETRY_AFTER = None
+    # Process-wide counters and queries in flight, see stats() and
+    # query_coalesced().
+    COUNTERS = collections.Counter()
+    _inflight = {}
+    # Queries which went on in the background after a stale answer was
+    # served.
+    _refreshing = set()
+    _prefetching = set()
 
     def __init__(self, upstream_resolver, upstream_port, logger=None):
+        """
+        :param upstream_resolver: an upstream resolver address, or a list of
+            them. Addresses may carry a port, as in "[::1]:5353", and a
+            transport, as in "tls://10.0.0.1", see utils.parse_upstream_url.
+        :param upstream_port: the port of plain DNS upstreams given without
+            one.
+        """
         self.loop = asyncio.get_event_loop()
         self.upstream_resolver = upstream_resolver
         self.upstream_port = upstream_port
+        if isinstance(upstream_resolver, str):
+            upstream_resolver = [upstream_resolver]
+        # (address, port) tuples of every upstream, of those queried over
+        # TLS, and of those queried over HTTPS along with their DOH API path.
+        self.upstreams = []
+        self.tls_upstreams = set()
+        self.https_upstreams = {}
+        for upstream in upstream_resolver:
+            transport, address, port, path = utils.parse_upstream_url(
+                upstream, upstream_port
+            )
+            self.upstreams.append((address, port))
+            if transport == "tls":
+                self.tls_upstreams.add((address, port))
+            elif transport == "https":
+                self.https_upstreams[(address, port)] = path
         if logger is None:
             logger = utils.configure_logger("DNSClient", "DEBUG")
         self.logger = logger
         self.transport = None
 
-    async def query(self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, ecs=False):
-        # (Potentially) modified copy of dnsq
-        dnsq_mod = dns.message.from_wire(dnsq.to_wire())
-        we_set_ecs = False
-        if ecs:
-            we_set_ecs = utils.set_dns_ecs(dnsq_mod, clientip)
+    @classmethod
+    def configure(cls, args):
+        """Apply the process-wide upstream settings from the command line.
+        :param args: an argparse.Namespace built by utils.proxy_parser_base.
+        """
+        cls.UDP_POOL_SIZE = args.upstream_udp_sockets
+        UDPSocketPool.SOCKET_MAX_QUERIES = args.upstream_udp_socket_queries
+        cls.TCP_POOL_SIZE = args.upstream_tcp_connections
+        cls.TCP_IDLE_TIMEOUT = args.upstream_tcp_idle_timeout
+        UpstreamPool.CAFILE = args.upstream_tls_cafile
+        if isinstance(aioh2, ImportError) and any(
+            upstream.startswith("https://") for upstream in args.upstream_resolver
+        ):
+            raise aioh2
+        UpstreamHealth.RTO_MIN = args.upstream_rto_min
+        UpstreamLimit.MAX_OUTSTANDING = args.upstream_max_outstanding
+        UpstreamLimit.MAX_QUEUED = args.upstream_max_queued
+        cls.SHED_RCODE = dns.rcode.from_text(args.shed_rcode)
+        cls.SHED_RETRY_AFTER = args.shed_retry_after
+        UpstreamHealth.RTO_MAX = args.upstream_rto_max
+        cls.RETRANSMIT_BUDGET = args.upstream_retransmit_budget
+        UpstreamHealth.BREAKER_ERROR_RATE = args.circuit_breaker_error_rate
+        UpstreamHealth.BREAKER_COOLDOWN = args.circuit_breaker_cooldown
+        UpstreamHealth.BREAKER_PROBES = args.circuit_breaker_probes
+        UpstreamHealth.EDNS_PAYLOAD_LARGE = args.upstream_edns_payload
+        cls.TRUNCATED_MEMORY_SIZE = args.truncated_memory_size
+        cls.TRUNCATED_MEMORY_TTL = args.truncated_memory_ttl
+        cls.HEDGE = args.hedge
+        cls.HEDGE_PERCENTILE = args.hedge_percentile
+        cls.STALE_ANSWER_TIMEOUT = args.stale_answer_timeout
+        cls.PREFETCH_CONCURRENCY = args.prefetch_concurrency
+        cls.NEGATIVE_TTL_MAX = args.negative_ttl_max
+        cls.FORWARDING = None
+        if args.forward_zones is not None:
+            cls.FORWARDING = ForwardingTable(args.forward_zones)
+        cls.CACHE = None
+        if args.cache_size > 0:
+            cls.CACHE = DNSCache(
+                args.cache_size,
+                stale_window=args.serve_stale,
+                prefetch_min_hits=args.prefetch_min_hits if args.prefetch else 0,
+                negative_ttl_max=args.negative_ttl_max,
+                max_subnets=args.cache_ecs_subnets,
+            )
+
+    @classmethod
+    def stats(cls):
+        """Return the process-wide counters, as a dict."""
+        stats = {
+            "client": dict(cls.COUNTERS),
+            "upstreams": UpstreamHealth.report(),
+            "limits": UpstreamLimit.report(),
+        }
+        if cls.CACHE is not None:
+            stats["cache"] = cls.CACHE.stats()
+        if cls.FORWARDING is not None:
+            stats["forwarding"] = cls.FORWARDING.stats()
+        return stats
+
+    @classmethod
+    def for_query(cls, dnsq, upstream_resolver, upstream_port, logger=None):
+        """Return a DNSClient for the upstream resolvers FORWARDING has for
+        the name of a query, or for upstream_resolver.
+        :param dnsq: the query, as a dns.message.Message.
+        """
+        if cls.FORWARDING is not None and len(dnsq.question):
+            upstreams = cls.FORWARDING.lookup(dnsq.question[0].name)
+            if upstreams is not None:
+                upstream_resolver = list(upstreams)
+        return cls(upstream_resolver, upstream_port, logger=logger)
+
+    async def query(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, ecs=False, wire=None
+    ):
+        """Same as query_wire, with the answer parsed by dnspython.
+        :return: a dns.message.Message, or None.
+        """
+        answer = await self.query_wire(
+            dnsq, clientip, timeout=timeout, ecs=ecs, wire=wire
+        )
+        return None if answer is None else answer.message()
+
+    async def query_wire(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, ecs=False, wire=None
+    ):
+        """Resolve a query, from cache or upstream.
+        :param dnsq: the query, as a dns.message.Message. It is not modified.
+        :param wire: the query in wire format, as received from the client.
+            It is forwarded upstream with only its ID and EDNS options
+            rewritten. Built from dnsq when not given.
+        :return: the answer, as a dnswire.WireMessage with the ID of dnsq, or
+            None.
+        :raise UpstreamOverloaded: when the query was shed, see UpstreamLimit.
+        """
+        if wire is None:
+            wire = dnsq.to_wire()
+        subnet = None
+        if ecs and not any(
+            isinstance(option, dns.edns.ECSOption) for option in dnsq.options
+        ):
+            subnet = utils.dns_ecs_subnet(clientip)
+            wire = self.add_ecs(wire, subnet, clientip)
+        we_set_ecs = subnet is not None
+
+        dnsr = None
+        cache_key = DNSCache.make_key(dnsq, subnet=subnet)
+        if self.CACHE is not None:
+            dnsr = self.CACHE.get(cache_key, with_ecs=not we_set_ecs)
+            if dnsr is not None:
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info(
+                        "[DNS] {} {} (CACHED)".format(
+                            clientip, utils.dnsans2log(dnsr.message())
+                        )
+                    )
+                self.maybe_prefetch(cache_key, dnsq, clientip, timeout, wire=wire)
+        if dnsr is None:
+            if self.CACHE is not None and self.CACHE.stale_window > 0:
+                dnsr = await self.query_or_stale(
+                    cache_key, dnsq, clientip, timeout=timeout, wire=wire
+                )
+            else:
+                dnsr = await self.query_and_cache(
+                    cache_key, dnsq, clientip, timeout=timeout, wire=wire
+                )
+
+        if dnsr is not None:
+            dnsr.set_id(dnsq.id)
+            if we_set_ecs:
+                dnsr = dnsr.without_option(dns.edns.ECS)
+            if dnsq.edns < 0:
+                dnsr = dnsr.without_opt()
+
+        return dnsr
+
+    @staticmethod
+    def add_ecs(wire, subnet, clientip):
+        """Add an EDNS Client Subnet option to a query in wire format."""
+        data = dnswire.add_edns_option(
+            wire, dns.edns.ECS, dnswire.ecs_option_data(subnet)
+        )
+        if data is None:
+            # The OPT record is not last, leave it to dnspython.
+            dnsq = dns.message.from_wire(wire)
+            utils.set_dns_ecs(dnsq, clientip)
+            data = dnsq.to_wire()
+        return data
 
-        dnsr = await self.query_udp(dnsq_mod, clientip, timeout=timeout)
-        if dnsr is None or (dnsr.flags & dns.flags.TC):
-            dnsr = await self.query_tcp(dnsq_mod, clientip, timeout=timeout)
+    def maybe_prefetch(
+        self, key, dnsq, clientip, timeout=DEFAULT_TIMEOUT, wire=None
+    ):
+        """Refresh a popular cache entry in the background before it
+        expires, unless PREFETCH_CONCURRENCY refreshes are already running.
+        """
+        if len(self._prefetching) >= self.PREFETCH_CONCURRENCY:
+            return
+        if not self.CACHE.prefetch_due(key):
+            return
+        self.COUNTERS["prefetches"] += 1
+        self.logger.debug(
+            "[DNS] {} {} (PREFETCH)".format(clientip, utils.dnsquery2log(dnsq))
+        )
+        task = asyncio.ensure_future(
+            self.query_and_cache(key, dnsq, clientip, timeout=timeout, wire=wire)
+        )
+        self._prefetching.add(task)
+        task.add_done_callback(
+            functools.partial(self._background_done, self._prefetching)
+        )
 
-        if dnsr is not None and we_set_ecs:
-            for option in dnsr.options:
-                if isinstance(option, dns.edns.ECSOption):
-                    dnsr.options.remove(option)
-            dnsr.edns = dnsq.edns
+    def _background_done(self, tasks, task):
+        tasks.discard(task)
+        if not task.cancelled() and isinstance(task.exception(), UpstreamOverloaded):
+            self.logger.debug("Background query shed")
 
+    async def query_and_cache(
+        self, key, dnsq, clientip, timeout=DEFAULT_TIMEOUT, wire=None
+    ):
+        dnsr = await self.query_coalesced(
+            key, dnsq, clientip, timeout=timeout, wire=wire
+        )
+        if dnsr is not None and self.CACHE is not None:
+            self.CACHE.put(key, dnsr)
         return dnsr
 
-    async def query_udp(self, dnsq, clientip, timeout=DEFAULT_TIMEOUT):
-        qid = dnsq.id
-        fut = asyncio.Future()
-        transport, _ = await self.loop.create_datagram_endpoint(
-            lambda: DNSClientProtocolUDP(dnsq, fut, clientip, logger=self.logger),
-            remote_addr=(self.upstream_resolver, self.upstream_port),
+    async def query_or_stale(
+        self, key, dnsq, clientip, timeout=DEFAULT_TIMEOUT, wire=None
+    ):
+        """Query the upstreams, and serve a stale answer from cache if they
+        did not answer within STALE_ANSWER_TIMEOUT or failed (RFC 8767).
+        The query then goes on in the background to refresh the cache. Stale
+        answers are also served to queries which were shed.
+        """
+        task = asyncio.ensure_future(
+            self.query_and_cache(key, dnsq, clientip, timeout=timeout, wire=wire)
+        )
+        done, _ = await asyncio.wait(
+            [task], timeout=min(self.STALE_ANSWER_TIMEOUT, timeout)
         )
-        return await self._try_query(fut, qid, timeout, transport)
+        if done and task.exception() is None and task.result() is not None:
+            return task.result()
+        dnsr = self.CACHE.get_stale(key)
+        if dnsr is None:
+            return await task
+        self.COUNTERS["stale_served"] += 1
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                "[DNS] {} {} (STALE)".format(
+                    clientip, utils.dnsans2log(dnsr.message())
+                )
+            )
+        if not done:
+            self._refreshing.add(task)
+            task.add_done_callback(
+                functools.partial(self._background_done, self._refreshing)
+            )
+        return dnsr
+
+    async def query_coalesced(
+        self, key, dnsq, clientip, timeout=DEFAULT_TIMEOUT, wire=None
+    ):
+        """Send a query upstream, unless the same question is already in
+        flight to this upstream, in which case its answer is shared. Queries
+        sent upstream first take a slot of the UpstreamLimit of the
+        upstreams.
+        :raise UpstreamOverloaded: when the query was shed.
+        """
+        key = (tuple(self.upstreams),) + key
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.COUNTERS["coalesced"] += 1
+            self.logger.debug(
+                "[DNS] {} {} (COALESCED)".format(clientip, utils.dnsquery2log(dnsq))
+            )
+            try:
+                wire = await asyncio.wait_for(asyncio.shield(fut), timeout)
+            except asyncio.TimeoutError:
+                self.logger.debug("Request timed out")
+                return None
+            return None if wire is None else dnswire.WireMessage(wire)
 
-    async def query_tcp(self, dnsq, clientip, timeout=DEFAULT_TIMEOUT):
-        qid = dnsq.id
-        fut = asyncio.Future()
-        start_time = time.time()
+        # The answer is shared in wire format so that every waiter gets its
+        # own copy to restore its message ID and EDNS on.
+        fut = self.loop.create_future()
+        self._inflight[key] = fut
+        dnsr = None
+        limit = UpstreamLimit.get(key[0])
         try:
-            transport, _ = await asyncio.wait_for(
-                self.loop.create_connection(
-                    lambda: DNSClientProtocolTCP(
-                        dnsq, fut, clientip, logger=self.logger
-                    ),
-                    self.upstream_resolver,
-                    self.upstream_port,
-                ),
+            deadline = self.loop.time() + timeout
+            try:
+                await limit.acquire(timeout)
+            except UpstreamOverloaded:
+                self.COUNTERS["shed"] += 1
+                raise
+            try:
+                dnsr = await self.query_upstream(
+                    dnsq, clientip, timeout=deadline - self.loop.time(), wire=wire
+                )
+            finally:
+                limit.release()
+            if dnsr is not None:
+                # The answer is shared with the other waiters and the cache,
+                # the options meant for this client only are not.
+                dnsr = dnsr.without_options(constants.DNS_EDNS_HOP_BY_HOP_OPTIONS)
+        finally:
+            del self._inflight[key]
+            fut.set_result(None if dnsr is None else dnsr.to_wire())
+        return dnsr
+
+    async def query_upstream(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, wire=None
+    ):
+        """Send a query over UDP, retransmitting it and failing over between
+        the upstreams until timeout. A truncated answer is retried over TCP
+        on the same upstream, and TCP is tried on the best upstream when UDP
+        got no answer.
+
+        Upstreams queried over TLS or HTTPS are tried first, one after the
+        other, when one of them ranks best or when there are only such
+        upstreams. Upstreams whose circuit is open are skipped, and the query
+        fails at once when all of them are. Upstreams letting probes through
+        are tried first, or they would never recover while the others
+        answer.
+
+        Questions whose answer was recently truncated go straight to TCP.
+        """
+        if wire is None:
+            wire = dnsq.to_wire()
+        deadline = self.loop.time() + timeout
+        ranked = [
+            u
+            for u in UpstreamHealth.rank(self.upstreams)
+            if not UpstreamHealth.get(u).is_open()
+        ]
+        ranked.sort(key=lambda u: not UpstreamHealth.get(u).wants_probe())
+        if not ranked:
+            self.COUNTERS["circuit_open"] += 1
+            self.logger.debug(
+                "[DNS] {} {} (CIRCUIT OPEN)".format(clientip, utils.dnsquery2log(dnsq))
+            )
+            return None
+        candidates = [u for u in ranked if not self.is_encrypted(u)]
+        if not candidates or self.is_encrypted(ranked[0]):
+            dnsr = await self.query_encrypted_failover(
+                dnsq,
+                clientip,
                 timeout,
+                [u for u in ranked if self.is_encrypted(u)],
+                wire=wire,
             )
-        except asyncio.TimeoutError:
+            if dnsr is not None or not candidates:
+                return dnsr
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                return None
+        truncation_key = dnswire.question_key(wire) + (
+            bool(dnsq.ednsflags & dns.flags.DO),
+        )
+        if self.recently_truncated(truncation_key):
+            self.COUNTERS["truncated_to_tcp"] += 1
             self.logger.debug(
-                "Timeout connecting to upstream resolver {}:{}".format(
-                    self.upstream_resolver, self.upstream_port
+                "[DNS] {} {} (TRUNCATED BEFORE)".format(
+                    clientip, utils.dnsquery2log(dnsq)
                 )
             )
+            return await self.query_tcp(
+                dnsq, clientip, timeout=timeout, upstream=candidates[0], wire=wire
+            )
+        dnsr, upstream = await self.query_udp_retransmit(
+            dnsq, clientip, timeout, candidates, wire=wire
+        )
+        if dnsr is not None and not dnsr.flags & dns.flags.TC:
+            return dnsr
+        if dnsr is not None:
+            self.remember_truncated(truncation_key)
+        remaining = deadline - self.loop.time()
+        if remaining <= 0:
             return None
+        return await self.query_tcp(
+            dnsq,
+            clientip,
+            timeout=remaining,
+            upstream=upstream or candidates[0],
+            wire=wire,
+        )
+
+    def remember_truncated(self, key):
+        """Remember that the answer to a question came back truncated, for
+        TRUNCATED_MEMORY_TTL seconds and as one of the
+        TRUNCATED_MEMORY_SIZE most recent ones.
+        """
+        if not self.TRUNCATED_MEMORY_SIZE:
+            return
+        self._truncated[key] = self.loop.time() + self.TRUNCATED_MEMORY_TTL
+        self._truncated.move_to_end(key)
+        while len(self._truncated) > self.TRUNCATED_MEMORY_SIZE:
+            self._truncated.popitem(last=False)
+
+    def recently_truncated(self, key):
+        expiry = self._truncated.get(key)
+        if expiry is None:
+            return False
+        if expiry <= self.loop.time():
+            del self._truncated[key]
+            return False
+        return True
+
+    def is_encrypted(self, upstream):
+        return upstream in self.tls_upstreams or upstream in self.https_upstreams
+
+    async def query_encrypted_failover(
+        self, dnsq, clientip, timeout, candidates, wire=None
+    ):
+        """Send a query over TLS or HTTPS to each candidate upstream in turn,
+        until one answers. Each gets an equal share of what is left of
+        timeout.
+        :return: the answer, or None.
+        """
+        deadline = self.loop.time() + timeout
+        for i, upstream in enumerate(candidates):
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            if i:
+                self.logger.debug(
+                    "[DNS] {} {} (FAILOVER {}:{})".format(
+                        clientip, utils.dnsquery2log(dnsq), *upstream
+                    )
+                )
+            if upstream in self.https_upstreams:
+                query = self.query_https
+            else:
+                query = self.query_tls
+            dnsr = await query(
+                dnsq,
+                clientip,
+                timeout=remaining / (len(candidates) - i),
+                upstream=upstream,
+                wire=wire,
+            )
+            if dnsr is not None:
+                return dnsr
+        return None
+
+    async def query_udp_retransmit(
+        self, dnsq, clientip, timeout, candidates, wire=None
+    ):
+        """Send a query over UDP, and retransmit it while no answer came.
+
+        Transmissions rotate over the candidate upstreams, each waiting the
+        retransmission timeout (RTO) of its upstream doubled at every round,
+        up to UDP_TRANSMISSIONS rounds. With hedging, the first wait is
+        rather a percentile of the RTT of the first upstream. Earlier
+        transmissions stay in flight, so the first answer to any of them
+        wins and the others are cancelled. Retransmissions past the budget,
+        see RETRANSMIT_BUDGET, are skipped and the earlier transmissions are
+        waited for instead.
+
+        Each upstream queried gets one outcome once the query is over: a
+        failure when it got no answer by the deadline or its socket failed,
+        a miss when only its RTO expired, see UpstreamHealth.record_miss.
+
+        Queries with EDNS advertise the payload size of their upstream in the
+        first round, and the small one in later rounds. A truncated answer
+        to the small payload size after the large one got nothing hints at
+        fragmented answers being dropped, and lowers the payload size of the
+        upstream, see UpstreamHealth.edns_payload.
+        :return: a tuple of the answer and the upstream which sent it, or
+            (None, None).
+        """
+        if wire is None:
+            wire = dnsq.to_wire()
+        deadline = self.loop.time() + timeout
+        tasks = []
+        upstreams = []
+        payloads = []
+        # Upstreams whose RTO expired before any answer came.
+        expired = set()
+        winner = None
+        # The transmission sent when the hedge delay expired, see HEDGE.
+        hedge = None
+        hedge_due = False
+        timed_out = False
+        retransmissions = 0
+        attempts = self.UDP_TRANSMISSIONS * len(candidates)
+        DNSClient._udp_queries += 1
+        try:
+            for attempt in range(attempts):
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    timed_out = True
+                if winner is not None or timed_out:
+                    break
+                upstream = candidates[attempt % len(candidates)]
+                health = UpstreamHealth.get(upstream)
+                if not health.allow():
+                    # Its probes were taken by other queries since it was
+                    # ranked.
+                    continue
+                hedging = self.HEDGE and not tasks
+                if hedging:
+                    wait = health.hedge_delay(self.HEDGE_PERCENTILE)
+                else:
+                    wait = health.rto() * 2 ** (attempt // len(candidates))
+                if attempt < len(candidates):
+                    payload = health.edns_payload()
+                else:
+                    payload = health.EDNS_PAYLOAD_SMALL
+                send = True
+                if tasks:
+                    if DNSClient._retransmissions >= max(
+                        self.RETRANSMIT_BUDGET_MIN,
+                        self.RETRANSMIT_BUDGET * DNSClient._udp_queries,
+                    ):
+                        send = False
+                        self.COUNTERS["retransmits_over_budget"] += 1
+                    else:
+                        retransmissions += 1
+                        DNSClient._retransmissions += 1
+                        self.COUNTERS["retransmits"] += 1
+                        self.logger.debug(
+                            "[DNS] {} {} (RETRANSMIT {})".format(
+                                clientip, utils.dnsquery2log(dnsq), attempt
+                            )
+                        )
+                if send:
+                    task = asyncio.ensure_future(
+                        self.query_udp(
+                            dnsq,
+                            clientip,
+                            timeout=remaining,
+                            upstream=upstream,
+                            wire=dnswire.set_payload(wire, payload),
+                        )
+                    )
+                    tasks.append(task)
+                    upstreams.append(upstream)
+                    payloads.append(payload)
+                    if hedge_due:
+                        hedge = task
+                        self.COUNTERS["hedged"] += 1
+                winner = await self._first_answer(tasks, min(wait, remaining))
+                hedge_due = hedging and winner is None
+                if winner is None:
+                    if wait >= remaining:
+                        timed_out = True
+                    if send and not hedging:
+                        expired.add(upstream)
+        finally:
+            DNSClient._udp_queries -= 1
+            DNSClient._retransmissions -= retransmissions
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.record_udp_outcomes(tasks, upstreams, expired, timed_out)
+
+        if winner is None:
+            return None, None
+        if hedge is not None and winner is hedge:
+            self.COUNTERS["hedge_wins"] += 1
+        index = tasks.index(winner)
+        dnsr, upstream = winner.result(), upstreams[index]
+        if dnsr.flags & dns.flags.TC and any(
+            u == upstream and p > payloads[index]
+            for u, p in zip(upstreams[:index], payloads[:index])
+        ):
+            UpstreamHealth.get(upstream).record_payload_loss()
+        return dnsr, upstream
+
+    @staticmethod
+    def record_udp_outcomes(tasks, upstreams, expired, timed_out):
+        """Account once for each upstream which did not answer a query sent
+        by query_udp_retransmit, the answers being accounted by
+        UDPSocketPool.query.
+        :param tasks: the transmissions, all done.
+        :param upstreams: the upstream of each transmission.
+        :param expired: the upstreams whose RTO expired.
+        :param timed_out: whether the query got no answer by its deadline.
+        """
+        answered = set()
+        failed = set()
+        for task, upstream in zip(tasks, upstreams):
+            if task.cancelled():
+                continue
+            if task.result() is None:
+                # Its socket failed.
+                failed.add(upstream)
+            else:
+                answered.add(upstream)
+        for upstream in set(upstreams) - answered:
+            health = UpstreamHealth.get(upstream)
+            if timed_out or upstream in failed:
+                health.record_failure()
+            elif upstream in expired:
+                health.record_miss()
+
+    async def _first_answer(self, tasks, timeout):
+        """Wait up to timeout for one of the tasks to return an answer.
+        :return: the task which got an answer, or None.
+        """
+        end = self.loop.time() + timeout
+        pending = [task for task in tasks if not task.done()]
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=max(end - self.loop.time(), 0),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                return None
+            for task in done:
+                if task.result() is not None:
+                    return task
+        # Every transmission failed early, wait out the timer anyway.
+        await asyncio.sleep(max(end - self.loop.time(), 0))
+        return None
 
-        end_time = time.time()
-        return await self._try_query(
-            fut, qid, timeout - (end_time - start_time), transport
+    async def query_udp(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, upstream=None, wire=None
+    ):
+        upstream = upstream or self.upstreams[0]
+        pool = UDPSocketPool.get(
+            *upstream, self.UDP_POOL_SIZE, logger=self.logger,
         )
+        return await pool.query(dnsq, clientip, timeout, wire=wire)
 
-    async def _try_query(self, fut, qid, timeout, transport):
+    async def query_tcp(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, upstream=None, wire=None
+    ):
+        upstream = upstream or self.upstreams[0]
+        if not UpstreamHealth.get(upstream).allow():
+            return None
+        pool = TCPConnectionPool.get(
+            *upstream,
+            self.TCP_POOL_SIZE,
+            self.TCP_IDLE_TIMEOUT,
+            logger=self.logger,
+        )
+        return await pool.query(dnsq, clientip, timeout, wire=wire)
+
+    async def query_tls(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, upstream=None, wire=None
+    ):
+        upstream = upstream or self.upstreams[0]
+        if not UpstreamHealth.get(upstream).allow():
+            return None
+        pool = TLSConnectionPool.get(
+            *upstream,
+            self.TCP_POOL_SIZE,
+            self.TCP_IDLE_TIMEOUT,
+            logger=self.logger,
+        )
+        return await pool.query(dnsq, clientip, timeout, wire=wire)
+
+    async def query_https(
+        self, dnsq, clientip, timeout=DEFAULT_TIMEOUT, upstream=None, wire=None
+    ):
+        upstream = upstream or self.upstreams[0]
+        if not UpstreamHealth.get(upstream).allow():
+            return None
+        pool = HTTPSConnectionPool.get(
+            *upstream, self.TCP_POOL_SIZE, logger=self.logger
+        )
+        return await pool.query(
+            dnsq, clientip, timeout, wire=wire, path=self.https_upstreams[upstream]
+        )
+
+
+class UpstreamPool:
+    """Base class of the long-lived connections to one upstream resolver.
+
+    One pool per upstream and transport is shared by every DNSClient of the
+    process, see get().
+    """
+
+    # CA bundle the certificates of the upstreams queried over TLS or HTTPS
+    # are verified with, the system one when None.
+    CAFILE = None
+
+    def __init__(self, upstream_resolver, upstream_port, size, logger=None):
+        self.loop = asyncio.get_event_loop()
+        self.upstream_resolver = upstream_resolver
+        self.upstream_port = upstream_port
+        self.size = max(1, size)
+        if logger is None:
+            logger = utils.configure_logger(self.__class__.__name__, "DEBUG")
+        self.logger = logger
+        self.health = UpstreamHealth.get((upstream_resolver, upstream_port))
+        self.protocols = []
+        self._lock = asyncio.Lock()
+        self._opening = None
+
+    @classmethod
+    def get(cls, upstream_resolver, upstream_port, *args, logger=None):
+        """Return the pool for this upstream, creating it when needed.
+        Pools are bound to the event loop that created them.
+        """
+        key = (upstream_resolver, upstream_port)
+        pool = cls._pools.get(key)
+        if pool is None or pool.loop is not asyncio.get_event_loop():
+            pool = cls(upstream_resolver, upstream_port, *args, logger=logger)
+            cls._pools[key] = pool
+        return pool
+
+    def discard(self, protocol):
+        if protocol in self.protocols:
+            self.protocols.remove(protocol)
+
+    async def open_shared(self, timeout):
+        """Open a connection with add_connection(), or wait for the one
+        being opened, for up to timeout. No lock is held meanwhile, so that
+        callers never wait past their own timeout for a slow connection. The
+        connection itself is given DNSClient.DEFAULT_TIMEOUT to open, for
+        the callers with a longer timeout than the one which started it.
+        :return: what add_connection() returned.
+        """
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(
+                self.add_connection(max(timeout, DNSClient.DEFAULT_TIMEOUT))
+            )
+            self._opening.add_done_callback(self._opened)
+        # Shielded, so that the connection others wait for is not cancelled
+        # when the caller which started it times out.
+        return await asyncio.wait_for(asyncio.shield(self._opening), timeout)
+
+    def _opened(self, task):
+        self._opening = None
+        if not task.cancelled():
+            # Retrieved, as no caller may be left waiting for it.
+            task.exception()
+
+    async def add_connection(self, timeout):
+        """Open a connection within timeout and add it to the pool.
+        :return: the connection.
+        """
+        raise NotImplementedError
+
+    def make_ssl_context(self):
+        """Return an SSL context to connect to the upstream with, which
+        resumes earlier sessions.
+        """
+        ssl_context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+        if self.CAFILE is None:
+            ssl_context.load_default_certs()
+        else:
+            ssl_context.load_verify_locations(self.CAFILE)
+        return ssl_context
+
+    def close(self):
+        if self._opening is not None:
+            self._opening.cancel()
+        for protocol in list(self.protocols):
+            if protocol.transport is not None:
+                protocol.transport.close()
+        self.protocols = []
+
+
+class UDPSocketPool(UpstreamPool):
+    """A set of UDP sockets connected to one upstream resolver. Queries are
+    spread round-robin over the sockets.
+
+    A spoofed answer only has to guess the query ID once the source port is
+    known, so sockets are replaced by new ones, on new ephemeral ports,
+    after SOCKET_MAX_QUERIES queries or SOCKET_MAX_AGE seconds (RFC 5452).
+    Retired sockets are closed once their queries are answered.
+    """
+
+    _pools = {}
+    SOCKET_MAX_QUERIES = 100
+    SOCKET_MAX_AGE = 10.0
+
+    def __init__(self, upstream_resolver, upstream_port, size, logger=None):
+        super().__init__(upstream_resolver, upstream_port, size, logger=logger)
+        self._next = 0
+
+    async def get_protocol(self):
+        """Pick a socket round-robin, opening a new one while the pool is
+        below its size.
+        """
+        now = self.loop.time()
+        for protocol in list(self.protocols):
+            if (
+                protocol.queries >= self.SOCKET_MAX_QUERIES
+                or now - protocol.opened_at >= self.SOCKET_MAX_AGE
+            ):
+                self.protocols.remove(protocol)
+                protocol.retire()
+                DNSClient.COUNTERS["udp_socket_rotations"] += 1
+        if len(self.protocols) < self.size:
+            async with self._lock:
+                if len(self.protocols) < self.size:
+                    _, protocol = await self.loop.create_datagram_endpoint(
+                        lambda: DNSClientProtocolUDP(self, logger=self.logger),
+                        remote_addr=(self.upstream_resolver, self.upstream_port),
+                    )
+                    self.protocols.append(protocol)
+                    return protocol
+        self._next = (self._next + 1) % len(self.protocols)
+        return self.protocols[self._next]
+
+    async def query(
+        self, dnsq, clientip, timeout=DNSClient.DEFAULT_TIMEOUT, wire=None
+    ):
+        """Send a query and wait up to timeout for its answer. Only answers
+        are accounted in the health of the upstream: the caller knows how
+        long the upstream should have taken, see
+        DNSClient.query_udp_retransmit.
+        :return: the answer, or None.
+        """
+        protocol = await self.get_protocol()
+        fut = self.loop.create_future()
+        start_time = self.loop.time()
+        key = protocol.send(dnsq, fut, clientip, wire=wire)
         try:
-            await asyncio.wait_for(fut, timeout)
-            dnsr = fut.result()
-            dnsr.id = qid
+            dnsr = await asyncio.wait_for(fut, timeout)
         except asyncio.TimeoutError:
             self.logger.debug("Request timed out")
-            if transport:
-                transport.close()
             dnsr = None
+        except OSError:
+            # See DNSClientProtocolUDP.error_received.
+            dnsr = None
+        finally:
+            protocol.forget(key, fut)
+        if dnsr is not None:
+            self.health.record_success(self.loop.time() - start_time)
         return dnsr
 
 
+class TCPConnectionPool(UpstreamPool):
+    """Persistent TCP connections to one upstream resolver (RFC 7766).
+
+    Queries are pipelined on the least busy connection and answered out of
+    order. A new connection is only opened when all of them are busy and the
+    pool is below its size. Idle connections are closed after idle_timeout,
+    or earlier if the upstream asks so with edns-tcp-keepalive (RFC 7828).
+    """
+
+    _pools = {}
+
+    def __init__(
+        self, upstream_resolver, upstream_port, size, idle_timeout, logger=None
+    ):
+        super().__init__(upstream_resolver, upstream_port, size, logger=logger)
+        self.idle_timeout = idle_timeout
+
+    async def get_protocol(self, timeout):
+        protocols = [p for p in self.protocols if p.usable()]
+        if protocols:
+            protocol = min(protocols, key=lambda p: len(p.pending))
+            if not protocol.pending or len(self.protocols) >= self.size:
+                return protocol
+        return await self.open_shared(timeout)
+
+    async def add_connection(self, timeout):
+        _, protocol = await asyncio.wait_for(self.connect(), timeout)
+        self.protocols.append(protocol)
+        return protocol
+
+    def connect(self):
+        """Open a new connection to the upstream.
+        :return: a coroutine returning a (transport, protocol) tuple.
+        """
+        return self.loop.create_connection(
+            lambda: DNSClientProtocolTCP(self, logger=self.logger),
+            self.upstream_resolver,
+            self.upstream_port,
+        )
+
+    async def query(
+        self, dnsq, clientip, timeout=DNSClient.DEFAULT_TIMEOUT, wire=None
+    ):
+        start_time = self.loop.time()
+        dnsr = await self._query(dnsq, clientip, start_time + timeout, wire)
+        if dnsr is None:
+            self.health.record_failure()
+        else:
+            self.health.record_success(self.loop.time() - start_time)
+        return dnsr
+
+    async def _query(self, dnsq, clientip, deadline, wire=None):
+        # A query in flight on a connection closed by the upstream is sent
+        # again once on a new connection.
+        for _ in range(2):
+            try:
+                protocol = await self.get_protocol(deadline - self.loop.time())
+            except (asyncio.TimeoutError, OSError) as e:
+                self.logger.debug(
+                    "Error connecting to upstream resolver {}:{}: {}".format(
+                        self.upstream_resolver, self.upstream_port, repr(e)
+                    )
+                )
+                return None
+            fut = self.loop.create_future()
+            key = protocol.send(dnsq, fut, clientip, wire=wire)
+            try:
+                return await asyncio.wait_for(fut, deadline - self.loop.time())
+            except asyncio.TimeoutError:
+                self.logger.debug("Request timed out")
+                return None
+            except ConnectionError:
+                self.logger.debug("Connection to upstream lost, retrying")
+            finally:
+                protocol.forget(key, fut)
+        return None
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """An SSL context resuming `session` in the client connections it wraps,
+    as asyncio has no way to pass a session to a new connection.
+    """
+
+    session = None
+
+    def wrap_bio(
+        self, incoming, outgoing, server_side=False, server_hostname=None, session=None
+    ):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+
+class TLSConnectionPool(TCPConnectionPool):
+    """Persistent DNS over TLS connections to one upstream resolver
+    (RFC 7858), pipelined and closed when idle as TCPConnectionPool does.
+
+    New connections resume the TLS session of an earlier one, which saves a
+    full handshake.
+    """
+
+    _pools = {}
+
+    def __init__(
+        self, upstream_resolver, upstream_port, size, idle_timeout, logger=None
+    ):
+        super().__init__(
+            upstream_resolver, upstream_port, size, idle_timeout, logger=logger
+        )
+        self.ssl_context = self.make_ssl_context()
+
+    def connect(self):
+        return self.loop.create_connection(
+            lambda: DNSClientProtocolTLS(self, logger=self.logger),
+            self.upstream_resolver,
+            self.upstream_port,
+            ssl=self.ssl_context,
+            server_hostname=self.upstream_resolver,
+        )
+
+
+class HTTPSConnection:
+    """An HTTP/2 connection of an HTTPSConnectionPool, with the number of
+    streams it carried so far and has in flight.
+    """
+
+    def __init__(self, transport, client):
+        self.transport = transport
+        self.client = client
+        self.streams = 0
+        self.in_flight = 0
+        self.session_saved = False
+
+    def alive(self):
+        return not self.transport.is_closing()
+
+    def close(self):
+        if self.alive():
+            self.client.close_connection()
+
+
+class HTTPSConnectionPool(UpstreamPool):
+    """Persistent DNS over HTTPS connections to one upstream DOH server
+    (RFC 8484).
+
+    Queries are multiplexed as HTTP/2 streams on the least busy connection.
+    A new connection is only opened when all of them have
+    MAX_CONCURRENT_STREAMS queries in flight and the pool is below its size.
+
+    aioh2 keeps some state for every stream a connection ever carried, and
+    refuses new streams past 1000 of them: connections are retired after
+    MAX_STREAMS queries. Their replacement is opened in the background
+    REPLACEMENT_MARGIN queries earlier, so that no query waits for it.
+    """
+
+    _pools = {}
+    MAX_STREAMS = 900
+    MAX_CONCURRENT_STREAMS = 100
+    REPLACEMENT_MARGIN = 100
+
+    def __init__(self, upstream_resolver, upstream_port, size, logger=None):
+        super().__init__(upstream_resolver, upstream_port, size, logger=logger)
+        self.ssl_context = self.make_ssl_context()
+        self.ssl_context.set_alpn_protocols(["h2"])
+        self.authority = upstream_resolver
+        if ":" in upstream_resolver:
+            self.authority = "[{}]".format(upstream_resolver)
+        if upstream_port != 443:
+            self.authority += ":{}".format(upstream_port)
+        self._replacement = None
+
+    async def connect(self):
+        """Open a new connection to the upstream.
+        :return: an HTTPSConnection.
+        """
+        # Same as aioh2.open_connection, but keeping the transport.
+        transport, client = await self.loop.create_connection(
+            lambda: aioh2.H2Protocol(True),
+            self.upstream_resolver,
+            self.upstream_port,
+            ssl=self.ssl_context,
+            server_hostname=self.upstream_resolver,
+        )
+        ssl_object = transport.get_extra_info("ssl_object")
+        DNSClient.COUNTERS["tls_handshakes"] += 1
+        if ssl_object.session_reused:
+            DNSClient.COUNTERS["tls_resumptions"] += 1
+        if ssl_object.selected_alpn_protocol() != "h2":
+            client.close_connection()
+            raise ConnectionRefusedError("Upstream does not support HTTP/2")
+        return HTTPSConnection(transport, client)
+
+    async def get_connection(self, timeout):
+        self.protocols = [
+            c
+            for c in self.protocols
+            if c.alive() and (c.streams < self.MAX_STREAMS or c.in_flight)
+        ]
+        connections = [c for c in self.protocols if c.streams < self.MAX_STREAMS]
+        if connections:
+            connection = min(connections, key=lambda c: c.in_flight)
+            if (
+                connection.in_flight < self.MAX_CONCURRENT_STREAMS
+                or len(connections) >= self.size
+            ):
+                self.maybe_replace(connections)
+                return connection
+        return await self.open_shared(timeout)
+
+    async def add_connection(self, timeout):
+        connection = await asyncio.wait_for(self.connect(), timeout)
+        self.protocols.append(connection)
+        return connection
+
+    def maybe_replace(self, connections):
+        """Open a connection in the background when every connection is
+        about to be retired.
+        """
+        limit = self.MAX_STREAMS - self.REPLACEMENT_MARGIN
+        if self._replacement is not None or any(
+            c.streams < limit for c in connections
+        ):
+            return
+        self._replacement = asyncio.ensure_future(self._replace())
+
+    async def _replace(self):
+        try:
+            self.protocols.append(await self.connect())
+        except OSError as e:
+            self.logger.debug(
+                "Error connecting to upstream resolver {}:{}: {}".format(
+                    self.upstream_resolver, self.upstream_port, repr(e)
+                )
+            )
+        finally:
+            self._replacement = None
+
+    async def query(
+        self,
+        dnsq,
+        clientip,
+        timeout=DNSClient.DEFAULT_TIMEOUT,
+        wire=None,
+        path=constants.DOH_URI,
+    ):
+        """Send a query as a DOH GET request, with ID 0 as RFC 8484 section
+        4.1 suggests for HTTP caches.
+        :param path: the path of the DOH API of the upstream.
+        :return: the answer, or None.
+        """
+        if wire is None:
+            wire = dnsq.to_wire()
+        headers, _ = utils.build_doh_request(
+            self.authority, path, dnswire.set_id(wire, 0)
+        )
+        self.logger.info(
+            "[DNS] {} {} {} {}".format(
+                clientip, utils.msg2question(dnsq), 0, utils.msg2flags(dnsq)
+            )
+        )
+        start_time = self.loop.time()
+        try:
+            dnsr = await asyncio.wait_for(
+                self._query(headers, start_time + timeout), timeout
+            )
+        except asyncio.TimeoutError:
+            self.logger.debug("Request timed out")
+            dnsr = None
+        except (
+            OSError,
+            dns.exception.FormError,
+            h2.exceptions.ProtocolError,
+        ) as e:
+            self.logger.debug(
+                "Error querying upstream resolver {}:{}: {}".format(
+                    self.upstream_resolver, self.upstream_port, repr(e)
+                )
+            )
+            dnsr = None
+        if dnsr is not None and dnsr.question != dnswire.question_key(wire):
+            self.logger.debug("Discard mismatched answer")
+            dnsr = None
+        if dnsr is None:
+            self.health.record_failure()
+            return None
+        self.health.record_success(self.loop.time() - start_time)
+        if self.logger.isEnabledFor(logging.INFO):
+            interval = int((self.loop.time() - start_time) * 1000)
+            self.logger.info(
+                "[DNS] {} {} {}ms".format(
+                    clientip, utils.dnsans2log(dnsr.message()), interval
+                )
+            )
+        return dnsr
+
+    async def _query(self, headers, deadline):
+        connection = await self.get_connection(deadline - self.loop.time())
+        connection.streams += 1
+        connection.in_flight += 1
+        try:
+            client = connection.client
+            stream_id = await client.start_request(headers, end_stream=True)
+            response = dict(await client.recv_response(stream_id))
+            body = await client.read_stream(stream_id, -1)
+            if not connection.session_saved:
+                connection.session_saved = True
+                ssl_object = connection.transport.get_extra_info("ssl_object")
+                self.ssl_context.session = ssl_object.session
+        finally:
+            connection.in_flight -= 1
+            if connection.streams >= self.MAX_STREAMS and not connection.in_flight:
+                connection.close()
+        if response.get(":status") != "200":
+            self.logger.debug(
+                "Upstream answered with HTTP status {}".format(
+                    response.get(":status")
+                )
+            )
+            return None
+        return dnswire.WireMessage(body)
+
+
 class DNSClientProtocol(asyncio.Protocol):
-    def __init__(self, dnsq, fut, clientip, logger=None):
+    """Base class of the pooled upstream connections. Many queries are in
+    flight at once and answers are matched back on (query ID, question).
+    """
+
+    def __init__(self, pool, logger=None):
+        self.pool = pool
         self.transport = None
-        self.dnsq = dnsq
-        self.fut = fut
-        self.clientip = clientip
+        # (qid, question) -> (future, clientip, time_stamp)
+        self.pending = {}
         if logger is None:
-            logger = utils.configure_logger("DNSClientProtocol", "DEBUG")
+            logger = utils.configure_logger(self.__class__.__name__, "DEBUG")
         self.logger = logger
 
-    def connection_lost(self, exc):
-        pass
-
     def connection_made(self, transport):
-        raise NotImplementedError()
-
-    def data_received(self, data):
-        raise NotImplementedError()
-
-    def datagram_received(self, data, addr):
-        raise NotImplementedError()
+        self.transport = transport
 
-    def error_received(self, exc):
-        raise NotImplementedError()
+    def connection_lost(self, exc):
+        self.transport = None
+        self.pool.discard(self)
+        for fut, _, _ in self.pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionResetError("Upstream connection lost"))
+        self.pending.clear()
 
-    def eof_received(self):
+    def write(self, msg):
         raise NotImplementedError()
 
-    def send_helper(self, transport):
-        self.transport = transport
-        self.dnsq.id = dns.entropy.random_16()
+    def send(self, dnsq, fut, clientip, wire=None):
+        """Send a query with an ID that is not in flight on this connection.
+        :param dnsq: the query, as a dns.message.Message. It is not modified.
+        :param wire: the query to send in wire format, dnsq.to_wire() when
+            not given.
+        :return: the key the answer will be matched on.
+        """
+        if wire is None:
+            wire = dnsq.to_wire()
+        question = dnswire.question_key(wire)
+        while True:
+            qid = dns.entropy.random_16()
+            key = (qid,) + question
+            if key not in self.pending:
+                break
+        self.pending[key] = (fut, clientip, time.time())
         self.logger.info(
-            "[DNS] {} {}".format(self.clientip, utils.dnsquery2log(self.dnsq))
+            "[DNS] {} {} {} {}".format(
+                clientip, utils.msg2question(dnsq), qid, utils.msg2flags(dnsq)
+            )
         )
-        self.time_stamp = time.time()
+        self.write(dnswire.set_id(wire, qid))
+        return key
 
-    def receive_helper(self, dnsr):
-        interval = int((time.time() - self.time_stamp) * 1000)
-        log_message = "[DNS] {} {} {}ms".format(
-            self.clientip, utils.dnsans2log(dnsr), interval
-        )
+    def forget(self, key, fut):
+        entry = self.pending.get(key)
+        if entry is not None and entry[0] is fut:
+            del self.pending[key]
 
-        if not self.fut.cancelled():
+    def receive_helper(self, dnsr):
+        """Hand an answer to the query it belongs to.
+        :param dnsr: a dnswire.WireMessage. It is only parsed by dnspython to
+            be logged.
+        """
+        key = (dnsr.id,) + dnsr.question
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(
+                    "Discard unexpected answer {}".format(
+                        utils.dnsans2log(dnsr.message())
+                    )
+                )
+            return
+        fut, clientip, time_stamp = entry
+        if self.logger.isEnabledFor(logging.INFO):
+            interval = int((time.time() - time_stamp) * 1000)
+            log_message = "[DNS] {} {} {}ms".format(
+                clientip, utils.dnsans2log(dnsr.message()), interval
+            )
+            if fut.done():
+                log_message += "(CANCELLED)"
             self.logger.info(log_message)
-            self.fut.set_result(dnsr)
-        else:
-            self.logger.info(log_message + "(CANCELLED)")
+        if not fut.done():
+            fut.set_result(dnsr)
 
 
-class DNSClientProtocolUDP(DNSClientProtocol):
-    def connection_made(self, transport):
-        self.send_helper(transport)
-        self.transport.sendto(self.dnsq.to_wire())
+class DNSClientProtocolUDP(DNSClientProtocol, asyncio.DatagramProtocol):
+    def __init__(self, pool, logger=None):
+        super().__init__(pool, logger=logger)
+        # Queries sent so far and when the socket was opened, see
+        # UDPSocketPool.get_protocol.
+        self.queries = 0
+        self.opened_at = pool.loop.time()
+        self.retired = False
+
+    def write(self, msg):
+        self.queries += 1
+        self.transport.sendto(msg)
+
+    def forget(self, key, fut):
+        super().forget(key, fut)
+        self._close_if_drained()
+
+    def retire(self):
+        """Close the socket once its queries are answered or timed out."""
+        self.retired = True
+        self._close_if_drained()
+
+    def _close_if_drained(self):
+        if self.retired and not self.pending and self.transport is not None:
+            self.transport.close()
 
     def datagram_received(self, data, addr):
-        dnsr = dns.message.from_wire(data)
+        try:
+            dnsr = dnswire.WireMessage(data)
+        except Exception as e:
+            self.logger.debug("Discard malformed answer: {}".format(e))
+            return
         self.receive_helper(dnsr)
-        self.transport.close()
 
     def error_received(self, exc):
-        self.transport.close()
-        self.logger.exception("Error received: " + str(exc))
+        """An ICMP error came back on the socket, as when nothing listens
+        upstream: fail the queries in flight on it rather than have them wait
+        out their RTO. It may well come for every datagram, so it is only
+        counted and logged at debug level.
+        """
+        DNSClient.COUNTERS["udp_errors"] += 1
+        self.logger.debug("Error received: {}".format(exc))
+        for fut, _, _ in self.pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
 
 
 class DNSClientProtocolTCP(DNSClientProtocol):
-    def __init__(self, dnsq, fut, clientip, logger=None):
-        super().__init__(dnsq, fut, clientip, logger=logger)
+    def __init__(self, pool, logger=None):
+        super().__init__(pool, logger=logger)
         self.buffer = bytes()
+        self.idle_timeout = pool.idle_timeout
+        # Set once the upstream asked us to close the connection.
+        self.closing = False
+        self._idle_handle = None
 
     def connection_made(self, transport):
-        self.send_helper(transport)
-        msg = self.dnsq.to_wire()
-        tcpmsg = struct.pack("!H", len(msg)) + msg
-        self.transport.write(tcpmsg)
+        super().connection_made(transport)
+        self._arm_idle_timer()
+
+    def connection_lost(self, exc):
+        self._cancel_idle_timer()
+        super().connection_lost(exc)
+
+    def usable(self):
+        return self.transport is not None and not self.closing
+
+    def write(self, msg):
+        self._cancel_idle_timer()
+        self.transport.write(struct.pack("!H", len(msg)) + msg)
+
+    def send(self, dnsq, fut, clientip, wire=None):
+        if wire is None:
+            wire = dnsq.to_wire()
+        # Only queries using EDNS get the keepalive option.
+        opt = dnswire.find_opt(wire)
+        if opt is not None and constants.DNS_EDNS_TCP_KEEPALIVE not in (
+            dnswire.edns_option_codes(wire, opt)
+        ):
+            wire = (
+                dnswire.add_edns_option(wire, constants.DNS_EDNS_TCP_KEEPALIVE, b"")
+                or wire
+            )
+        return super().send(dnsq, fut, clientip, wire=wire)
+
+    def forget(self, key, fut):
+        super().forget(key, fut)
+        self._on_drained()
 
     def data_received(self, data):
-        self.buffer = utils.handle_dns_tcp_data(self.buffer + data, self.receive_helper)
+        self.buffer = utils.handle_dns_tcp_data(
+            self.buffer + data, self.receive_helper, parse=dnswire.WireMessage
+        )
+        self._on_drained()
+
+    def receive_helper(self, dnsr):
+        super().receive_helper(self.update_keepalive(dnsr))
+
+    def update_keepalive(self, dnsr):
+        """Apply and strip the hop-by-hop edns-tcp-keepalive option of an
+        answer. Its timeout is expressed in units of 100 milliseconds.
+        :return: the answer without the option.
+        """
+        data = dnsr.option(constants.DNS_EDNS_TCP_KEEPALIVE)
+        if data is not None and len(data) == 2:
+            timeout = struct.unpack("!H", data)[0] / 10
+            if timeout == 0:
+                self.closing = True
+            else:
+                self.idle_timeout = min(self.pool.idle_timeout, timeout)
+        return dnsr.without_option(constants.DNS_EDNS_TCP_KEEPALIVE)
 
     def eof_received(self):
         if len(self.buffer) > 0:
             self.logger.debug("Discard incomplete message")
+        self.closing = True
         self.transport.close()
+
+    def _on_drained(self):
+        if self.pending or self.transport is None:
+            return
+        if self.closing:
+            self.transport.close()
+        elif self._idle_handle is None:
+            self._arm_idle_timer()
+
+    def _arm_idle_timer(self):
+        self._cancel_idle_timer()
+        self._idle_handle = self.pool.loop.call_later(
+            self.idle_timeout, self._on_idle
+        )
+
+    def _cancel_idle_timer(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _on_idle(self):
+        self._idle_handle = None
+        if not self.pending and self.transport is not None:
+            self.logger.debug("Closing idle upstream connection")
+            self.closing = True
+            self.transport.close()
+
+
+class DNSClientProtocolTLS(DNSClientProtocolTCP):
+    """A DNS over TLS connection of a TLSConnectionPool. Its TLS session is
+    handed to the pool once it got an answer, for new connections to resume
+    it.
+    """
+
+    def __init__(self, pool, logger=None):
+        super().__init__(pool, logger=logger)
+        self.session_saved = False
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        DNSClient.COUNTERS["tls_handshakes"] += 1
+        if transport.get_extra_info("ssl_object").session_reused:
+            DNSClient.COUNTERS["tls_resumptions"] += 1
+
+    def receive_helper(self, dnsr):
+        if not self.session_saved:
+            # TLS 1.3 session tickets are sent after the handshake, but
+            # before any answer.
+            self.session_saved = True
+            ssl_object = self.transport.get_extra_info("ssl_object")
+            self.pool.ssl_context.session = ssl_object.session
+        super().receive_helper(dnsr)
@@ -36,7 +36,9 @@ def parse_args():
 def main():
     args = parse_args()
     logger = utils.configure_logger("doh-stub", args.level)
-    loop = asyncio.get_event_loop()
+    utils.set_event_loop_policy(args.event_loop, logger)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
     if "all" in args.listen_address:
         listen_addresses = utils.get_system_addresses()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import asyncio
+import collections
+import logging
+import random
+import time
+
+from dohproxy import constants
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamOverloaded(Exception):
+    """A query was shed: too many queries were already waiting for the
+    upstream resolvers, see UpstreamLimit.
+    """
+
+
+class UpstreamHealth:
+    """Smoothed round-trip time and error rate of an upstream resolver, and
+    its circuit breaker.
+
+    One instance per upstream is shared by every DNSClient of the process,
+    see get(). The smoothing follows RFC 6298.
+
+    The circuit of an upstream opens when BREAKER_ERROR_RATE of its queries
+    of the last BREAKER_WINDOW seconds failed, see record_failure(), and it
+    is then skipped for BREAKER_COOLDOWN seconds, see is_open(). The circuit
+    is then half-open: BREAKER_PROBES queries are let through, see allow(),
+    which close it if they all get an answer. It opens again at the first
+    failure. The smoothed error rate only ranks the upstreams.
+    """
+
+    RTT_ALPHA = 0.125
+    RTTVAR_BETA = 0.25
+    ERROR_ALPHA = 0.1
+    # Cost in seconds of a query which got no answer, weighted by the error
+    # rate when ranking upstreams.
+    FAILURE_PENALTY = 1.0
+    # Retransmission timeout bounds in seconds, and its value until the
+    # upstream was measured.
+    RTO_MIN = 0.1
+    RTO_MAX = 3.0
+    RTO_INITIAL = 1.0
+    # Number of recent RTT samples kept to compute percentiles.
+    RTT_SAMPLES = 128
+    # Bounds of the delay after which a query is hedged, in seconds. The
+    # upper bound is used until the upstream was measured.
+    HEDGE_MIN_DELAY = 0.01
+    HEDGE_MAX_DELAY = 0.5
+    # Probability of sending a query to another upstream than the best one,
+    # so that the others keep being measured.
+    EXPLORATION = 0.05
+    # Circuit breaker settings, disabled when BREAKER_ERROR_RATE is 0. The
+    # circuit does not open before BREAKER_MIN_FAILURES failures within
+    # BREAKER_WINDOW seconds.
+    BREAKER_ERROR_RATE = 0
+    BREAKER_MIN_FAILURES = 5
+    BREAKER_WINDOW = 10.0
+    BREAKER_COOLDOWN = 5.0
+    BREAKER_PROBES = 3
+
+    # EDNS UDP payload sizes advertised to the upstream: the large one, unless
+    # answers to it were lost, as happens to fragmented datagrams on some
+    # paths, in which case the small one is used for EDNS_PAYLOAD_BACKOFF
+    # seconds.
+    EDNS_PAYLOAD_LARGE = 4096
+    EDNS_PAYLOAD_SMALL = constants.DNS_EDNS_PAYLOAD
+    EDNS_PAYLOAD_BACKOFF = 600.0
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    _registry = {}
+
+    def __init__(self, upstream):
+        """
+        :param upstream: an (address, port) tuple.
+        """
+        self.upstream = upstream
+        self.srtt = None
+        self.rttvar = None
+        self.samples = collections.deque(maxlen=self.RTT_SAMPLES)
+        self.error_rate = 0.0
+        self.queries = 0
+        self.errors = 0
+        self.state = self.CLOSED
+        # [second, queries, failures] of the last BREAKER_WINDOW seconds,
+        # oldest first.
+        self.window = collections.deque()
+        # When the circuit last opened, or when the current probes started.
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_successes = 0
+        self.trips = 0
+        self.small_payload_until = 0.0
+        self.payload_losses = 0
+
+    @classmethod
+    def get(cls, upstream):
+        health = cls._registry.get(upstream)
+        if health is None:
+            health = cls(upstream)
+            cls._registry[upstream] = health
+        return health
+
+    @classmethod
+    def rank(cls, upstreams):
+        """Order upstreams from the best to the worst candidate, sometimes
+        promoting another one first.
+        :param upstreams: a list of (address, port) tuples.
+        :return: a new list of (address, port) tuples.
+        """
+        ranked = sorted(upstreams, key=lambda u: cls.get(u).score())
+        if len(ranked) > 1 and random.random() < cls.EXPLORATION:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    @classmethod
+    def report(cls):
+        """Return the stats of every upstream, keyed on address:port."""
+        return {
+            "{}:{}".format(*upstream): health.stats()
+            for upstream, health in cls._registry.items()
+        }
+
+    def record_success(self, rtt):
+        """Account for an answer received after rtt seconds."""
+        self.queries += 1
+        self.samples.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.RTTVAR_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.RTT_ALPHA * (rtt - self.srtt)
+        self.error_rate -= self.ERROR_ALPHA * self.error_rate
+        self._count(failed=False)
+        if self.state == self.HALF_OPEN:
+            self.probe_successes += 1
+            if self.probe_successes >= self.BREAKER_PROBES:
+                self.error_rate = 0.0
+                self.window.clear()
+                self._set_state(self.CLOSED)
+
+    def record_miss(self):
+        """Account for a query the upstream did not answer within its
+        retransmission timeouts, while the query went on elsewhere. It lowers
+        the rank of the upstream as a failure does, but leaves its circuit
+        alone: a slow upstream is not a dead one.
+        """
+        self.queries += 1
+        self.errors += 1
+        self.error_rate += self.ERROR_ALPHA * (1 - self.error_rate)
+
+    def record_failure(self):
+        """Account for a query which got no answer by its deadline, or whose
+        connection failed.
+        """
+        self.queries += 1
+        self.errors += 1
+        self.error_rate += self.ERROR_ALPHA * (1 - self.error_rate)
+        queries, failures = self._count(failed=True)
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED
+            and self.BREAKER_ERROR_RATE
+            and failures >= self.BREAKER_MIN_FAILURES
+            and failures >= self.BREAKER_ERROR_RATE * queries
+        ):
+            self.trips += 1
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def _count(self, failed):
+        """Count a query in the window of the circuit breaker.
+        :return: the number of queries and of failures in the window.
+        """
+        now = time.monotonic()
+        second = int(now)
+        if not self.window or self.window[-1][0] != second:
+            self.window.append([second, 0, 0])
+        self.window[-1][1] += 1
+        self.window[-1][2] += failed
+        while self.window[0][0] + 1 <= now - self.BREAKER_WINDOW:
+            self.window.popleft()
+        return (
+            sum(bucket[1] for bucket in self.window),
+            sum(bucket[2] for bucket in self.window),
+        )
+
+    def is_open(self):
+        """Tell whether the circuit turns queries away, without counting a
+        probe, unlike allow().
+        """
+        if self.state == self.CLOSED:
+            return False
+        if time.monotonic() - self.opened_at >= self.BREAKER_COOLDOWN:
+            return False
+        return self.state == self.OPEN or self.probes >= self.BREAKER_PROBES
+
+    def wants_probe(self):
+        """Tell whether the circuit is half-open, or about to be, and lets
+        probes through.
+        """
+        return self.state != self.CLOSED and not self.is_open()
+
+    def allow(self):
+        """Tell whether a query may be sent to the upstream, counting it as
+        a probe when the circuit is half-open. To be called when the query
+        is sent.
+        """
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.BREAKER_COOLDOWN:
+            # Also lets new probes through when the earlier ones got neither
+            # an answer nor a failure, as when they were hedged.
+            self.opened_at = now
+            self.probes = 0
+            self.probe_successes = 0
+            if self.state == self.OPEN:
+                self._set_state(self.HALF_OPEN)
+        elif self.state == self.OPEN:
+            return False
+        if self.probes >= self.BREAKER_PROBES:
+            return False
+        self.probes += 1
+        return True
+
+    def edns_payload(self):
+        """Return the EDNS UDP payload size to advertise to the upstream."""
+        if time.monotonic() < self.small_payload_until:
+            return self.EDNS_PAYLOAD_SMALL
+        return self.EDNS_PAYLOAD_LARGE
+
+    def record_payload_loss(self):
+        """Account for a query which only got an answer once it advertised
+        the small EDNS payload size.
+        """
+        if time.monotonic() >= self.small_payload_until:
+            logger.info(
+                "Upstream {}:{} EDNS payload size lowered to {}".format(
+                    *self.upstream, self.EDNS_PAYLOAD_SMALL
+                )
+            )
+        self.payload_losses += 1
+        self.small_payload_until = time.monotonic() + self.EDNS_PAYLOAD_BACKOFF
+
+    def _set_state(self, state):
+        log = logger.warning if state == self.OPEN else logger.info
+        log(
+            "Upstream {}:{} circuit {} ({} of {} queries failed in {:g}s)".format(
+                *self.upstream,
+                state,
+                sum(bucket[2] for bucket in self.window),
+                sum(bucket[1] for bucket in self.window),
+                self.BREAKER_WINDOW,
+            )
+        )
+        self.state = state
+
+    def rtt_percentile(self, percentile):
+        """Return a percentile of the recent RTTs, or None if there are
+        none.
+        :param percentile: a number between 0 and 100.
+        """
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * percentile / 100), len(samples) - 1)]
+
+    def hedge_delay(self, percentile):
+        """Return how long to wait for an answer before hedging a query."""
+        rtt = self.rtt_percentile(percentile)
+        if rtt is None:
+            return self.HEDGE_MAX_DELAY
+        return min(max(rtt, self.HEDGE_MIN_DELAY), self.HEDGE_MAX_DELAY)
+
+    def rto(self):
+        """Return the retransmission timeout of the upstream (RFC 6298)."""
+        if self.srtt is None:
+            rto = self.RTO_INITIAL
+        else:
+            rto = self.srtt + 4 * self.rttvar
+        return min(max(rto, self.RTO_MIN), self.RTO_MAX)
+
+    def score(self):
+        """Smoothed RTT plus a penalty for the failures, lower is better.
+        Upstreams never queried score 0 so they get tried.
+        """
+        return (self.srtt or 0.0) + self.error_rate * self.FAILURE_PENALTY
+
+    def stats(self):
+        return {
+            "srtt_ms": None if self.srtt is None else int(self.srtt * 1000),
+            "error_rate": round(self.error_rate, 3),
+            "queries": self.queries,
+            "errors": self.errors,
+            "circuit": self.state,
+            "circuit_trips": self.trips,
+            "edns_payload": self.edns_payload(),
+            "edns_payload_losses": self.payload_losses,
+        }
+
+
+class UpstreamLimit:
+    """Bound on the queries in flight to the upstream resolvers of a
+    DNSClient, with a bounded queue of queries waiting for a slot.
+
+    One instance per set of upstreams is shared by every DNSClient of the
+    process, see get(). Queries are admitted in order, and shed with
+    UpstreamOverloaded when the queue is full or they waited too long.
+    """
+
+    # Maximum number of queries in flight, unlimited when 0, and of queries
+    # waiting for one of them to finish.
+    MAX_OUTSTANDING = 0
+    MAX_QUEUED = 1000
+
+    _registry = {}
+
+    def __init__(self, upstreams):
+        """
+        :param upstreams: a tuple of (address, port) tuples.
+        """
+        self.upstreams = upstreams
+        self.outstanding = 0
+        self.waiters = collections.deque()
+        self.shed = 0
+
+    @classmethod
+    def get(cls, upstreams):
+        limit = cls._registry.get(upstreams)
+        if limit is None:
+            limit = cls(upstreams)
+            cls._registry[upstreams] = limit
+        return limit
+
+    @classmethod
+    def report(cls):
+        """Return the stats of every set of upstreams, keyed on their
+        comma-separated address:port.
+        """
+        return {
+            ",".join("{}:{}".format(*upstream) for upstream in upstreams): (
+                limit.stats()
+            )
+            for upstreams, limit in cls._registry.items()
+        }
+
+    async def acquire(self, timeout):
+        """Wait up to timeout for a slot, to be handed back with release().
+        :raise UpstreamOverloaded: when the query is shed.
+        """
+        if not self.MAX_OUTSTANDING or (
+            self.outstanding < self.MAX_OUTSTANDING and not self.waiters
+        ):
+            self.outstanding += 1
+            return
+        if len(self.waiters) >= self.MAX_QUEUED:
+            self.shed += 1
+            raise UpstreamOverloaded()
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the wait timed out.
+            if not fut.done() or fut.cancelled():
+                self.shed += 1
+                raise UpstreamOverloaded()
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        finally:
+            if fut in self.waiters:
+                self.waiters.remove(fut)
+
+    def release(self):
+        """Hand a slot over to the first waiting query, or free it."""
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.outstanding -= 1
+
+    def stats(self):
+        return {
+            "outstanding": self.outstanding,
+            "queued": len(self.waiters),
+            "shed": self.shed,
+        }
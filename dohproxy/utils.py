@@ -21,12 +21,18 @@ import dns.edns
 import dns.exception
 import dns.message
 import dns.rcode
+import dns.rdatatype
 
 try:
     import netifaces
 except ImportError as e:
     # Optional module
     netifaces = e
+try:
+    import uvloop
+except ImportError as e:
+    # Optional module
+    uvloop = e
 from typing import Dict, List, Optional, Tuple
 
 from dohproxy import __version__, constants, server_protocol
@@ -55,6 +61,17 @@ def msg2question(msg: dns.message.Message) -> str:
     return question
 
 
+def dns_question_key(msg: dns.message.Message) -> Tuple:
+    """ Helper function to return a hashable key for the question of a
+    message: the lowercased name, type and class. Returns an empty tuple when
+    the message has no question.
+    """
+    if not len(msg.question):
+        return ()
+    q = msg.question[0]
+    return (q.name.to_text().lower(), q.rdtype, q.rdclass)
+
+
 def msg2flags(msg: dns.message.Message) -> str:
     """ Helper function to return flags in a message
     """
@@ -96,6 +113,60 @@ def dnsans2log(msg: dns.message.Message) -> str:
     )
 
 
+def parse_upstream(upstream: str, default_port: int) -> Tuple[str, int]:
+    """ Split an upstream resolver into its address and port. IPv6 addresses
+    must be enclosed in brackets to be followed by a port, as in [::1]:53.
+    :param upstream: the upstream, e.g. 10.0.0.1, 10.0.0.1:53 or ::1.
+    :param default_port: the port to use when upstream has none.
+    :return: a tuple of the address and the port.
+    """
+    if upstream.startswith("["):
+        address, _, port = upstream[1:].partition("]")
+        port = port[1:]
+    elif upstream.count(":") == 1:
+        address, _, port = upstream.partition(":")
+    else:
+        address, port = upstream, ""
+    return address, int(port or default_port)
+
+
+def parse_upstream_url(
+    upstream: str, default_port: int
+) -> Tuple[str, str, int, Optional[str]]:
+    """ Split an upstream resolver into its transport, address, port and
+    path. The transport is given as a URL scheme: tls:// for DNS over TLS
+    (RFC 7858), on port 853 by default, and https:// for DNS over HTTPS
+    (RFC 8484), with the path of the DoH API, /dns-query by default.
+    Upstreams without one are queried over UDP with a fallback to TCP.
+    :param upstream: the upstream, e.g. 10.0.0.1:53, tls://[::1]:853 or
+        https://dns.example.com/dns-query.
+    :param default_port: the port to use when a plain DNS upstream has none.
+    :return: a tuple of the transport ("udp", "tls" or "https"), address,
+        port and path, which is None but for https.
+    """
+    scheme, sep, rest = upstream.partition("://")
+    if not sep:
+        return ("udp",) + parse_upstream(upstream, default_port) + (None,)
+    if scheme == "tls":
+        return (scheme,) + parse_upstream(rest, constants.DNS_OVER_TLS_PORT) + (None,)
+    if scheme == "https":
+        url = urllib.parse.urlsplit(upstream)
+        if not url.hostname:
+            raise ValueError("Missing host in upstream: {}".format(upstream))
+        return scheme, url.hostname, url.port or 443, url.path or constants.DOH_URI
+    raise ValueError("Unsupported upstream transport: {}".format(scheme))
+
+
+def upstream_resolver(upstream: str) -> str:
+    """ argparse type of the upstream resolvers, checking their transport.
+    """
+    try:
+        parse_upstream_url(upstream, 53)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return upstream
+
+
 def extract_path_params(url: str) -> Tuple[str, Dict[str, List[str]]]:
     """ Given a URI, extract the path and the parameters
     """
@@ -212,6 +283,31 @@ def build_query_params(dns_query):
     }
 
 
+def build_doh_request(authority, uri, dns_query, post=False):
+    """Build a DOH request (RFC 8484) for a wire-format DNS query.
+    :param authority: the host, and port if not 443, of the DOH server.
+    :param uri: the path of the DOH API.
+    :param post: use HTTP POST instead of GET.
+    :return: a tuple of the HTTP/2 request headers and body.
+    """
+    body = b""
+    headers = [
+        (":authority", authority),
+        (":method", "POST" if post else "GET"),
+        (":scheme", "https"),
+        ("Accept", constants.DOH_MEDIA_TYPE),
+    ]
+    if post:
+        headers.append(("content-type", constants.DOH_MEDIA_TYPE))
+        body = dns_query
+        path = uri
+    else:
+        path = uri + "?" + urllib.parse.urlencode(build_query_params(dns_query))
+    headers.insert(0, (":path", path))
+    headers.append(("content-length", str(len(body))))
+    return headers, body
+
+
 def make_url(domain, uri):
     """Utility function to return a URL ready to use from a browser or cURL....
     """
@@ -221,6 +317,25 @@ def make_url(domain, uri):
     return urllib.parse.urlunparse(p)
 
 
+EVENT_LOOPS = ("asyncio", "uvloop")
+
+
+def set_event_loop_policy(name, logger=None):
+    """Install the event loop policy of name, before any loop is created.
+    :param name: one of EVENT_LOOPS.
+    :return: the name of the installed policy, "asyncio" when uvloop is asked
+        for but not installed.
+    """
+    if name == "uvloop":
+        if not isinstance(uvloop, ImportError):
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+        if logger is not None:
+            logger.warning("uvloop is not installed, using asyncio: {}".format(uvloop))
+    asyncio.set_event_loop_policy(None)
+    return "asyncio"
+
+
 def client_parser_base():
     """Build a ArgumentParser object with all the default arguments that are
     useful to both client and stub.
@@ -252,6 +367,13 @@ def client_parser_base():
     parser.add_argument(
         "--level", default="DEBUG", help="log level [%(default)s]",
     )
+    parser.add_argument(
+        "--event-loop",
+        default="asyncio",
+        choices=EVENT_LOOPS,
+        help="Event loop to run on. uvloop falls back to asyncio when it is "
+        "not installed. Default: [%(default)s]",
+    )
     parser.add_argument(
         "--cafile", default=None, help="Specify custom CA file for cert verification"
     )
@@ -281,13 +403,47 @@ def proxy_parser_base(*, port: int, secure: bool = True) -> argparse.ArgumentPar
         type=int,
         help="Port to listen on. Default: [%(default)s]",
     )
+    parser.add_argument(
+        "--event-loop",
+        default="asyncio",
+        choices=EVENT_LOOPS,
+        help="Event loop to run on. uvloop falls back to asyncio when it is "
+        "not installed. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of worker processes, sharing the listening addresses "
+        "with SO_REUSEPORT. Crashed workers are restarted. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--worker-cpu-affinity",
+        action="store_true",
+        help="Pin each worker process to a CPU.",
+    )
     parser.add_argument("--certfile", help="SSL cert file.", required=secure)
     parser.add_argument("--keyfile", help="SSL key file.", required=secure)
     parser.add_argument(
         "--upstream-resolver",
-        default="::1",
-        help="Upstream recursive resolver to send the query to. "
-        "Default: [%(default)s]",
+        default=["::1"],
+        nargs="+",
+        type=upstream_resolver,
+        help="A list of upstream recursive resolvers to send the query to. "
+        "Each query goes to the fastest one and fails over to the others. "
+        "A port may be given as in 10.0.0.1:53 or [::1]:53. Resolvers given "
+        "as tls://10.0.0.1 are queried over TLS (RFC 7858), on port 853 by "
+        "default, and those given as https://dns.example.com/dns-query over "
+        "HTTPS (RFC 8484). Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--forward-zones",
+        default=None,
+        help="A file of domain suffixes whose queries go to other upstream "
+        "resolvers than --upstream-resolver, one per line: the suffix followed "
+        "by its upstream resolvers, as in: corp.example 10.0.0.53. The file "
+        "is reloaded on SIGHUP.",
     )
     parser.add_argument(
         "--upstream-port",
@@ -295,9 +451,242 @@ def proxy_parser_base(*, port: int, secure: bool = True) -> argparse.ArgumentPar
         help="Upstream recursive resolver port to send the query to. "
         "Default: [%(default)s]",
     )
+    parser.add_argument(
+        "--upstream-udp-sockets",
+        default=4,
+        type=int,
+        help="Number of UDP sockets shared by all queries to an upstream "
+        "resolver. Each socket has its own source port, and is replaced by a "
+        "new one after --upstream-udp-socket-queries queries: more sockets, "
+        "or fewer queries per socket, make spoofed answers harder to get "
+        "accepted at the cost of more sockets opened. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-udp-socket-queries",
+        default=100,
+        type=int,
+        help="Number of queries after which an upstream UDP socket is "
+        "replaced by one on a new source port. Sockets are also replaced "
+        "after {:g} seconds. Default: [%(default)s]".format(
+            server_protocol.UDPSocketPool.SOCKET_MAX_AGE
+        ),
+    )
+    parser.add_argument(
+        "--upstream-tcp-connections",
+        default=2,
+        type=int,
+        help="Maximum number of persistent TCP, TLS or HTTPS connections to an "
+        "upstream resolver. Queries are pipelined on them. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-tcp-idle-timeout",
+        default=10,
+        type=float,
+        help="Seconds after which an idle upstream TCP or TLS connection is "
+        "closed. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-tls-cafile",
+        help="CA bundle to verify the certificates of the upstream resolvers "
+        "queried over TLS or HTTPS with. Default: the system CA bundle.",
+    )
+    parser.add_argument(
+        "--upstream-timeout",
+        default=server_protocol.DNSClient.DEFAULT_TIMEOUT,
+        type=float,
+        help="Seconds to get an answer from the upstream resolvers, "
+        "retransmissions and TCP fallback included, before answering "
+        "SERVFAIL. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-rto-min",
+        default=0.1,
+        type=float,
+        help="Lower bound in seconds of the timeout after which a UDP query is "
+        "retransmitted. It is computed from the measured upstream round-trip "
+        "times. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-rto-max",
+        default=3.0,
+        type=float,
+        help="Upper bound in seconds of the timeout after which a UDP query is "
+        "retransmitted. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-retransmit-budget",
+        default=0.2,
+        type=float,
+        help="Maximum number of UDP retransmissions in flight, as a fraction "
+        "of the UDP queries in flight, so that retransmissions do not pile "
+        "onto an overloaded upstream resolver. {} are always allowed. "
+        "Default: [%(default)s]".format(
+            server_protocol.DNSClient.RETRANSMIT_BUDGET_MIN
+        ),
+    )
+    parser.add_argument(
+        "--upstream-edns-payload",
+        default=4096,
+        type=int,
+        help="EDNS UDP payload size advertised to the upstream resolvers. It "
+        "is lowered to {} for a while on upstreams whose large answers get "
+        "lost. Default: [%(default)s]".format(constants.DNS_EDNS_PAYLOAD),
+    )
+    parser.add_argument(
+        "--truncated-memory-size",
+        default=10000,
+        type=int,
+        help="Number of questions whose answer came back truncated over UDP "
+        "which are remembered, to query them straight over TCP. 0 to disable. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--truncated-memory-ttl",
+        default=600,
+        type=float,
+        help="Seconds a question whose answer came back truncated is queried "
+        "straight over TCP. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--circuit-breaker-error-rate",
+        default=0,
+        type=float,
+        help="Share, between 0 and 1, of the queries of the last {:g} seconds "
+        "which got no answer by their deadline, from which an upstream "
+        "resolver is skipped for --circuit-breaker-cooldown. It takes at "
+        "least {} such queries. 0 to never skip upstreams. "
+        "Default: [%(default)s]".format(
+            server_protocol.UpstreamHealth.BREAKER_WINDOW,
+            server_protocol.UpstreamHealth.BREAKER_MIN_FAILURES,
+        ),
+    )
+    parser.add_argument(
+        "--circuit-breaker-cooldown",
+        default=5.0,
+        type=float,
+        help="Seconds an upstream resolver is skipped for, before "
+        "--circuit-breaker-probes queries are sent to check whether it "
+        "recovered. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--circuit-breaker-probes",
+        default=3,
+        type=int,
+        help="Number of queries which must get an answer from a skipped "
+        "upstream resolver for it to be used again. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-max-outstanding",
+        default=0,
+        type=int,
+        help="Maximum number of queries in flight to the upstream resolvers. "
+        "Further queries wait in a queue, see --upstream-max-queued. 0 for no "
+        "limit. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--upstream-max-queued",
+        default=1000,
+        type=int,
+        help="Maximum number of queries waiting for the upstream resolvers "
+        "when --upstream-max-outstanding are in flight. Further queries are "
+        "shed, see --shed-rcode. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--shed-rcode",
+        default="SERVFAIL",
+        choices=["SERVFAIL", "REFUSED"],
+        help="Response code of the answers to shed queries. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--shed-retry-after",
+        default=None,
+        type=int,
+        help="Answer shed queries with HTTP 503 and this Retry-After, in "
+        "seconds, rather than with --shed-rcode.",
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Send a second copy of a query to another upstream resolver when "
+        "the first one is slower than usual, see --hedge-percentile.",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        default=95,
+        type=float,
+        help="Percentile of the recent round-trip times of an upstream after "
+        "which its queries are hedged. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=0,
+        type=int,
+        help="Maximum memory used by the answers kept in the in-process DNS "
+        "cache, in bytes. 0 disables the cache. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--cache-ecs-subnets",
+        default=32,
+        type=int,
+        help="Maximum number of client subnets an answer is cached for, per "
+        "question, when it depends on EDNS Client Subnet. "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--negative-ttl-max",
+        default=3600,
+        type=int,
+        help="Maximum time, in seconds, NXDOMAIN and NODATA answers are "
+        "cached for, in the DNS cache and by HTTP caches (RFC 2308). "
+        "Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--serve-stale",
+        default=0,
+        type=float,
+        help="How long, in seconds, expired answers are kept in cache to be "
+        "served when the upstreams do not answer in time (RFC 8767). Needs "
+        "--cache-size. 0 disables it. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--stale-answer-timeout",
+        default=1.8,
+        type=float,
+        help="How long, in seconds, to wait for the upstreams before serving "
+        "a stale answer. The query goes on in the background to refresh "
+        "the cache. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Refresh popular cache entries in the background shortly before "
+        "they expire. Needs --cache-size.",
+    )
+    parser.add_argument(
+        "--prefetch-min-hits",
+        default=3,
+        type=int,
+        help="Number of cache hits after which an entry is refreshed before "
+        "it expires. Default: [%(default)s]",
+    )
+    parser.add_argument(
+        "--prefetch-concurrency",
+        default=4,
+        type=int,
+        help="Maximum number of cache entries refreshed at once. "
+        "Default: [%(default)s]",
+    )
     parser.add_argument(
         "--uri", default=constants.DOH_URI, help="DNS API URI. Default [%(default)s]",
     )
+    parser.add_argument(
+        "--stats-uri",
+        default=None,
+        help="If set, URI serving the proxy counters as JSON. "
+        "Default [%(default)s]",
+    )
     parser.add_argument(
         "--level", default="DEBUG", help="log level [%(default)s]",
     )
@@ -351,19 +740,21 @@ def get_system_addresses():
     return list(addresses)
 
 
-def handle_dns_tcp_data(data, cb):
+def handle_dns_tcp_data(data, cb, parse=dns.message.from_wire):
     """Handle TCP data_received DNS data.
     When enough data is received to assemble a DNS message, a
     callback is called and the remaining data (if any) is returned.
     :param data: Incoming bytes data.
     :param cb: Callback to call when a full TCP DNS message is received.
+    :param parse: Function building the message passed to cb from its wire
+        format.
     :return: Any remaining bytes not fed to the callback.
     """
     if len(data) < 2:
         return data
     msglen = struct.unpack("!H", data[0:2])[0]
     while msglen + 2 <= len(data):
-        dnsq = dns.message.from_wire(data[2 : msglen + 2])
+        dnsq = parse(data[2 : msglen + 2])
         cb(dnsq)
         data = data[msglen + 2 :]
         if len(data) < 2:
@@ -372,6 +763,18 @@ def handle_dns_tcp_data(data, cb):
     return data
 
 
+def dns_ecs_subnet(ip):
+    """Return the subnet of a client sent upstream in EDNS Client Subnet: its
+    /24 for IPv4, or its /56 for IPv6.
+    :param ip: IP address. String or ipaddress object.
+    :return: an ipaddress.IPv4Network or ipaddress.IPv6Network.
+    """
+    if not isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        ip = ipaddress.ip_address(ip)
+    ip_supernet_bits = 56 if ip.version == 6 else 24
+    return ipaddress.ip_network(ip).supernet(new_prefix=ip_supernet_bits)
+
+
 def set_dns_ecs(dnsq, ip):
     """Sets RFC 7871 EDNS Client Subnet (ECS) option in a DNS packet.
     An existing ECS option will not be overwritten if present.
@@ -385,14 +788,11 @@ def set_dns_ecs(dnsq, ip):
             return False
         options.append(option)
 
-    if not isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
-        ip = ipaddress.ip_address(ip)
-    ip_supernet_bits = 56 if ip.version == 6 else 24
-    ip_supernet = ipaddress.ip_network(ip).supernet(new_prefix=ip_supernet_bits,)
-
+    ip_supernet = dns_ecs_subnet(ip)
     options.append(
         dns.edns.ECSOption(
-            address=ip_supernet.network_address.compressed, srclen=ip_supernet_bits,
+            address=ip_supernet.network_address.compressed,
+            srclen=ip_supernet.prefixlen,
         )
     )
     dnsq.use_edns(edns=0, ednsflags=dnsq.ednsflags, options=options)
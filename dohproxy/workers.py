@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Run a proxy in several worker processes, which all bind the listening
+addresses with SO_REUSEPORT so that the kernel spreads connections over them.
+
+Workers publish their stats in a directory shared with the other workers,
+so that the stats served by any of them cover the whole instance, see
+instance_stats().
+"""
+import asyncio
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+# Seconds between two publications of the stats of a worker.
+STATS_INTERVAL = 1.0
+
+# Directory of the stats of the workers and ID of this worker, set in the
+# worker processes only.
+_stats_dir = None
+_worker_id = None
+
+
+def _stats_path(stats_dir, worker_id):
+    return os.path.join(stats_dir, "worker-{}.json".format(worker_id))
+
+
+def _sum_stats(all_stats):
+    """Add up the numbers of several stats dicts, recursively. Other values,
+    like circuit states, only make sense per worker and are left out.
+    """
+    total = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                total[key] = _sum_stats([total.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def instance_stats(stats):
+    """Return the stats of the whole instance.
+    :param stats: the stats of this process, as returned by DNSClient.stats.
+    :return: stats when not running workers, else a dict with the "total"
+        of the workers and the stats of each of them under "workers".
+    """
+    if _stats_dir is None:
+        return stats
+    workers = {str(_worker_id): stats}
+    for name in os.listdir(_stats_dir):
+        if not name.endswith(".json"):
+            continue
+        worker_id = name[len("worker-") : -len(".json")]
+        if worker_id in workers:
+            continue
+        try:
+            with open(os.path.join(_stats_dir, name)) as f:
+                workers[worker_id] = json.load(f)
+        except (OSError, ValueError):
+            # The worker is gone, or being restarted.
+            continue
+    return {"total": _sum_stats(workers.values()), "workers": workers}
+
+
+async def publish_stats(stats_fn):
+    """Write the stats of this worker for the others to read, every
+    STATS_INTERVAL seconds.
+    :param stats_fn: a callable returning the stats of this worker.
+    """
+    path = _stats_path(_stats_dir, _worker_id)
+    while True:
+        with open(path + ".tmp", "w") as f:
+            json.dump(stats_fn(), f)
+        os.replace(path + ".tmp", path)
+        await asyncio.sleep(STATS_INTERVAL)
+
+
+class Supervisor:
+    """Start worker processes, restart those which exit, forward SIGHUP to
+    them, and stop them on SIGTERM or SIGINT.
+    """
+
+    # Minimum seconds between two starts of a worker, so that one failing
+    # at startup does not spin.
+    RESTART_DELAY = 1.0
+    # Seconds given to the workers to stop before they are killed.
+    SHUTDOWN_TIMEOUT = 10.0
+
+    def __init__(self, workers, target, logger, cpu_affinity=False):
+        """
+        :param workers: the number of worker processes.
+        :param target: the callable serving in a worker process. It should
+            return once the worker gets SIGTERM. SIGHUP is ignored unless it
+            handles it.
+        :param cpu_affinity: pin each worker to a CPU, round-robin.
+        """
+        self.workers = workers
+        self.target = target
+        self.logger = logger
+        self.cpu_affinity = cpu_affinity
+        self.processes = {}
+        self.started = {}
+        self.stopping = False
+        self.stats_dir = None
+
+    def _run_worker(self, worker_id):
+        global _stats_dir, _worker_id
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # Every SIGHUP is forwarded, the target installs a handler if it has
+        # anything to reload.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        _stats_dir = self.stats_dir
+        _worker_id = worker_id
+        if self.cpu_affinity and hasattr(os, "sched_setaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+        try:
+            self.target()
+        finally:
+            try:
+                os.remove(_stats_path(_stats_dir, worker_id))
+            except OSError:
+                pass
+
+    def start(self, worker_id):
+        delay = self.started.get(worker_id, 0) + self.RESTART_DELAY - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        # Forked, so that the target needs not be picklable.
+        process = multiprocessing.get_context("fork").Process(
+            target=self._run_worker,
+            args=(worker_id,),
+            name="worker-{}".format(worker_id),
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self.started[worker_id] = time.monotonic()
+        self.logger.info("Started worker {} (pid {})".format(worker_id, process.pid))
+
+    def _forward(self, signum, frame):
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        """Supervise the workers until SIGTERM or SIGINT.
+        :return: the exit code of the supervisor.
+        """
+        self.stats_dir = tempfile.mkdtemp(prefix="doh-proxy-stats-")
+        signal.signal(signal.SIGHUP, self._forward)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            for worker_id in range(self.workers):
+                self.start(worker_id)
+            while not self.stopping:
+                sentinels = [p.sentinel for p in self.processes.values()]
+                multiprocessing.connection.wait(sentinels, timeout=1)
+                for worker_id, process in list(self.processes.items()):
+                    if self.stopping or process.is_alive():
+                        continue
+                    self.logger.error(
+                        "Worker {} (pid {}) exited with code {}, restarting".format(
+                            worker_id, process.pid, process.exitcode
+                        )
+                    )
+                    self.start(worker_id)
+        finally:
+            self.shutdown()
+            shutil.rmtree(self.stats_dir, ignore_errors=True)
+        return 0
+
+    def shutdown(self):
+        self.logger.info("Stopping {} workers".format(len(self.processes)))
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.SHUTDOWN_TIMEOUT
+        for process in self.processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                self.logger.error(
+                    "Worker (pid {}) did not stop, killing it".format(process.pid)
+                )
+                process.kill()
+                process.join()
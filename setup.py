@@ -57,7 +57,7 @@ setup(
     keywords="doh proxy dns https",
     packages=["dohproxy"],
     setup_requires=["flake8", "pytest-runner"],
-    extras_require={"integration_tests": ["colour-runner"]},
+    extras_require={"integration_tests": ["colour-runner"], "uvloop": ["uvloop"]},
     install_requires=[
         "aiohttp < 4.0.0",
         "dnspython",
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import ipaddress
+import unittest
+from unittest.mock import patch
+
+import dns.edns
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rrset
+from dohproxy import dnswire, utils
+from dohproxy.cache import DNSCache
+
+
+def make_answer(dnsq, ttl=60, address="192.0.2.1"):
+    dnsr = dns.message.make_response(dnsq)
+    dnsr.answer.append(
+        dns.rrset.from_text(dnsq.question[0].name, ttl, "IN", "A", address)
+    )
+    return dnsr
+
+
+def wire_message(dnsr):
+    return dnswire.WireMessage(dnsr.to_wire())
+
+
+def make_negative_answer(dnsq, rcode=dns.rcode.NXDOMAIN, minimum=60):
+    dnsr = dns.message.make_response(dnsq)
+    dnsr.set_rcode(rcode)
+    dnsr.authority.append(
+        dns.rrset.from_text(
+            "example.com.",
+            3600,
+            "IN",
+            "SOA",
+            "ns.example.com. admin.example.com. 1 7200 900 1209600 "
+            "{}".format(minimum),
+        )
+    )
+    return dnsr
+
+
+def make_ecs_query(ip, srclen=24):
+    dnsq = dns.message.make_query("www.example.com", "A")
+    dnsq.use_edns(options=[dns.edns.ECSOption(ip, srclen=srclen)])
+    return dnsq
+
+
+def make_ecs_answer(dnsq, scopelen, address="192.0.2.1"):
+    dnsr = make_answer(dnsq, address=address)
+    option = dnsq.options[0]
+    dnsr.use_edns(
+        options=[
+            dns.edns.ECSOption(option.address, option.srclen, scopelen=scopelen)
+        ]
+    )
+    return dnsr
+
+
+class DNSCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = DNSCache(65536)
+        self.dnsq = dns.message.make_query("www.example.com", "A")
+
+    def put(self, key, dnsr):
+        return self.cache.put(key, wire_message(dnsr))
+
+    def get(self, key):
+        """Look up an answer and parse it."""
+        dnsr = self.cache.get(key)
+        return None if dnsr is None else dnsr.message()
+
+    def test_miss_then_hit(self):
+        key = self.cache.make_key(self.dnsq)
+        self.assertIsNone(self.cache.get(key))
+        self.assertTrue(self.put(key, make_answer(self.dnsq)))
+        dnsr = self.cache.get(key)
+        self.assertEqual(dnsr.to_wire(), make_answer(self.dnsq).to_wire())
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_cached_answer_is_a_copy(self):
+        key = self.cache.make_key(self.dnsq)
+        dnsr = wire_message(make_answer(self.dnsq))
+        self.cache.put(key, dnsr)
+        dnsr.set_id(1)
+        self.cache.get(key).set_id(2)
+        self.assertEqual(self.cache.get(key).id, self.dnsq.id)
+
+    def test_key_normalization(self):
+        other = dns.message.make_query("WWW.Example.COM", "A")
+        self.assertEqual(self.cache.make_key(self.dnsq), self.cache.make_key(other))
+
+    def test_key_flags(self):
+        key = self.cache.make_key(self.dnsq)
+        do = dns.message.make_query("www.example.com", "A", want_dnssec=True)
+        self.assertNotEqual(key, self.cache.make_key(do))
+        cd = dns.message.make_query("www.example.com", "A")
+        cd.flags |= dns.flags.CD
+        self.assertNotEqual(key, self.cache.make_key(cd))
+        edns = dns.message.make_query("www.example.com", "A", use_edns=0)
+        self.assertNotEqual(key, self.cache.make_key(edns))
+        # The query ID does not matter
+        self.dnsq.id += 1
+        self.assertEqual(key, self.cache.make_key(self.dnsq))
+
+    def test_key_ecs(self):
+        ecs1 = dns.message.make_query("www.example.com", "A")
+        utils.set_dns_ecs(ecs1, "10.0.0.1")
+        ecs2 = dns.message.make_query("www.example.com", "A")
+        utils.set_dns_ecs(ecs2, "10.0.0.2")
+        ecs3 = dns.message.make_query("www.example.com", "A")
+        utils.set_dns_ecs(ecs3, "10.0.1.2")
+        self.assertEqual(self.cache.make_key(ecs1), self.cache.make_key(ecs2))
+        self.assertNotEqual(self.cache.make_key(ecs1), self.cache.make_key(ecs3))
+        self.assertNotEqual(
+            self.cache.make_key(ecs1), self.cache.make_key(self.dnsq)
+        )
+        # The ECS added upstream comes with an OPT record
+        subnet = ipaddress.ip_network("10.0.0.0/24")
+        self.assertEqual(
+            self.cache.make_key(ecs1), self.cache.make_key(self.dnsq, subnet=subnet)
+        )
+
+    @patch("dohproxy.cache.time")
+    def test_ttl_aging_and_expiry(self, m_time):
+        m_time.monotonic.return_value = 1000
+        key = self.cache.make_key(self.dnsq)
+        self.put(key, make_answer(self.dnsq, ttl=60))
+        m_time.monotonic.return_value = 1010
+        self.assertEqual(self.get(key).answer[0].ttl, 50)
+        m_time.monotonic.return_value = 1060
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_lru_eviction(self):
+        """The cache is budgeted in bytes, the least recently used entries
+        are evicted first."""
+        keys = []
+        for name in ["a.example.com", "b.example.com", "c.example.com"]:
+            dnsq = dns.message.make_query(name, "A")
+            keys.append(self.cache.make_key(dnsq))
+            self.put(keys[-1], make_answer(dnsq))
+            if len(keys) == 1:
+                # Room for two entries of the same size
+                self.cache.size = self.cache.stats()["bytes"] * 2
+            # Keep the first entry hot
+            self.cache.get(keys[0])
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_not_cacheable(self):
+        key = self.cache.make_key(self.dnsq)
+        servfail = dns.message.make_response(self.dnsq)
+        servfail.set_rcode(dns.rcode.SERVFAIL)
+        self.assertFalse(self.put(key, servfail))
+        truncated = make_answer(self.dnsq)
+        truncated.flags |= dns.flags.TC
+        self.assertFalse(self.put(key, truncated))
+        self.assertFalse(self.put(key, make_answer(self.dnsq, ttl=0)))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_too_large(self):
+        self.cache.size = 10
+        key = self.cache.make_key(self.dnsq)
+        self.assertFalse(self.put(key, make_answer(self.dnsq)))
+        self.assertEqual(self.cache.stats()["bytes"], 0)
+
+    @patch("dohproxy.cache.time")
+    def test_stale(self, m_time):
+        self.cache.stale_window = 30
+        m_time.monotonic.return_value = 1000
+        key = self.cache.make_key(self.dnsq)
+        self.put(key, make_answer(self.dnsq, ttl=60))
+        m_time.monotonic.return_value = 1070
+        self.assertIsNone(self.cache.get(key))
+        dnsr = self.cache.get_stale(key).message()
+        self.assertEqual(dnsr.answer[0].ttl, DNSCache.STALE_TTL)
+        self.assertEqual(self.cache.stats()["stale_hits"], 1)
+        m_time.monotonic.return_value = 1090
+        self.assertIsNone(self.cache.get_stale(key))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_no_stale_window(self):
+        key = self.cache.make_key(self.dnsq)
+        self.assertIsNone(self.cache.get_stale(key))
+
+    @patch("dohproxy.cache.time")
+    def test_prefetch_due(self, m_time):
+        self.cache.prefetch_min_hits = 2
+        m_time.monotonic.return_value = 1000
+        key = self.cache.make_key(self.dnsq)
+        self.put(key, make_answer(self.dnsq, ttl=100))
+        self.cache.get(key)
+        self.cache.get(key)
+        # Popular but not close to expiry yet
+        self.assertFalse(self.cache.prefetch_due(key))
+        m_time.monotonic.return_value = 1095
+        self.assertTrue(self.cache.prefetch_due(key))
+        # Only reported once
+        self.assertFalse(self.cache.prefetch_due(key))
+        # A fresh answer has to earn its hits again
+        self.put(key, make_answer(self.dnsq, ttl=100))
+        m_time.monotonic.return_value = 1195
+        self.assertFalse(self.cache.prefetch_due(key))
+
+    def test_prefetch_disabled(self):
+        key = self.cache.make_key(self.dnsq)
+        self.put(key, make_answer(self.dnsq, ttl=1))
+        for _ in range(5):
+            self.cache.get(key)
+        self.assertFalse(self.cache.prefetch_due(key))
+
+    @patch("dohproxy.cache.time")
+    def test_negative(self, m_time):
+        """NXDOMAIN and NODATA answers are cached for the negative TTL, which
+        their SOA TTL ages from."""
+        m_time.monotonic.return_value = 1000
+        key = self.cache.make_key(self.dnsq)
+        self.assertTrue(self.put(key, make_negative_answer(self.dnsq)))
+        m_time.monotonic.return_value = 1010
+        dnsr = self.get(key)
+        self.assertEqual(dnsr.rcode(), dns.rcode.NXDOMAIN)
+        self.assertEqual(dnsr.authority[0].ttl, 50)
+        m_time.monotonic.return_value = 1060
+        self.assertIsNone(self.cache.get(key))
+        nodata = make_negative_answer(self.dnsq, rcode=dns.rcode.NOERROR)
+        self.assertTrue(self.put(key, nodata))
+
+    def test_negative_ttl_max(self):
+        self.cache.negative_ttl_max = 10
+        key = self.cache.make_key(self.dnsq)
+        self.put(key, make_negative_answer(self.dnsq, minimum=600))
+        self.assertEqual(self.get(key).authority[0].ttl, 10)
+
+    def test_ecs_scope(self):
+        """An answer scoped to a subnet serves the clients of that subnet
+        only, with their own ECS option."""
+        dnsq = make_ecs_query("10.0.0.0")
+        self.put(self.cache.make_key(dnsq), make_ecs_answer(dnsq, 16))
+        other = make_ecs_query("10.0.1.0")
+        dnsr = self.get(self.cache.make_key(other))
+        self.assertEqual(dnsr.options[0].address, "10.0.1.0")
+        self.assertEqual(dnsr.options[0].scopelen, 16)
+        other = make_ecs_query("10.1.0.0")
+        self.assertIsNone(self.cache.get(self.cache.make_key(other)))
+        self.assertIsNone(self.cache.get(self.cache.make_key(self.dnsq)))
+
+    def test_ecs_most_specific(self):
+        dnsq = make_ecs_query("10.0.0.0")
+        key = self.cache.make_key(dnsq)
+        self.put(key, make_ecs_answer(dnsq, 8, "192.0.2.8"))
+        self.put(key, make_ecs_answer(dnsq, 24, "192.0.2.24"))
+        dnsr = self.get(key)
+        self.assertEqual(dnsr.answer[0][0].address, "192.0.2.24")
+        dnsr = self.get(self.cache.make_key(make_ecs_query("10.0.1.0")))
+        self.assertEqual(dnsr.answer[0][0].address, "192.0.2.8")
+        # A scope longer than the source prefix applies to the source prefix
+        self.put(key, make_ecs_answer(dnsq, 32, "192.0.2.32"))
+        self.assertEqual(self.get(key).answer[0][0].address, "192.0.2.32")
+        self.assertEqual(len(self.cache.subnets[key[:-1]]), 2)
+
+    def test_ecs_global(self):
+        """A /0 scope is a global answer, which also serves EDNS queries
+        without ECS, without an ECS option."""
+        dnsq = make_ecs_query("10.0.0.0")
+        self.put(self.cache.make_key(dnsq), make_ecs_answer(dnsq, 0))
+        dnsr = self.get(self.cache.make_key(make_ecs_query("172.16.0.0")))
+        self.assertEqual(dnsr.options[0].address, "172.16.0.0")
+        self.assertEqual(dnsr.options[0].scopelen, 0)
+        edns = dns.message.make_query("www.example.com", "A", use_edns=0)
+        dnsr = self.get(self.cache.make_key(edns))
+        self.assertEqual(len(dnsr.options), 0)
+        self.assertEqual(self.cache.subnets, {})
+
+    def test_ecs_without_option(self):
+        """The ECS option of the query key can be left out of the answer."""
+        dnsq = make_ecs_query("10.0.0.0")
+        key = self.cache.make_key(dnsq)
+        self.put(key, make_ecs_answer(dnsq, 24))
+        self.assertIsNone(self.cache.get(key, with_ecs=False).option(dns.edns.ECS))
+
+    def test_ecs_max_subnets(self):
+        self.cache.max_subnets = 2
+        keys = []
+        for ip in ["10.0.0.0", "10.0.1.0", "10.0.2.0"]:
+            dnsq = make_ecs_query(ip)
+            keys.append(self.cache.make_key(dnsq))
+            self.put(keys[-1], make_ecs_answer(dnsq, 24))
+        self.assertIsNone(self.cache.get(keys[0]))
+        self.assertIsNotNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+        self.assertEqual(self.cache.stats()["entries"], 2)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import ipaddress
+import unittest
+
+import dns.edns
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rrset
+from dohproxy import constants, dnswire
+
+
+class TestDNSWire(unittest.TestCase):
+    def setUp(self):
+        self.dnsq = dns.message.make_query("www.example.com", "A")
+
+    def test_find_opt(self):
+        self.assertIsNone(dnswire.find_opt(self.dnsq.to_wire()))
+        self.dnsq.use_edns(0)
+        wire = self.dnsq.to_wire()
+        self.assertEqual(dnswire.find_opt(wire), (len(wire) - 11, len(wire)))
+        self.assertEqual(dnswire.edns_option_codes(wire, dnswire.find_opt(wire)), [])
+
+    def test_malformed(self):
+        self.dnsq.use_edns(0)
+        with self.assertRaises(dns.exception.FormError):
+            dnswire.find_opt(self.dnsq.to_wire()[:-4])
+        with self.assertRaises(dns.exception.FormError):
+            dnswire.find_opt(b"\x00" * 5)
+
+    def test_add_edns_option_without_opt(self):
+        wire = dnswire.add_edns_option(self.dnsq.to_wire(), 65001, b"abc")
+        dnsq = dns.message.from_wire(wire)
+        self.assertEqual(dnsq.question, self.dnsq.question)
+        self.assertEqual(dnsq.edns, 0)
+        self.assertEqual(dnsq.payload, constants.DNS_EDNS_PAYLOAD)
+        self.assertEqual(dnsq.options[0].otype, 65001)
+        self.assertEqual(dnsq.options[0].data, b"abc")
+
+    def test_add_edns_option(self):
+        self.dnsq.use_edns(
+            0, payload=4096, options=[dns.edns.GenericOption(65001, b"")]
+        )
+        wire = dnswire.add_edns_option(
+            self.dnsq.to_wire(), constants.DNS_EDNS_TCP_KEEPALIVE, b""
+        )
+        dnsq = dns.message.from_wire(wire)
+        self.assertEqual(dnsq.payload, 4096)
+        self.assertEqual(
+            [option.otype for option in dnsq.options],
+            [65001, constants.DNS_EDNS_TCP_KEEPALIVE],
+        )
+        self.assertEqual(
+            dnswire.edns_option_codes(wire, dnswire.find_opt(wire)),
+            [65001, constants.DNS_EDNS_TCP_KEEPALIVE],
+        )
+
+    def test_add_edns_option_unsupported(self):
+        """Additional records without an OPT record are left alone."""
+        self.dnsq.additional.append(
+            dns.rrset.from_text("ns.example.com.", 60, "IN", "A", "192.0.2.1")
+        )
+        self.assertIsNone(dnswire.add_edns_option(self.dnsq.to_wire(), 65001, b""))
+
+    def test_ecs_option_data(self):
+        for subnet in ["10.0.1.0/24", "2001:db8::/56", "0.0.0.0/0"]:
+            subnet = ipaddress.ip_network(subnet)
+            wire = dnswire.add_edns_option(
+                self.dnsq.to_wire(), dns.edns.ECS, dnswire.ecs_option_data(subnet)
+            )
+            option = dns.message.from_wire(wire).options[0]
+            self.assertEqual(option.address, subnet.network_address.compressed)
+            self.assertEqual(option.srclen, subnet.prefixlen)
+            self.assertEqual(option.scopelen, 0)
+
+    def test_set_id(self):
+        wire = dnswire.set_id(self.dnsq.to_wire(), 1234)
+        self.assertEqual(dns.message.from_wire(wire).id, 1234)
+
+    def test_set_payload(self):
+        wire = self.dnsq.to_wire()
+        self.assertIs(dnswire.set_payload(wire, 4096), wire)
+        self.dnsq.use_edns(0, payload=1232)
+        wire = dnswire.set_payload(self.dnsq.to_wire(), 4096)
+        dnsq = dns.message.from_wire(wire)
+        self.assertEqual(dnsq.payload, 4096)
+        self.assertEqual(dnsq.question, self.dnsq.question)
+        self.assertIs(dnswire.set_payload(wire, 4096), wire)
+
+
+class TestWireMessage(unittest.TestCase):
+    def setUp(self):
+        self.dnsq = dns.message.make_query("www.example.com", "A")
+        self.dnsr = dns.message.make_response(self.dnsq)
+        self.dnsr.answer.append(
+            dns.rrset.from_text("www.example.com.", 60, "IN", "A", "192.0.2.1")
+        )
+        self.dnsr.answer.append(
+            dns.rrset.from_text("www.example.com.", 30, "IN", "TXT", "foo")
+        )
+
+    def make_negative_answer(self, rcode, soa_ttl=300, minimum=60, answer=False):
+        dnsr = dns.message.make_response(self.dnsq)
+        dnsr.set_rcode(rcode)
+        if answer:
+            dnsr.answer.append(
+                dns.rrset.from_text("www.example.com.", 60, "IN", "A", "192.0.2.1")
+            )
+        if soa_ttl is not None:
+            dnsr.authority.append(
+                dns.rrset.from_text(
+                    "example.com.",
+                    soa_ttl,
+                    "IN",
+                    "SOA",
+                    "ns.example.com. admin.example.com. 1 7200 900 1209600 "
+                    "{}".format(minimum),
+                )
+            )
+        return dnswire.WireMessage(dnsr.to_wire())
+
+    def test_scan(self):
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        self.assertEqual(dnsr.id, self.dnsr.id)
+        self.assertEqual(dnsr.flags, self.dnsr.flags)
+        self.assertEqual(dnsr.rcode(), dns.rcode.NOERROR)
+        self.assertEqual(
+            dnsr.question, dnswire.question_key(self.dnsq.to_wire()),
+        )
+        self.assertEqual(dnsr.ancount, 2)
+        self.assertEqual(len(dnsr.ttl_offsets), 2)
+        self.assertEqual(dnsr.answer_ttl, 30)
+        self.assertEqual(dnsr.max_age(), 30)
+        self.assertIsNone(dnsr.negative_ttl())
+        self.assertEqual(dnsr.edns, -1)
+        self.assertEqual(dnsr.message(), self.dnsr)
+
+    def test_question_key_case_insensitive(self):
+        dnsq = dns.message.make_query("WWW.Example.COM", "A")
+        self.assertEqual(
+            dnswire.question_key(dnsq.to_wire()),
+            dnswire.question_key(self.dnsq.to_wire()),
+        )
+
+    def test_zero_ttl(self):
+        self.dnsr.answer[0].ttl = 0
+        self.assertEqual(dnswire.WireMessage(self.dnsr.to_wire()).max_age(), 0)
+
+    def test_negative_ttl(self):
+        dnsr = self.make_negative_answer(dns.rcode.NXDOMAIN)
+        self.assertEqual(dnsr.negative_ttl(), 60)
+        self.assertEqual(dnsr.max_age(), 60)
+        self.assertEqual(dnsr.negative_ttl(max_ttl=10), 10)
+        dnsr = self.make_negative_answer(dns.rcode.NOERROR, soa_ttl=30)
+        self.assertEqual(dnsr.max_age(), 30)
+        dnsr = self.make_negative_answer(dns.rcode.NXDOMAIN, 86400, 7200)
+        self.assertEqual(dnsr.negative_ttl(max_ttl=3600), 3600)
+        self.assertEqual(dnsr.max_age(negative_ttl_max=600), 600)
+        dnsr = self.make_negative_answer(dns.rcode.SERVFAIL)
+        self.assertIsNone(dnsr.negative_ttl())
+        self.assertIsNone(dnsr.max_age())
+
+    def test_negative_ttl_without_soa(self):
+        dnsr = self.make_negative_answer(dns.rcode.NXDOMAIN, soa_ttl=None)
+        self.assertIsNone(dnsr.negative_ttl())
+        self.assertIsNone(dnsr.max_age())
+
+    def test_negative_ttl_with_answer(self):
+        dnsr = self.make_negative_answer(dns.rcode.NOERROR, answer=True)
+        self.assertIsNone(dnsr.negative_ttl())
+        self.assertEqual(dnsr.max_age(), 60)
+
+    def test_without_options(self):
+        self.dnsr.use_edns(
+            0,
+            options=[
+                dns.edns.GenericOption(constants.DNS_EDNS_COOKIE, b"\x01" * 8),
+                dns.edns.GenericOption(constants.DNS_EDNS_NSID, b"ns1"),
+                dns.edns.GenericOption(constants.DNS_EDNS_PADDING, b"\0" * 4),
+            ],
+        )
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        self.assertIs(dnsr.without_options([constants.DNS_EDNS_TCP_KEEPALIVE]), dnsr)
+        stripped = dnsr.without_options(
+            [constants.DNS_EDNS_COOKIE, constants.DNS_EDNS_PADDING]
+        )
+        self.assertEqual(list(stripped.options), [constants.DNS_EDNS_NSID])
+        self.assertEqual(
+            [o.otype for o in stripped.message().options], [constants.DNS_EDNS_NSID]
+        )
+        self.assertEqual(stripped.option(constants.DNS_EDNS_NSID), b"ns1")
+        self.assertEqual(stripped.message().answer, self.dnsr.answer)
+
+    def test_extended_rcode(self):
+        self.dnsr.use_edns(0)
+        self.dnsr.set_rcode(dns.rcode.BADVERS)
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        self.assertEqual(dnsr.rcode(), dns.rcode.BADVERS)
+        self.assertEqual(dnsr.edns, 0)
+
+    def test_options(self):
+        self.dnsr.use_edns(
+            0,
+            payload=4096,
+            options=[
+                dns.edns.GenericOption(65001, b"abc"),
+                dns.edns.GenericOption(65002, b"de"),
+            ],
+        )
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        self.assertEqual(dnsr.payload, 4096)
+        self.assertEqual(dnsr.option(65001), b"abc")
+        self.assertEqual(dnsr.option(65002), b"de")
+        self.assertIsNone(dnsr.option(65003))
+        self.assertIs(dnsr.without_option(65003), dnsr)
+
+        stripped = dnsr.without_option(65001)
+        self.assertEqual(list(stripped.options), [65002])
+        self.assertEqual(stripped.option(65002), b"de")
+        options = stripped.message().options
+        self.assertEqual(len(options), 1)
+        self.assertEqual(options[0].otype, 65002)
+        self.assertEqual(stripped.message().answer, self.dnsr.answer)
+
+        stripped = stripped.without_opt()
+        self.assertEqual(stripped.edns, -1)
+        self.assertEqual(stripped.arcount, 0)
+        self.assertEqual(stripped.message().edns, -1)
+        self.assertIs(stripped.without_opt(), stripped)
+
+    def test_set_id(self):
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        self.assertEqual(dnsr.message().id, self.dnsr.id)
+        dnsr.set_id(1234)
+        self.assertEqual(dnsr.id, 1234)
+        self.assertEqual(dnsr.message().id, 1234)
+        self.assertEqual(dns.message.from_wire(dnsr.to_wire()).id, 1234)
+
+    def test_equality(self):
+        wire = self.dnsr.to_wire()
+        self.assertEqual(dnswire.WireMessage(wire), dnswire.WireMessage(wire))
+        self.assertNotEqual(dnswire.WireMessage(wire), wire)
+
+    def test_copy_on_write(self):
+        """Received bytes are scanned in place, and only copied once the
+        message is modified."""
+        wire = self.dnsr.to_wire()
+        dnsr = dnswire.WireMessage(wire)
+        self.assertIs(dnsr.wire, wire)
+        self.assertIs(dnsr.to_wire(), wire)
+        dnsr.set_id(self.dnsr.id)
+        self.assertIs(dnsr.wire, wire)
+        dnsr.set_id(self.dnsr.id ^ 1)
+        self.assertEqual(dnsr.message().id, self.dnsr.id ^ 1)
+        self.assertEqual(wire, self.dnsr.to_wire())
+
+    def test_truncated(self):
+        wire = self.dnsr.to_wire()
+        for length in [5, len(wire) - 1]:
+            with self.assertRaises(dns.exception.FormError):
+                dnswire.WireMessage(wire[:length])
+
+    def test_age_and_cap_ttls(self):
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        wire = bytearray(dnsr.wire)
+        dnswire.age_ttls(wire, dnsr.ttl_offsets, 40)
+        self.assertEqual(
+            [rrset.ttl for rrset in dns.message.from_wire(bytes(wire)).answer],
+            [20, 0],
+        )
+        wire = bytearray(dnsr.wire)
+        dnswire.cap_ttls(wire, dnsr.ttl_offsets, 45)
+        self.assertEqual(
+            [rrset.ttl for rrset in dns.message.from_wire(bytes(wire)).answer],
+            [45, 30],
+        )
+
+    def test_append_edns_option(self):
+        self.dnsr.use_edns(0, options=[dns.edns.GenericOption(65001, b"abc")])
+        dnsr = dnswire.WireMessage(self.dnsr.to_wire())
+        wire = bytearray(dnsr.wire)
+        dnswire.append_edns_option(wire, dnsr.opt[1] - 2, 65002, b"de")
+        dnsr = dnswire.WireMessage(wire)
+        self.assertEqual(dnsr.option(65001), b"abc")
+        self.assertEqual(dnsr.option(65002), b"de")
+        self.assertEqual(len(dnsr.message().options), 2)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import dns.message
+import dns.name
+from dohproxy.forwarding import ForwardingTable
+from dohproxy.server_protocol import DNSClient
+
+RULES = """
+# Internal zones
+corp.example        10.0.0.53 10.0.1.53:5353
+lab.corp.example    tls://10.0.2.53
+10.in-addr.arpa     [::1]:5353
+"""
+
+
+class ForwardingTableTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        self.addCleanup(os.remove, self.path)
+        with os.fdopen(fd, "w") as f:
+            f.write(RULES)
+        self.table = ForwardingTable(self.path)
+
+    def lookup(self, name):
+        return self.table.lookup(dns.name.from_text(name))
+
+    def test_lookup(self):
+        self.assertEqual(self.table.rules, 3)
+        self.assertEqual(
+            self.lookup("www.corp.example"), ("10.0.0.53", "10.0.1.53:5353")
+        )
+        self.assertEqual(self.lookup("corp.example"), ("10.0.0.53", "10.0.1.53:5353"))
+        self.assertEqual(self.lookup("WWW.Lab.Corp.Example."), ("tls://10.0.2.53",))
+        self.assertEqual(self.lookup("1.0.0.10.in-addr.arpa"), ("[::1]:5353",))
+        self.assertIsNone(self.lookup("example"))
+        self.assertIsNone(self.lookup("xcorp.example"))
+        self.assertIsNone(self.lookup("."))
+
+    def test_root_rule(self):
+        self.table.add(".", ["192.0.2.1"])
+        self.assertEqual(self.lookup("www.example.com"), ("192.0.2.1",))
+        self.assertEqual(
+            self.lookup("www.corp.example"), ("10.0.0.53", "10.0.1.53:5353")
+        )
+        self.assertEqual(self.table.rules, 4)
+
+    def test_reload(self):
+        with open(self.path, "a") as f:
+            f.write("example.net 192.0.2.1\n")
+        self.table.reload()
+        self.assertEqual(self.lookup("www.example.net"), ("192.0.2.1",))
+        self.assertEqual(self.table.stats(), {"rules": 4, "reloads": 1})
+
+    def test_reload_malformed(self):
+        """A malformed file leaves the rules unchanged."""
+        for rule in ["example.net\n", "example.net quic://192.0.2.1\n"]:
+            with open(self.path, "a") as f:
+                f.write(rule)
+            with self.assertRaises(ValueError):
+                self.table.load()
+            self.table.reload()
+            self.assertEqual(self.table.stats(), {"rules": 3, "reloads": 0})
+            self.assertIsNone(self.lookup("example.net"))
+            with open(self.path, "w") as f:
+                f.write(RULES)
+
+    def test_dnsclient_for_query(self):
+        with patch.object(DNSClient, "FORWARDING", self.table):
+            dnsq = dns.message.make_query("www.lab.corp.example", "A")
+            dnsclient = DNSClient.for_query(dnsq, ["192.0.2.1"], 53)
+            self.assertEqual(dnsclient.upstreams, [("10.0.2.53", 853)])
+            self.assertEqual(dnsclient.tls_upstreams, {("10.0.2.53", 853)})
+            dnsq = dns.message.make_query("www.example.com", "A")
+            dnsclient = DNSClient.for_query(dnsq, ["192.0.2.1"], 53)
+            self.assertEqual(dnsclient.upstreams, [("192.0.2.1", 53)])
@@ -8,15 +8,22 @@
 #
 
 import logging
+import os
+import shutil
+import tempfile
+import unittest
 from unittest.mock import MagicMock, patch
 
 import aiohttp
 import aiohttp_remotes
 import asynctest
 import dns.message
+import dns.rcode
+import dns.rrset
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
-from dohproxy import constants, httpproxy, server_protocol, utils
+from dohproxy import constants, dnswire, httpproxy, server_protocol, utils
 from dohproxy.server_protocol import DNSClient
+from dohproxy.upstream import UpstreamOverloaded
 
 
 def echo_dns_q(q):
@@ -207,6 +214,96 @@ class HTTPProxyPOSTTestCase(HTTPProxyTestCase):
         self.assertEqual(content, b"Malformed DNS query")
 
 
+class HTTPProxyCacheControlTestCase(HTTPProxyTestCase):
+    def make_answer(self, rcode, soa_ttl=300):
+        dnsr = dns.message.make_response(self.dnsq)
+        dnsr.set_rcode(rcode)
+        dnsr.authority.append(
+            dns.rrset.from_text(
+                "example.com.",
+                soa_ttl,
+                "IN",
+                "SOA",
+                "ns.example.com. admin.example.com. 1 7200 900 1209600 60",
+            )
+        )
+        return dnswire.WireMessage(dnsr.to_wire())
+
+    @asynctest.patch.object(server_protocol.DNSClient, "query_wire")
+    @unittest_run_loop
+    async def test_nxdomain_max_age(self, query_wire):
+        """ Test that NXDOMAIN answers get a cache-control header from the
+        SOA MINIMUM.
+        """
+        query_wire.return_value = self.make_answer(dns.rcode.NXDOMAIN)
+        params = utils.build_query_params(self.dnsq.to_wire())
+        request = await self.client.request("GET", self.endpoint, params=params)
+        self.assertEqual(request.status, 200)
+        self.assertEqual(request.headers["cache-control"], "max-age=60")
+
+    @asynctest.patch.object(server_protocol.DNSClient, "query_wire")
+    @unittest_run_loop
+    async def test_nodata_max_age(self, query_wire):
+        """ Test that NODATA answers get a cache-control header from the SOA
+        TTL when it is lower than its MINIMUM.
+        """
+        query_wire.return_value = self.make_answer(dns.rcode.NOERROR, soa_ttl=30)
+        params = utils.build_query_params(self.dnsq.to_wire())
+        request = await self.client.request("GET", self.endpoint, params=params)
+        self.assertEqual(request.headers["cache-control"], "max-age=30")
+
+    @asynctest.patch.object(server_protocol.DNSClient, "query_wire")
+    @unittest_run_loop
+    async def test_servfail_no_max_age(self, query_wire):
+        query_wire.return_value = self.make_answer(dns.rcode.SERVFAIL)
+        params = utils.build_query_params(self.dnsq.to_wire())
+        request = await self.client.request("GET", self.endpoint, params=params)
+        self.assertNotIn("cache-control", request.headers)
+
+
+class HTTPProxyShedTestCase(HTTPProxyTestCase):
+    def get_args(self):
+        return super().get_args() + ["--shed-rcode", "REFUSED"]
+
+    @asynctest.patch.object(server_protocol.DNSClient, "query_wire")
+    @unittest_run_loop
+    async def test_shed_rcode(self, query_wire):
+        """ Test that shed queries are answered with --shed-rcode.
+        """
+        query_wire.side_effect = UpstreamOverloaded()
+        params = utils.build_query_params(self.dnsq.to_wire())
+        request = await self.client.request("GET", self.endpoint, params=params)
+        self.assertEqual(request.status, 200)
+        dnsr = dns.message.from_wire(await request.read())
+        self.assertEqual(dnsr.rcode(), dns.rcode.REFUSED)
+
+    @asynctest.patch.object(server_protocol.DNSClient, "query_wire")
+    @unittest_run_loop
+    async def test_shed_retry_after(self, query_wire):
+        """ Test that shed queries get HTTP 503 with --shed-retry-after.
+        """
+        query_wire.side_effect = UpstreamOverloaded()
+        params = utils.build_query_params(self.dnsq.to_wire())
+        with patch.object(DNSClient, "SHED_RETRY_AFTER", 5):
+            request = await self.client.request("GET", self.endpoint, params=params)
+        self.assertEqual(request.status, 503)
+        self.assertEqual(request.headers["retry-after"], "5")
+
+
+class HTTPProxyStatsTestCase(HTTPProxyTestCase):
+    def get_args(self):
+        return super().get_args() + ["--stats-uri", "/stats", "--cache-size", "65536"]
+
+    @unittest_run_loop
+    async def test_stats(self):
+        """ Test that the counters are served as JSON on --stats-uri.
+        """
+        request = await self.client.request("GET", "/stats")
+        self.assertEqual(request.status, 200)
+        stats = await request.json()
+        self.assertEqual(stats["cache"]["hits"], 0)
+
+
 class HTTPProxyXForwardedModeTestCase(HTTPProxyTestCase):
     """ Trusted parameter is set by default to [::1, 127.0.0.1].
     See httpproxy.parse_args
@@ -295,8 +392,8 @@ class DNSClientLoggerTestCase(HTTPProxyTestCase):
         await app.resolve(request, self.dnsq)
 
         mylogger = utils.configure_logger(name="doh-httpproxy", level="DEBUG")
-        MockedDNSClient.assert_called_with(
-            app.upstream_resolver, app.upstream_port, logger=mylogger
+        MockedDNSClient.for_query.assert_called_with(
+            self.dnsq, app.upstream_resolver, app.upstream_port, logger=mylogger
         )
 
     def test_dnsclient_none_logger(self):
@@ -318,3 +415,29 @@ class DNSClientLoggerTestCase(HTTPProxyTestCase):
         dnsclient = DNSClient("", 80, logger=mylogger)
         self.assertEqual(dnsclient.logger.level, 40)  # ERROR's level is 40
         self.assertEqual(dnsclient.logger.name, "mylogger")
+
+
+class ListenTestCase(unittest.TestCase):
+    def test_listen_unix(self):
+        parser, args = httpproxy.parse_args(["--listen-unix", "/run/doh.sock"])
+        self.assertEqual(args.listen_unix, "/run/doh.sock")
+        self.assertEqual(args.listen_address, [])
+
+    def test_listen_unix_and_address(self):
+        parser, args = httpproxy.parse_args(
+            ["--listen-unix", "/run/doh.sock", "--listen-address", "::1", "10.0.0.1"]
+        )
+        self.assertEqual(args.listen_address, ["::1", "10.0.0.1"])
+
+    def test_listen_address_default(self):
+        parser, args = httpproxy.parse_args([])
+        self.assertEqual(args.listen_address, ["::1"])
+
+    def test_bind_unix_socket_stale(self):
+        path = os.path.join(tempfile.mkdtemp(), "doh.sock")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        # Left over by a previous run.
+        httpproxy.bind_unix_socket(path).close()
+        sock = httpproxy.bind_unix_socket(path)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getsockname(), path)
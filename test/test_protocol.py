@@ -7,13 +7,142 @@
 # LICENSE file in the root directory of this source tree.
 #
 import asyncio
+import collections
+import os
+import ssl
 import struct
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+import asynctest
 import dns
 import dns.message
-from dohproxy.server_protocol import DNSClientProtocolTCP
+import dns.rrset
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.settings
+from dohproxy import constants, dnswire, utils
+from dohproxy.cache import DNSCache
+from dohproxy.proxy import H2Protocol
+from dohproxy.server_protocol import (
+    DNSClient,
+    DNSClientProtocolTCP,
+    HTTPSConnectionPool,
+    TCPConnectionPool,
+    TLSConnectionPool,
+    UDPSocketPool,
+    UpstreamPool,
+)
+from dohproxy.upstream import UpstreamHealth, UpstreamLimit, UpstreamOverloaded
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+class FakeResolverUDP(asyncio.DatagramProtocol):
+    """A local upstream stand-in answering every query with an empty
+    response, truncated if `truncate` is set, unless `drop` is set or it is
+    one of the first `drop_first` queries. Answers are sent after `delay`
+    seconds, and those to queries with EDNS carry the EDNS `options`.
+    """
+
+    def __init__(self, drop=False, drop_first=0, truncate=False, delay=0):
+        self.drop = drop
+        self.drop_first = drop_first
+        self.truncate = truncate
+        self.delay = delay
+        self.options = []
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        dnsq = dns.message.from_wire(data)
+        self.queries.append((dnsq, addr))
+        if not self.drop and len(self.queries) > self.drop_first:
+            dnsr = dns.message.make_response(dnsq)
+            if self.truncate:
+                dnsr.flags |= dns.flags.TC
+            if dnsq.edns >= 0:
+                dnsr.use_edns(0, options=self.options)
+            if self.delay:
+                asyncio.get_event_loop().call_later(
+                    self.delay, self.transport.sendto, dnsr.to_wire(), addr
+                )
+            else:
+                self.transport.sendto(dnsr.to_wire(), addr)
+
+
+async def start_fake_resolver_udp(**kwargs):
+    loop = asyncio.get_event_loop()
+    transport, resolver = await loop.create_datagram_endpoint(
+        lambda: FakeResolverUDP(**kwargs), local_addr=("127.0.0.1", 0)
+    )
+    return transport, resolver, transport.get_extra_info("sockname")[1]
+
+
+class FakeResolverTCP(asyncio.Protocol):
+    """A local upstream stand-in over TCP. Queries are answered in reverse
+    order once `server.batch` of them were received on a connection.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = b""
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+
+    def data_received(self, data):
+        self.buffer = utils.handle_dns_tcp_data(self.buffer + data, self.on_query)
+
+    def on_query(self, dnsq):
+        self.server.queries.append(dnsq)
+        if self.server.hangup:
+            self.server.hangup = False
+            self.transport.close()
+            return
+        self.queries.append(dnsq)
+        if len(self.queries) < self.server.batch:
+            return
+        for q in reversed(self.queries):
+            dnsr = dns.message.make_response(q)
+            if self.server.keepalive is not None and q.edns >= 0:
+                dnsr.use_edns(
+                    edns=0,
+                    options=[
+                        dns.edns.GenericOption(
+                            constants.DNS_EDNS_TCP_KEEPALIVE,
+                            struct.pack("!H", self.server.keepalive),
+                        )
+                    ],
+                )
+            msg = dnsr.to_wire()
+            self.transport.write(struct.pack("!H", len(msg)) + msg)
+        self.queries = []
+
+
+class FakeServerTCP:
+    def __init__(self, batch=1, keepalive=None, hangup=False):
+        self.batch = batch
+        self.keepalive = keepalive
+        self.hangup = hangup
+        self.connections = 0
+        self.queries = []
+
+    async def start(self, ssl=None):
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(
+            lambda: FakeResolverTCP(self), host="127.0.0.1", port=0, ssl=ssl
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
 
 
 class TCPTestCase(unittest.TestCase):
@@ -21,67 +150,70 @@ class TCPTestCase(unittest.TestCase):
         self.dnsq = dns.message.make_query("www.example.com", dns.rdatatype.ANY)
         self.dnsr = dns.message.make_response(self.dnsq)
         self.response = self.dnsr.to_wire()
+        self.answer = dnswire.WireMessage(self.response)
+        self.pool = MagicMock(TCPConnectionPool)
+        self.pool.idle_timeout = 10
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_single_valid(self, m_rcv):
         data = struct.pack("!H", len(self.response)) + self.response
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         client_tcp.data_received(data)
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_two_valid(self, m_rcv):
         data = struct.pack("!H", len(self.response)) + self.response
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         client_tcp.data_received(data + data)
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
         self.assertEqual(m_rcv.call_count, 2)
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_partial_valid(self, m_rcv):
         data = struct.pack("!H", len(self.response)) + self.response
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         client_tcp.data_received(data[0:5])
         m_rcv.assert_not_called()
         client_tcp.data_received(data[5:])
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_len_byte(self, m_rcv):
         data = struct.pack("!H", len(self.response)) + self.response
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         client_tcp.data_received(data[0:1])
         m_rcv.assert_not_called()
         client_tcp.data_received(data[1:])
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_complex(self, m_rcv):
         data = struct.pack("!H", len(self.response)) + self.response
         length = len(data)
         data = data * 3
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         client_tcp.data_received(data[0 : length - 3])
         client_tcp.data_received(data[length - 3 : length + 1])
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
         m_rcv.reset_mock()
         client_tcp.data_received(data[length + 1 : 2 * length])
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
         m_rcv.reset_mock()
         client_tcp.data_received(data[2 * length :])
-        m_rcv.assert_called_with(self.dnsr)
+        m_rcv.assert_called_with(self.answer)
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_single_long(self, m_rcv):
         data = struct.pack("!H", len(self.response) - 3) + self.response
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         with self.assertRaises(dns.exception.FormError):
             client_tcp.data_received(data)
 
     @patch.object(DNSClientProtocolTCP, "receive_helper")
     def test_single_short(self, m_rcv):
         data = struct.pack("!H", len(self.response) + 3) + self.response
-        client_tcp = DNSClientProtocolTCP(self.dnsq, [], "10.0.0.0")
+        client_tcp = DNSClientProtocolTCP(self.pool)
         client_tcp.data_received(data)
         m_rcv.assert_not_called()
 
@@ -90,11 +222,1048 @@ class TCPTestCase(unittest.TestCase):
         data = struct.pack("!H", len(self.response)) + self.response
 
         mock_future = unittest.mock.MagicMock(asyncio.Future)
-        client_tcp = DNSClientProtocolTCP(self.dnsq, mock_future, "10.0.0.0")
-        client_tcp.time_stamp = 1000000
+        client_tcp = DNSClientProtocolTCP(self.pool)
+        key = (self.dnsq.id,) + dnswire.question_key(self.response)
+        client_tcp.pending[key] = (mock_future, "10.0.0.0", 1000000)
 
         # If the future is cancelled, set_result raises InvalidStateError.
         mock_future.set_result.side_effect = asyncio.InvalidStateError(
             "CANCELLED: <Future cancelled>"
         )
         client_tcp.data_received(data)
+
+        self.assertEqual(client_tcp.pending, {})
+
+
+class UDPSocketPoolTestCase(asynctest.TestCase):
+    async def setUp(self):
+        self.transport, self.resolver, self.port = await start_fake_resolver_udp()
+        self.pool = UDPSocketPool("127.0.0.1", self.port, 2)
+
+    async def tearDown(self):
+        self.pool.close()
+        self.transport.close()
+
+    async def test_sockets_are_reused(self):
+        """Many queries only use as many sockets as the pool size and each
+        answer goes to the query it belongs to."""
+        queries = [
+            dns.message.make_query("{}.example.com".format(i), dns.rdatatype.A)
+            for i in range(10)
+        ]
+        answers = await asyncio.gather(
+            *[self.pool.query(q, "10.0.0.0", timeout=1) for q in queries]
+        )
+        for q, r in zip(queries, answers):
+            self.assertEqual(q.question, r.message().question)
+        sources = {addr for _, addr in self.resolver.queries}
+        self.assertEqual(len(sources), 2)
+        self.assertEqual(len(self.pool.protocols), 2)
+        for protocol in self.pool.protocols:
+            self.assertEqual(protocol.pending, {})
+
+    @patch.object(UDPSocketPool, "SOCKET_MAX_QUERIES", 3)
+    async def test_sockets_are_rotated(self):
+        """Sockets are replaced by new ones, on new source ports, after
+        SOCKET_MAX_QUERIES queries, and closed once drained."""
+        self.pool.size = 1
+        protocols = []
+        for i in range(7):
+            dnsq = dns.message.make_query("{}.example.com".format(i), "A")
+            await self.pool.query(dnsq, "10.0.0.0", timeout=1)
+            protocols.extend(p for p in self.pool.protocols if p not in protocols)
+        sources = [addr for _, addr in self.resolver.queries]
+        self.assertEqual(len(set(sources)), 3)
+        self.assertEqual(len(set(sources[:3])), 1)
+        self.assertEqual(len(protocols), 3)
+        await asyncio.sleep(0)
+        self.assertEqual(self.pool.protocols, protocols[2:])
+        for protocol in protocols[:2]:
+            self.assertIsNone(protocol.transport)
+
+    async def test_icmp_error_fails_queries(self):
+        """A query to a closed port fails as soon as the ICMP error comes."""
+        self.transport.close()
+        errors = DNSClient.COUNTERS["udp_errors"]
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        start = self.loop.time()
+        self.assertIsNone(await self.pool.query(dnsq, "10.0.0.0", timeout=1))
+        self.assertLess(self.loop.time() - start, 0.5)
+        self.assertGreater(DNSClient.COUNTERS["udp_errors"], errors)
+        for protocol in self.pool.protocols:
+            self.assertEqual(protocol.pending, {})
+
+    async def test_retired_socket_drains(self):
+        """A retired socket is closed once its queries are answered."""
+        self.resolver.drop = True
+        self.pool.size = 1
+        protocol = await self.pool.get_protocol()
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        query = asyncio.ensure_future(self.pool.query(dnsq, "10.0.0.0", timeout=0.2))
+        await asyncio.sleep(0.05)
+        protocol.retire()
+        self.assertFalse(protocol.transport.is_closing())
+        self.assertIsNone(await query)
+        self.assertIsNone(protocol.transport)
+
+    async def test_unexpected_answer_is_discarded(self):
+        protocol = await self.pool.get_protocol()
+        fut = self.loop.create_future()
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        # The query is sent with its own ID, dnsq is left untouched.
+        dnsq.id = protocol.send(dnsq, fut, "10.0.0.0")[0]
+        dnsr = dns.message.make_response(dnsq)
+        dnsr.id = (dnsq.id + 1) % 65536
+        protocol.datagram_received(dnsr.to_wire(), None)
+        self.assertFalse(fut.done())
+        other = dns.message.make_query("other.example.com", dns.rdatatype.A)
+        other.id = dnsq.id
+        protocol.datagram_received(dns.message.make_response(other).to_wire(), None)
+        self.assertFalse(fut.done())
+        protocol.datagram_received(dns.message.make_response(dnsq).to_wire(), None)
+        self.assertTrue(fut.done())
+
+    async def test_timeout(self):
+        self.resolver.drop = True
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        self.assertIsNone(await self.pool.query(dnsq, "10.0.0.0", timeout=0.1))
+        for protocol in self.pool.protocols:
+            self.assertEqual(protocol.pending, {})
+
+    async def test_pool_is_shared(self):
+        pool = UDPSocketPool.get("127.0.0.1", self.port, 2)
+        self.assertIs(pool, UDPSocketPool.get("127.0.0.1", self.port, 2))
+        pool.close()
+
+    async def test_dnsclient_restores_id(self):
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, dnsq.id)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_forwards_wire(self):
+        """The wire query of the client is forwarded, with its own ID, and
+        the parsed query is left untouched."""
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsq.use_edns(0, options=[dns.edns.GenericOption(65001, b"x")])
+        wire = dnsq.to_wire()
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.1", timeout=1, ecs=True, wire=wire)
+        self.assertEqual(dnsr.id, dnsq.id)
+        self.assertEqual(dnsq.to_wire(), wire)
+        upstream_dnsq = self.resolver.queries[0][0]
+        self.assertEqual(upstream_dnsq.options[0].otype, 65001)
+        self.assertEqual(upstream_dnsq.options[1].address, "10.0.0.0")
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_cache(self):
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        with patch.object(DNSClient, "CACHE", DNSCache(65536)):
+            with patch.object(DNSCache, "answer_ttl", return_value=60):
+                await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                dnsq.id += 1
+                dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+            self.assertEqual(dnsr.id, dnsq.id)
+            self.assertEqual(len(self.resolver.queries), 1)
+            self.assertEqual(DNSClient.stats()["cache"]["hits"], 1)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.3)
+    @patch.object(DNSClient, "STALE_ANSWER_TIMEOUT", 0.1)
+    @patch("dohproxy.cache.time")
+    async def test_dnsclient_serve_stale(self, m_time):
+        """An expired answer is served when the upstream is slow, and the
+        cache gets refreshed in the background."""
+        self.resolver.drop_first = 1
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        cache = DNSCache(65536, stale_window=60)
+        key = cache.make_key(dnsq)
+        stale = dns.message.make_response(dnsq)
+        stale.answer.append(
+            dns.rrset.from_text(dnsq.question[0].name, 300, "IN", "A", "192.0.2.1")
+        )
+        m_time.monotonic.return_value = 1000
+        cache.put(key, dnswire.WireMessage(stale.to_wire()))
+        m_time.monotonic.return_value = 1320
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        stale_served = DNSClient.COUNTERS["stale_served"]
+        with patch.object(DNSClient, "CACHE", cache):
+            with patch.object(DNSCache, "answer_ttl", return_value=60):
+                dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                self.assertEqual(dnsr.id, dnsq.id)
+                self.assertEqual(dnsr.answer[0].ttl, DNSCache.STALE_TTL)
+                self.assertEqual(DNSClient.COUNTERS["stale_served"], stale_served + 1)
+                await asyncio.gather(*DNSClient._refreshing)
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertEqual(cache.get(key).ancount, 0)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch("dohproxy.cache.time")
+    async def test_dnsclient_prefetch(self, m_time):
+        """A popular entry about to expire is refreshed in the background
+        while the cached answer is served."""
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        cache = DNSCache(65536, prefetch_min_hits=1)
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        prefetches = DNSClient.COUNTERS["prefetches"]
+        m_time.monotonic.return_value = 1000
+        with patch.object(DNSClient, "CACHE", cache):
+            with patch.object(DNSCache, "answer_ttl", return_value=60):
+                await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                self.assertEqual(DNSClient._prefetching, set())
+                m_time.monotonic.return_value = 1055
+                dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                self.assertEqual(dnsr.id, dnsq.id)
+                self.assertEqual(len(DNSClient._prefetching), 1)
+                await asyncio.gather(*DNSClient._prefetching)
+        self.assertEqual(DNSClient.COUNTERS["prefetches"], prefetches + 1)
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertEqual(cache.entries[cache.make_key(dnsq)].time_stamp, 1055)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(DNSClient, "PREFETCH_CONCURRENCY", 0)
+    @patch("dohproxy.cache.time")
+    async def test_dnsclient_prefetch_concurrency(self, m_time):
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        cache = DNSCache(65536, prefetch_min_hits=1)
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        m_time.monotonic.return_value = 1000
+        with patch.object(DNSClient, "CACHE", cache):
+            with patch.object(DNSCache, "answer_ttl", return_value=60):
+                await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+                m_time.monotonic.return_value = 1055
+                await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(DNSClient._prefetching, set())
+        self.assertEqual(len(self.resolver.queries), 1)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_coalescing(self):
+        """Identical questions in flight at once share one upstream query and
+        get their own message ID back. Queries with and without EDNS are not
+        shared, as the answers to the latter have no OPT record."""
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        queries = [
+            dns.message.make_query("www.example.com", dns.rdatatype.A),
+            dns.message.make_query("www.example.com", dns.rdatatype.A, use_edns=0),
+            dns.message.make_query("www.example.com", dns.rdatatype.A),
+            dns.message.make_query("www.example.com", dns.rdatatype.A, use_edns=0),
+        ]
+        coalesced = DNSClient.COUNTERS["coalesced"]
+        answers = await asyncio.gather(
+            *[dnsclient.query(q, "10.0.0.0", timeout=1) for q in queries]
+        )
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertEqual(DNSClient.COUNTERS["coalesced"], coalesced + 2)
+        for q, r in zip(queries, answers):
+            self.assertEqual(q.id, r.id)
+            self.assertEqual(q.edns, r.edns)
+        self.assertEqual(DNSClient._inflight, {})
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_hop_by_hop_options(self):
+        """EDNS options meant for one client are neither shared with the
+        queries coalesced with its own, nor cached."""
+        self.resolver.options = [
+            dns.edns.GenericOption(
+                constants.DNS_EDNS_COOKIE, b"\x01" * 8 + b"\x02" * 16
+            ),
+            dns.edns.GenericOption(constants.DNS_EDNS_NSID, b"ns1"),
+        ]
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        queries = [
+            dns.message.make_query("www.example.com", "A", use_edns=0)
+            for _ in range(3)
+        ]
+        queries[0].use_edns(
+            0, options=[dns.edns.GenericOption(constants.DNS_EDNS_COOKIE, b"\x01" * 8)]
+        )
+        with patch.object(DNSClient, "CACHE", DNSCache(65536)):
+            with patch.object(DNSCache, "answer_ttl", return_value=60):
+                answers = await asyncio.gather(
+                    *[dnsclient.query(q, "10.0.0.0", timeout=1) for q in queries[:2]]
+                )
+                answers.append(
+                    await dnsclient.query(queries[2], "10.0.0.0", timeout=1)
+                )
+        self.assertEqual(len(self.resolver.queries), 1)
+        for r in answers:
+            self.assertEqual(r.edns, 0)
+            self.assertEqual(len(r.options), 0)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_coalescing_timeout(self):
+        self.resolver.drop = True
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        answers = await asyncio.gather(
+            dnsclient.query(dnsq, "10.0.0.0", timeout=0.2),
+            dnsclient.query(dnsq, "10.0.0.0", timeout=0.1),
+        )
+        self.assertEqual(answers, [None, None])
+        self.assertEqual(len(self.resolver.queries), 1)
+        self.assertEqual(DNSClient._inflight, {})
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamLimit, "_registry", {})
+    @patch.object(UpstreamLimit, "MAX_OUTSTANDING", 1)
+    @patch.object(UpstreamLimit, "MAX_QUEUED", 1)
+    async def test_dnsclient_shed(self):
+        """Queries past the outstanding limit wait in a bounded queue, and
+        are shed when it is full."""
+        self.resolver.drop = True
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        results = await asyncio.gather(
+            *[
+                dnsclient.query(
+                    dns.message.make_query("{}.example.com".format(i), "A"),
+                    "10.0.0.0",
+                    timeout=timeout,
+                )
+                for i, timeout in enumerate([0.1, 0.3, 0.3])
+            ],
+            return_exceptions=True,
+        )
+        self.assertIsNone(results[0])
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], UpstreamOverloaded)
+        self.assertEqual(
+            {q.question[0].name.to_text() for q, _ in self.resolver.queries},
+            {"0.example.com.", "1.example.com."},
+        )
+        limit = UpstreamLimit.get((("127.0.0.1", self.port),))
+        self.assertEqual(limit.stats(), {"outstanding": 0, "queued": 0, "shed": 1})
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "EXPLORATION", 0)
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.1)
+    async def test_dnsclient_failover(self):
+        """A query to a dead upstream fails over to the next one."""
+        transport, dead, dead_port = await start_fake_resolver_udp(drop=True)
+        dnsclient = DNSClient(
+            ["127.0.0.1:{}".format(dead_port), "127.0.0.1:{}".format(self.port)], 53
+        )
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+        self.assertEqual(dnsr.id, dnsq.id)
+        self.assertEqual(len(dead.queries), 1)
+        self.assertEqual(UpstreamHealth.get(("127.0.0.1", dead_port)).errors, 1)
+        self.assertEqual(UpstreamHealth.get(("127.0.0.1", self.port)).errors, 0)
+        # The dead upstream is now ranked last
+        dnsq = dns.message.make_query("www2.example.com", dns.rdatatype.A)
+        await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+        self.assertEqual(len(dead.queries), 1)
+        transport.close()
+        UDPSocketPool.get("127.0.0.1", dead_port, 1).close()
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_circuit_open(self):
+        """Upstreams whose circuit is open are skipped, and queries fail at
+        once when all of them are."""
+        transport, dead, dead_port = await start_fake_resolver_udp(drop=True)
+        dnsclient = DNSClient(
+            ["127.0.0.1:{}".format(dead_port), "127.0.0.1:{}".format(self.port)], 53
+        )
+        dead_health = UpstreamHealth.get(("127.0.0.1", dead_port))
+        with patch.object(dead_health, "state", UpstreamHealth.OPEN), patch.object(
+            dead_health, "opened_at", self.loop.time() + 60
+        ):
+            dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+            dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+            self.assertEqual(dnsr.id, dnsq.id)
+            self.assertEqual(dead.queries, [])
+            dnsclient = DNSClient("127.0.0.1:{}".format(dead_port), 53)
+            start = self.loop.time()
+            self.assertIsNone(await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5))
+            self.assertLess(self.loop.time() - start, 0.1)
+        transport.close()
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "EXPLORATION", 0)
+    @patch.object(UpstreamHealth, "BREAKER_ERROR_RATE", 0.5)
+    async def test_dnsclient_circuit_recovers(self):
+        """An upstream whose circuit is half-open gets the probes, and
+        recovers, while another one answers."""
+        transport, recovered, recovered_port = await start_fake_resolver_udp()
+        dnsclient = DNSClient(
+            [
+                "127.0.0.1:{}".format(self.port),
+                "127.0.0.1:{}".format(recovered_port),
+            ],
+            53,
+        )
+        UpstreamHealth.get(("127.0.0.1", self.port)).record_success(0.001)
+        health = UpstreamHealth.get(("127.0.0.1", recovered_port))
+        while health.state == UpstreamHealth.CLOSED:
+            health.record_failure()
+        health.opened_at -= UpstreamHealth.BREAKER_COOLDOWN
+        for i in range(UpstreamHealth.BREAKER_PROBES):
+            dnsq = dns.message.make_query("{}.example.com".format(i), "A")
+            await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+        self.assertEqual(len(recovered.queries), UpstreamHealth.BREAKER_PROBES)
+        self.assertEqual(health.state, UpstreamHealth.CLOSED)
+        transport.close()
+        UDPSocketPool.get("127.0.0.1", recovered_port, 1).close()
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.05)
+    @patch.object(UpstreamHealth, "BREAKER_ERROR_RATE", 0.5)
+    async def test_dnsclient_slow_upstream_circuit_closed(self):
+        """An upstream answering every query, but slower than its RTO, does
+        not get its circuit opened."""
+        transport, slow, slow_port = await start_fake_resolver_udp(delay=0.2)
+        dnsclient = DNSClient("127.0.0.1:{}".format(slow_port), 53)
+        for wave in range(2):
+            queries = [
+                dns.message.make_query("{}-{}.example.com".format(wave, i), "A")
+                for i in range(10)
+            ]
+            answers = await asyncio.gather(
+                *[dnsclient.query(q, "10.0.0.0", timeout=1) for q in queries]
+            )
+            self.assertNotIn(None, answers)
+        health = UpstreamHealth.get(("127.0.0.1", slow_port))
+        self.assertEqual(health.state, UpstreamHealth.CLOSED)
+        self.assertEqual(health.errors, 0)
+        transport.close()
+        UDPSocketPool.get("127.0.0.1", slow_port, 1).close()
+
+    @patch.object(DNSClient, "_truncated", collections.OrderedDict())
+    async def test_dnsclient_truncated_memory(self):
+        """Questions whose answer came back truncated go straight to TCP."""
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.TXT)
+        dnsr = dns.message.make_response(dnsq)
+        dnsr.flags |= dns.flags.TC
+        truncated = dnswire.WireMessage(dnsr.to_wire())
+        answer = dnswire.WireMessage(dns.message.make_response(dnsq).to_wire())
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        with asynctest.patch.object(
+            dnsclient, "query_udp", return_value=truncated
+        ) as query_udp, asynctest.patch.object(
+            dnsclient, "query_tcp", return_value=answer
+        ) as query_tcp:
+            for _ in range(2):
+                dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+                self.assertEqual(dnsr, answer.message())
+            self.assertEqual(query_udp.call_count, 1)
+            self.assertEqual(query_tcp.call_count, 2)
+            # The DO bit is part of the key
+            dnsq.want_dnssec()
+            await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+            self.assertEqual(query_udp.call_count, 2)
+
+    @patch.object(UpstreamHealth, "_registry", {})
+    @patch.object(DNSClient, "_truncated", collections.OrderedDict())
+    async def test_dnsclient_edns_payload(self):
+        """A truncated answer to the small payload size, after the large one
+        got nothing, lowers the payload size of the upstream."""
+        self.resolver.drop_first = 1
+        dnsq = dns.message.make_query("www.example.com", "A", use_edns=0)
+        health = UpstreamHealth.get(("127.0.0.1", self.port))
+        health.record_success(0.01)
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        self.resolver.truncate = True
+        await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5)
+        payloads = [q.payload for q, _ in self.resolver.queries[:2]]
+        self.assertEqual(payloads, [4096, constants.DNS_EDNS_PAYLOAD])
+        self.assertEqual(health.edns_payload(), constants.DNS_EDNS_PAYLOAD)
+        self.assertEqual(health.payload_losses, 1)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+        TCPConnectionPool.get("127.0.0.1", self.port, 1, 1).close()
+
+    @patch.object(UpstreamHealth, "EXPLORATION", 0)
+    @patch.object(UpstreamHealth, "HEDGE_MAX_DELAY", 0.05)
+    @patch.object(DNSClient, "HEDGE", True)
+    async def test_dnsclient_hedging(self):
+        """A slow upstream gets its query hedged to the next one, whose answer
+        wins."""
+        transport, dead, dead_port = await start_fake_resolver_udp(drop=True)
+        dead_upstream = ("127.0.0.1", dead_port)
+        dnsclient = DNSClient(["127.0.0.1:{}".format(dead_port)], 53)
+        dnsclient.upstreams.append(("127.0.0.1", self.port))
+        hedged = DNSClient.COUNTERS["hedged"]
+        hedge_wins = DNSClient.COUNTERS["hedge_wins"]
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, dnsq.id)
+        self.assertEqual(len(dead.queries), 1)
+        self.assertEqual(len(self.resolver.queries), 1)
+        self.assertEqual(DNSClient.COUNTERS["hedged"], hedged + 1)
+        self.assertEqual(DNSClient.COUNTERS["hedge_wins"], hedge_wins + 1)
+        # The losing query was cancelled and forgotten
+        dead_pool = UDPSocketPool.get(*dead_upstream, 1)
+        self.assertEqual(dead_pool.protocols[0].pending, {})
+        self.assertEqual(UpstreamHealth.get(dead_upstream).errors, 0)
+        transport.close()
+        dead_pool.close()
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.05)
+    @patch.object(UpstreamHealth, "HEDGE_MAX_DELAY", 0.05)
+    @patch.object(DNSClient, "HEDGE", True)
+    async def test_dnsclient_hedge_lost(self):
+        """An answer to a retransmission after the hedge is no hedge win."""
+        self.resolver.drop_first = 2
+        hedged = DNSClient.COUNTERS["hedged"]
+        hedge_wins = DNSClient.COUNTERS["hedge_wins"]
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, dnsq.id)
+        self.assertEqual(len(self.resolver.queries), 3)
+        self.assertEqual(DNSClient.COUNTERS["hedged"], hedged + 1)
+        self.assertEqual(DNSClient.COUNTERS["hedge_wins"], hedge_wins)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.1)
+    async def test_dnsclient_retransmit(self):
+        """A lost datagram is retransmitted after the RTO."""
+        self.resolver.drop_first = 1
+        retransmits = DNSClient.COUNTERS["retransmits"]
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, dnsq.id)
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertEqual(DNSClient.COUNTERS["retransmits"], retransmits + 1)
+        protocol = UDPSocketPool.get("127.0.0.1", self.port, 1).protocols[0]
+        self.assertEqual(protocol.pending, {})
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.1)
+    async def test_dnsclient_late_answer(self):
+        """A query answered just after its RTO expired counts as answered
+        only."""
+        transport, slow, slow_port = await start_fake_resolver_udp(delay=0.15)
+        dnsclient = DNSClient("127.0.0.1:{}".format(slow_port), 53)
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, dnsq.id)
+        self.assertEqual(len(slow.queries), 2)
+        health = UpstreamHealth.get(("127.0.0.1", slow_port))
+        self.assertEqual((health.queries, health.errors), (1, 0))
+        transport.close()
+        UDPSocketPool.get("127.0.0.1", slow_port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.05)
+    @patch.object(DNSClient, "RETRANSMIT_BUDGET", 0)
+    @patch.object(DNSClient, "RETRANSMIT_BUDGET_MIN", 1)
+    async def test_dnsclient_retransmit_budget(self):
+        """Retransmissions past the budget are skipped."""
+        self.resolver.drop = True
+        over_budget = DNSClient.COUNTERS["retransmits_over_budget"]
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        answers = await asyncio.gather(
+            *[
+                dnsclient.query(
+                    dns.message.make_query("{}.example.com".format(i), "A"),
+                    "10.0.0.0",
+                    timeout=0.3,
+                )
+                for i in range(5)
+            ]
+        )
+        self.assertEqual(answers, [None] * 5)
+        # One transmission each, and a single retransmission, whose query
+        # kept the budget until its deadline.
+        self.assertEqual(len(self.resolver.queries), 6)
+        self.assertGreater(DNSClient.COUNTERS["retransmits_over_budget"], over_budget)
+        self.assertEqual(DNSClient._retransmissions, 0)
+        self.assertEqual(DNSClient._udp_queries, 0)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    @patch.object(UpstreamHealth, "RTO_INITIAL", 0.1)
+    async def test_dnsclient_deadline(self):
+        """UDP is retransmitted with a backoff and the whole query, TCP
+        fallback included, gives up at the deadline."""
+        self.resolver.drop = True
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        start = self.loop.time()
+        self.assertIsNone(await dnsclient.query(dnsq, "10.0.0.0", timeout=0.5))
+        self.assertLess(self.loop.time() - start, 0.8)
+        # RTO_MIN, twice RTO_MIN then the third transmission waits the rest
+        # of the time
+        self.assertEqual(len(self.resolver.queries), DNSClient.UDP_TRANSMISSIONS)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+    async def test_dnsclient_ecs_restores_edns(self):
+        """A client that did not use EDNS gets an answer without EDNS, even
+        though ECS was added upstream."""
+        dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+        dnsclient = DNSClient("127.0.0.1", self.port)
+        dnsr = await dnsclient.query(dnsq, "10.0.0.1", timeout=1, ecs=True)
+        self.assertEqual(self.resolver.queries[0][0].options[0].otype, dns.edns.ECS)
+        self.assertEqual(dnsr.edns, -1)
+        UDPSocketPool.get("127.0.0.1", self.port, 1).close()
+
+
+class TCPConnectionPoolTestCase(asynctest.TestCase):
+    async def setUp(self):
+        self.server = FakeServerTCP()
+        await self.server.start()
+        self.pool = TCPConnectionPool("127.0.0.1", self.server.port, 2, 10)
+
+    async def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def make_queries(self, count, **kwargs):
+        return [
+            dns.message.make_query(
+                "{}.example.com".format(i), dns.rdatatype.A, **kwargs
+            )
+            for i in range(count)
+        ]
+
+    async def test_connection_is_reused(self):
+        for q in self.make_queries(3):
+            r = await self.pool.query(q, "10.0.0.0", timeout=1)
+            self.assertEqual(q.question, r.message().question)
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_pipelined_out_of_order(self):
+        """Answers coming back in reverse order go to the right query."""
+        self.server.batch = 2
+        self.pool.size = 1
+        queries = self.make_queries(2)
+        answers = await asyncio.gather(
+            *[self.pool.query(q, "10.0.0.0", timeout=1) for q in queries]
+        )
+        for q, r in zip(queries, answers):
+            self.assertEqual(q.question, r.message().question)
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_slow_connect(self):
+        """Queries waiting for a connection being opened give up at their
+        own timeout."""
+        connect = self.pool.connect
+
+        async def slow_connect():
+            await asyncio.sleep(1)
+            return await connect()
+
+        with patch.object(self.pool, "connect", slow_connect):
+            slow = asyncio.ensure_future(
+                self.pool.query(self.make_queries(1)[0], "10.0.0.0", timeout=3)
+            )
+            await asyncio.sleep(0)
+            start = self.loop.time()
+            self.assertIsNone(
+                await self.pool.query(self.make_queries(1)[0], "10.0.0.0", timeout=0.2)
+            )
+            self.assertLess(self.loop.time() - start, 0.5)
+            self.assertIsNotNone(await slow)
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_shared_connect_outlives_first_query(self):
+        """A connection being opened is not given up when the query which
+        started it times out, while other queries wait for it."""
+        connect = self.pool.connect
+
+        async def slow_connect():
+            await asyncio.sleep(0.5)
+            return await connect()
+
+        with patch.object(self.pool, "connect", slow_connect):
+            fast = asyncio.ensure_future(
+                self.pool.query(self.make_queries(1)[0], "10.0.0.0", timeout=0.2)
+            )
+            await asyncio.sleep(0)
+            start = self.loop.time()
+            self.assertIsNotNone(
+                await self.pool.query(self.make_queries(1)[0], "10.0.0.0", timeout=3)
+            )
+            self.assertLess(self.loop.time() - start, 0.9)
+            self.assertIsNone(await fast)
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_keepalive_is_hop_by_hop(self):
+        self.server.keepalive = 5
+        q = self.make_queries(1, use_edns=0)[0]
+        r = await self.pool.query(q, "10.0.0.0", timeout=1)
+        self.assertIn(
+            constants.DNS_EDNS_TCP_KEEPALIVE,
+            [o.otype for o in self.server.queries[0].options],
+        )
+        self.assertEqual(r.options, {})
+        self.assertEqual(self.pool.protocols[0].idle_timeout, 0.5)
+
+    async def test_no_keepalive_without_edns(self):
+        q = self.make_queries(1)[0]
+        await self.pool.query(q, "10.0.0.0", timeout=1)
+        self.assertEqual(self.server.queries[0].edns, -1)
+
+    async def test_keepalive_zero_closes(self):
+        self.server.keepalive = 0
+        q = self.make_queries(1, use_edns=0)[0]
+        await self.pool.query(q, "10.0.0.0", timeout=1)
+        await asyncio.sleep(0)
+        self.assertEqual(self.pool.protocols, [])
+
+    async def test_reconnect_on_eof(self):
+        self.server.hangup = True
+        q = self.make_queries(1)[0]
+        r = await self.pool.query(q, "10.0.0.0", timeout=1)
+        self.assertEqual(q.question, r.message().question)
+        self.assertEqual(self.server.connections, 2)
+
+    async def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.05
+        q = self.make_queries(1)[0]
+        await self.pool.query(q, "10.0.0.0", timeout=1)
+        self.assertEqual(len(self.pool.protocols), 1)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.pool.protocols, [])
+
+    async def test_connection_refused(self):
+        self.server.close()
+        await self.server.server.wait_closed()
+        q = self.make_queries(1)[0]
+        self.assertIsNone(await self.pool.query(q, "10.0.0.0", timeout=1))
+
+
+def server_ssl_context():
+    """The TLS context of the stand-in upstreams, with a certificate for
+    127.0.0.1 signed by data/ca.pem.
+    """
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(os.path.join(DATA_DIR, "server.pem"))
+    return ctx
+
+
+class TLSConnectionPoolTestCase(asynctest.TestCase):
+    async def setUp(self):
+        patcher = patch.object(
+            TLSConnectionPool, "CAFILE", os.path.join(DATA_DIR, "ca.pem")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = FakeServerTCP()
+        await self.server.start(ssl=server_ssl_context())
+        self.pool = TLSConnectionPool("127.0.0.1", self.server.port, 2, 10)
+        self.dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+
+    async def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    async def test_query(self):
+        for _ in range(2):
+            r = await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+            self.assertEqual(self.dnsq.question, r.message().question)
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_session_resumption(self):
+        resumptions = DNSClient.COUNTERS["tls_resumptions"]
+        await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+        self.assertIsNotNone(self.pool.ssl_context.session)
+        self.pool.close()
+        r = await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(self.dnsq.question, r.message().question)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(DNSClient.COUNTERS["tls_resumptions"], resumptions + 1)
+
+    async def test_untrusted_certificate(self):
+        with patch.object(TLSConnectionPool, "CAFILE", None):
+            pool = TLSConnectionPool("127.0.0.1", self.server.port, 2, 10)
+        self.assertIsNone(await pool.query(self.dnsq, "10.0.0.0", timeout=1))
+        self.assertEqual(pool.protocols, [])
+
+    async def test_dnsclient_tls_upstream(self):
+        """Upstreams given as tls:// are queried over TLS, first when they
+        rank best."""
+        transport, resolver, port = await start_fake_resolver_udp()
+        dnsclient = DNSClient(
+            [
+                "tls://127.0.0.1:{}".format(self.server.port),
+                "127.0.0.1:{}".format(port),
+            ],
+            53,
+        )
+        self.assertEqual(dnsclient.tls_upstreams, {("127.0.0.1", self.server.port)})
+        with patch.object(UpstreamHealth, "rank", side_effect=list):
+            dnsr = await dnsclient.query(self.dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, self.dnsq.id)
+        self.assertEqual(len(self.server.queries), 1)
+        self.assertEqual(resolver.queries, [])
+        TLSConnectionPool.get("127.0.0.1", self.server.port, 1, 1).close()
+        transport.close()
+
+
+class HTTPSConnectionPoolTestCase(asynctest.TestCase):
+    """The DOH upstream stand-in is the H2Protocol of doh-proxy itself,
+    forwarding to a FakeResolverUDP.
+    """
+
+    async def setUp(self):
+        patcher = patch.object(
+            UpstreamPool, "CAFILE", os.path.join(DATA_DIR, "ca.pem")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.udp_transport, self.resolver, udp_port = await start_fake_resolver_udp()
+        ssl_context = server_ssl_context()
+        ssl_context.set_alpn_protocols(["h2"])
+        self.connections = 0
+
+        def protocol_factory():
+            self.connections += 1
+            return H2Protocol(
+                upstream_resolver="127.0.0.1", upstream_port=udp_port,
+            )
+
+        self.server = await self.loop.create_server(
+            protocol_factory, host="127.0.0.1", port=0, ssl=ssl_context
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.pool = HTTPSConnectionPool("127.0.0.1", self.port, 2)
+        self.dnsq = dns.message.make_query("www.example.com", dns.rdatatype.A)
+
+    async def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        self.udp_transport.close()
+        UDPSocketPool._pools.clear()
+
+    async def test_query(self):
+        for _ in range(2):
+            r = await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+            self.assertEqual(self.dnsq.question, r.message().question)
+        self.assertEqual(self.connections, 1)
+        self.assertEqual(self.pool.authority, "127.0.0.1:{}".format(self.port))
+        self.assertIsNotNone(self.pool.ssl_context.session)
+
+    async def test_concurrent_queries(self):
+        answers = await asyncio.gather(
+            *[self.pool.query(self.dnsq, "10.0.0.0", timeout=1) for _ in range(10)]
+        )
+        self.assertNotIn(None, answers)
+        self.assertEqual(self.connections, 1)
+
+    async def test_wrong_path(self):
+        r = await self.pool.query(self.dnsq, "10.0.0.0", timeout=1, path="/foo")
+        self.assertIsNone(r)
+
+    async def test_shared_connect_outlives_first_query(self):
+        """A connection being opened is shared by the queries waiting for it,
+        and is not cancelled when the query which started it times out."""
+        connect = self.pool.connect
+        connects = []
+
+        async def slow_connect():
+            connects.append(None)
+            await asyncio.sleep(0.5)
+            return await connect()
+
+        with patch.object(self.pool, "connect", slow_connect):
+            fast = asyncio.ensure_future(
+                self.pool.query(self.dnsq, "10.0.0.0", timeout=0.2)
+            )
+            await asyncio.sleep(0)
+            start = self.loop.time()
+            self.assertIsNotNone(await self.pool.query(self.dnsq, "10.0.0.0"))
+            self.assertLess(self.loop.time() - start, 0.9)
+            self.assertIsNone(await fast)
+        self.assertEqual(len(connects), 1)
+        self.assertEqual(self.connections, 1)
+
+    @patch.object(HTTPSConnectionPool, "MAX_STREAMS", 4)
+    @patch.object(HTTPSConnectionPool, "REPLACEMENT_MARGIN", 2)
+    async def test_connection_is_replaced(self):
+        """A connection is replaced before it reaches MAX_STREAMS, and closed
+        once it did."""
+        for _ in range(3):
+            await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+        first = self.pool.protocols[0]
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.connections, 2)
+        self.assertEqual(len(self.pool.protocols), 2)
+        await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(first.streams, 4)
+        await asyncio.sleep(0.1)
+        self.assertFalse(first.alive())
+        r = await self.pool.query(self.dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(self.dnsq.question, r.message().question)
+        self.assertEqual(self.connections, 2)
+        self.assertNotIn(first, self.pool.protocols)
+
+    async def test_dnsclient_https_upstream(self):
+        dnsclient = DNSClient(["https://127.0.0.1:{}".format(self.port)], 53)
+        self.assertEqual(
+            dnsclient.https_upstreams, {("127.0.0.1", self.port): constants.DOH_URI}
+        )
+        dnsr = await dnsclient.query(self.dnsq, "10.0.0.0", timeout=1)
+        self.assertEqual(dnsr.id, self.dnsq.id)
+        self.assertEqual(len(self.resolver.queries), 1)
+        HTTPSConnectionPool.get("127.0.0.1", self.port, 1).close()
+
+
+class H2ProtocolTestCase(asynctest.TestCase):
+    """Drive an H2Protocol with an h2 client connection over a mocked
+    transport.
+    """
+
+    async def setUp(self):
+        self.transport = MagicMock()
+        self.transport.is_closing.return_value = False
+        self.transport.get_extra_info.return_value = ("127.0.0.1", 12345)
+        self.protocol = H2Protocol(
+            upstream_resolver="127.0.0.1", upstream_port=53, stats_uri="/stats",
+        )
+        self.protocol.connection_made(self.transport)
+        self.client = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=True)
+        )
+        self.client.initiate_connection()
+
+    def request(self, path):
+        stream_id = self.client.get_next_available_stream_id()
+        self.client.send_headers(
+            stream_id,
+            [
+                (":method", "GET"),
+                (":scheme", "https"),
+                (":authority", "localhost"),
+                (":path", path),
+            ],
+            end_stream=True,
+        )
+        return stream_id
+
+    def receive(self):
+        """Feed the client with what the protocol wrote.
+        :return: the events of the client.
+        """
+        events = []
+        for args, _ in self.transport.write.call_args_list:
+            events += self.client.receive_data(args[0])
+        self.transport.write.reset_mock()
+        return events
+
+    async def test_coalesced_writes(self):
+        # The connection preface.
+        self.receive()
+        stream_ids = [self.request("/nope") for _ in range(3)]
+        self.protocol.data_received(self.client.data_to_send())
+        self.transport.write.assert_not_called()
+        await asyncio.sleep(0)
+        self.assertEqual(self.transport.write.call_count, 1)
+        ended = [
+            e.stream_id for e in self.receive() if isinstance(e, h2.events.StreamEnded)
+        ]
+        self.assertEqual(ended, stream_ids)
+
+    async def test_flow_control(self):
+        self.client.update_settings({h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: 8})
+        stream_id = self.request("/stats")
+        self.protocol.data_received(self.client.data_to_send())
+        await asyncio.sleep(0)
+        events = self.receive()
+        body = b"".join(
+            e.data for e in events if isinstance(e, h2.events.DataReceived)
+        )
+        self.assertEqual(len(body), 8)
+        self.assertIn(stream_id, self.protocol.pending_data)
+
+        self.client.increment_flow_control_window(65535, stream_id=stream_id)
+        self.protocol.data_received(self.client.data_to_send())
+        await asyncio.sleep(0)
+        events = self.receive()
+        body += b"".join(
+            e.data for e in events if isinstance(e, h2.events.DataReceived)
+        )
+        self.assertTrue(any(isinstance(e, h2.events.StreamEnded) for e in events))
+        self.assertIn(b"upstreams", body)
+        self.assertNotIn(stream_id, self.protocol.pending_data)
+
+    async def test_pause_writing(self):
+        self.receive()
+        self.protocol.pause_writing()
+        self.transport.pause_reading.assert_called_once()
+        self.request("/nope")
+        self.protocol.data_received(self.client.data_to_send())
+        await asyncio.sleep(0)
+        self.transport.write.assert_not_called()
+
+        self.protocol.resume_writing()
+        self.transport.resume_reading.assert_called_once()
+        await asyncio.sleep(0)
+        self.assertEqual(self.transport.write.call_count, 1)
+
+    async def test_stream_state_freed(self):
+        self.request("/nope")
+        self.protocol.data_received(self.client.data_to_send())
+        self.assertEqual(self.protocol.stream_data, {})
+
+        stream_id = self.client.get_next_available_stream_id()
+        self.client.send_headers(
+            stream_id,
+            [
+                (":method", "POST"),
+                (":scheme", "https"),
+                (":authority", "localhost"),
+                (":path", "/dns-query"),
+            ],
+        )
+        self.protocol.data_received(self.client.data_to_send())
+        self.assertIn(stream_id, self.protocol.stream_data)
+        self.client.reset_stream(stream_id)
+        self.protocol.data_received(self.client.data_to_send())
+        self.assertEqual(self.protocol.stream_data, {})
+
+    async def test_headers_too_large(self):
+        """Headers larger than MAX_HEADER_LIST_SIZE are refused."""
+        self.receive()
+        stream_id = self.client.get_next_available_stream_id()
+        self.client.send_headers(
+            stream_id,
+            [
+                (":method", "GET"),
+                (":scheme", "https"),
+                (":authority", "localhost"),
+                (":path", "/dns-query"),
+            ]
+            + [("x-padding-{}".format(i), "x" * 1000) for i in range(40)],
+            end_stream=True,
+        )
+        self.protocol.data_received(self.client.data_to_send())
+        events = self.receive()
+        self.assertTrue(
+            any(isinstance(e, h2.events.ConnectionTerminated) for e in events)
+        )
+        self.transport.close.assert_called_once()
+        self.assertEqual(self.protocol.stream_data, {})
+
+    async def test_body_too_large(self):
+        self.receive()
+        stream_id = self.client.get_next_available_stream_id()
+        self.client.send_headers(
+            stream_id,
+            [
+                (":method", "POST"),
+                (":scheme", "https"),
+                (":authority", "localhost"),
+                (":path", "/dns-query"),
+                ("content-type", constants.DOH_MEDIA_TYPE),
+            ],
+        )
+        self.client.send_data(stream_id, b"\0" * 16384)
+        # Beyond the initial windows, which are given back as data comes in.
+        for _ in range(4):
+            self.protocol.data_received(self.client.data_to_send())
+            await asyncio.sleep(0)
+            events = self.receive()
+            if stream_id not in self.protocol.stream_data:
+                break
+            self.client.send_data(stream_id, b"\0" * 16384)
+        responses = [e for e in events if isinstance(e, h2.events.ResponseReceived)]
+        self.assertEqual(dict(responses[0].headers)[b":status"], b"413")
+        self.assertEqual(self.protocol.stream_data, {})
+        # The client is told to stop sending the body.
+        resets = [e for e in events if isinstance(e, h2.events.StreamReset)]
+        self.assertEqual(resets[0].stream_id, stream_id)
+        self.assertEqual(resets[0].error_code, h2.errors.ErrorCodes.NO_ERROR)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import asyncio
+import unittest
+from unittest.mock import patch
+
+import asynctest
+from dohproxy.upstream import UpstreamHealth, UpstreamLimit, UpstreamOverloaded
+
+
+class UpstreamHealthTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(UpstreamHealth, "_registry", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fast = ("10.0.0.1", 53)
+        self.slow = ("10.0.0.2", 53)
+        self.unknown = ("10.0.0.3", 53)
+
+    def test_smoothed_rtt(self):
+        health = UpstreamHealth.get(self.fast)
+        health.record_success(0.1)
+        self.assertEqual(health.srtt, 0.1)
+        health.record_success(0.9)
+        self.assertAlmostEqual(health.srtt, 0.2)
+        self.assertIs(health, UpstreamHealth.get(self.fast))
+
+    def test_error_rate(self):
+        health = UpstreamHealth.get(self.fast)
+        health.record_success(0.1)
+        score = health.score()
+        health.record_failure()
+        self.assertGreater(health.score(), score)
+        for _ in range(50):
+            health.record_success(0.1)
+        self.assertLess(health.error_rate, 0.01)
+        self.assertEqual(health.stats()["errors"], 1)
+
+    @patch.object(UpstreamHealth, "EXPLORATION", 0)
+    def test_rank(self):
+        UpstreamHealth.get(self.fast).record_success(0.01)
+        UpstreamHealth.get(self.slow).record_success(0.1)
+        self.assertEqual(
+            UpstreamHealth.rank([self.slow, self.fast]), [self.fast, self.slow]
+        )
+        # Never measured upstreams are tried first
+        self.assertEqual(
+            UpstreamHealth.rank([self.slow, self.fast, self.unknown])[0],
+            self.unknown,
+        )
+        # A failing upstream loses its rank
+        for _ in range(10):
+            UpstreamHealth.get(self.fast).record_failure()
+        self.assertEqual(
+            UpstreamHealth.rank([self.slow, self.fast]), [self.slow, self.fast]
+        )
+
+    @patch.object(UpstreamHealth, "EXPLORATION", 1)
+    def test_rank_exploration(self):
+        UpstreamHealth.get(self.fast).record_success(0.01)
+        UpstreamHealth.get(self.slow).record_success(0.1)
+        self.assertEqual(
+            UpstreamHealth.rank([self.slow, self.fast]), [self.slow, self.fast]
+        )
+
+    def test_report(self):
+        UpstreamHealth.get(self.fast).record_success(0.01)
+        self.assertEqual(UpstreamHealth.report()["10.0.0.1:53"]["srtt_ms"], 10)
+
+    def test_hedge_delay(self):
+        health = UpstreamHealth.get(self.fast)
+        self.assertEqual(health.hedge_delay(95), UpstreamHealth.HEDGE_MAX_DELAY)
+        for i in range(100):
+            health.record_success((i + 1) / 1000)
+        self.assertEqual(health.rtt_percentile(50), 0.051)
+        self.assertEqual(health.hedge_delay(95), 0.096)
+        health.record_success(0.0001)
+        self.assertEqual(health.hedge_delay(0), UpstreamHealth.HEDGE_MIN_DELAY)
+
+    def test_rto(self):
+        health = UpstreamHealth.get(self.fast)
+        self.assertEqual(health.rto(), UpstreamHealth.RTO_INITIAL)
+        health.record_success(0.2)
+        # srtt + 4 * rttvar = 0.2 + 4 * 0.1
+        self.assertAlmostEqual(health.rto(), 0.6)
+        for _ in range(100):
+            health.record_success(0.001)
+        self.assertEqual(health.rto(), UpstreamHealth.RTO_MIN)
+        for _ in range(100):
+            health.record_success(10)
+        self.assertEqual(health.rto(), UpstreamHealth.RTO_MAX)
+
+    @patch.object(UpstreamHealth, "BREAKER_ERROR_RATE", 0.5)
+    @patch("dohproxy.upstream.time.monotonic")
+    def test_circuit_breaker(self, m_monotonic):
+        m_monotonic.return_value = 100.0
+        health = UpstreamHealth.get(self.fast)
+        while health.state == UpstreamHealth.CLOSED:
+            self.assertTrue(health.allow())
+            health.record_failure()
+        self.assertEqual(health.state, UpstreamHealth.OPEN)
+        self.assertEqual(health.queries, UpstreamHealth.BREAKER_MIN_FAILURES)
+        self.assertTrue(health.is_open())
+        self.assertFalse(health.allow())
+        # Half-open after the cooldown, a failed probe opens the circuit again
+        m_monotonic.return_value += UpstreamHealth.BREAKER_COOLDOWN
+        self.assertFalse(health.is_open())
+        self.assertTrue(health.wants_probe())
+        self.assertTrue(health.allow())
+        self.assertEqual(health.state, UpstreamHealth.HALF_OPEN)
+        health.record_failure()
+        self.assertEqual(health.state, UpstreamHealth.OPEN)
+        # Only BREAKER_PROBES probes are let through, which close it
+        m_monotonic.return_value += UpstreamHealth.BREAKER_COOLDOWN
+        for _ in range(UpstreamHealth.BREAKER_PROBES):
+            self.assertFalse(health.is_open())
+            self.assertTrue(health.allow())
+        self.assertTrue(health.is_open())
+        self.assertFalse(health.allow())
+        for _ in range(UpstreamHealth.BREAKER_PROBES):
+            health.record_success(0.01)
+        self.assertEqual(health.state, UpstreamHealth.CLOSED)
+        self.assertTrue(health.allow())
+        self.assertEqual(health.stats()["circuit_trips"], 2)
+
+    @patch.object(UpstreamHealth, "BREAKER_ERROR_RATE", 0.5)
+    @patch("dohproxy.upstream.time.monotonic")
+    def test_circuit_breaker_window(self, m_monotonic):
+        """Only the failures of the last BREAKER_WINDOW seconds count, against
+        the answers of the same seconds, and misses never do."""
+        m_monotonic.return_value = 100.0
+        health = UpstreamHealth.get(self.fast)
+        for _ in range(UpstreamHealth.BREAKER_MIN_FAILURES - 1):
+            health.record_failure()
+        for _ in range(50):
+            health.record_miss()
+        m_monotonic.return_value += UpstreamHealth.BREAKER_WINDOW + 1
+        health.record_failure()
+        self.assertEqual(health.state, UpstreamHealth.CLOSED)
+        for _ in range(10):
+            health.record_success(0.01)
+        for _ in range(UpstreamHealth.BREAKER_MIN_FAILURES):
+            health.record_failure()
+        self.assertEqual(health.state, UpstreamHealth.CLOSED)
+        for _ in range(10):
+            health.record_failure()
+        self.assertEqual(health.state, UpstreamHealth.OPEN)
+
+    def test_circuit_breaker_disabled(self):
+        health = UpstreamHealth.get(self.fast)
+        for _ in range(50):
+            health.record_failure()
+        self.assertEqual(health.state, UpstreamHealth.CLOSED)
+        self.assertTrue(health.allow())
+
+
+class UpstreamLimitTestCase(asynctest.TestCase):
+    def setUp(self):
+        for name, value in [
+            ("_registry", {}),
+            ("MAX_OUTSTANDING", 2),
+            ("MAX_QUEUED", 1),
+        ]:
+            patcher = patch.object(UpstreamLimit, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.limit = UpstreamLimit.get((("10.0.0.1", 53),))
+
+    async def test_queue_and_shed(self):
+        await self.limit.acquire(1)
+        await self.limit.acquire(1)
+        waiter = asyncio.ensure_future(self.limit.acquire(1))
+        await asyncio.sleep(0)
+        self.assertEqual(self.limit.stats()["queued"], 1)
+        with self.assertRaises(UpstreamOverloaded):
+            await self.limit.acquire(1)
+        self.limit.release()
+        await waiter
+        self.assertEqual(
+            self.limit.stats(), {"outstanding": 2, "queued": 0, "shed": 1}
+        )
+        self.limit.release()
+        self.limit.release()
+        self.assertEqual(self.limit.outstanding, 0)
+
+    async def test_queue_timeout(self):
+        await self.limit.acquire(1)
+        await self.limit.acquire(1)
+        with self.assertRaises(UpstreamOverloaded):
+            await self.limit.acquire(0.01)
+        self.assertEqual(self.limit.stats(), {"outstanding": 2, "queued": 0, "shed": 1})
+
+    async def test_unlimited(self):
+        with patch.object(UpstreamLimit, "MAX_OUTSTANDING", 0):
+            for _ in range(10):
+                await self.limit.acquire(1)
+        self.assertEqual(self.limit.outstanding, 10)
+        self.assertEqual(UpstreamLimit.report(), {"10.0.0.1:53": self.limit.stats()})
@@ -8,6 +8,7 @@
 #
 
 import argparse
+import asyncio
 import binascii
 import ssl
 import tempfile
@@ -15,6 +16,7 @@ import unittest
 
 import dns.message
 import dns.rcode
+import dns.rrset
 
 try:
     import netifaces
@@ -138,6 +140,27 @@ class TestBuildQueryParams(unittest.TestCase):
         self.assertEqual(utils.doh_b64_encode(q), params[constants.DOH_DNS_PARAM])
 
 
+class TestBuildDOHRequest(unittest.TestCase):
+    def test_get(self):
+        headers, body = utils.build_doh_request("foo:8443", "/dns-query", b"\x00")
+        headers = dict(headers)
+        self.assertEqual(headers[":method"], "GET")
+        self.assertEqual(headers[":authority"], "foo:8443")
+        self.assertEqual(headers[":path"], "/dns-query?dns=AA")
+        self.assertEqual(body, b"")
+
+    def test_post(self):
+        headers, body = utils.build_doh_request(
+            "foo", "/dns-query", b"\x00", post=True
+        )
+        headers = dict(headers)
+        self.assertEqual(headers[":method"], "POST")
+        self.assertEqual(headers[":path"], "/dns-query")
+        self.assertEqual(headers["content-type"], constants.DOH_MEDIA_TYPE)
+        self.assertEqual(headers["content-length"], "1")
+        self.assertEqual(body, b"\x00")
+
+
 class TestTypoChecker(unittest.TestCase):
     def test_client_base_parser(self):
         """ Basic test to check that there is no stupid typos.
@@ -381,6 +404,33 @@ class TestGetSystemAddresses(unittest.TestCase):
         self.assertIn("127.0.0.1", utils.get_system_addresses())
 
 
+class TestSetEventLoopPolicy(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(asyncio.set_event_loop_policy, None)
+
+    def test_asyncio(self):
+        self.assertEqual(utils.set_event_loop_policy("asyncio"), "asyncio")
+        self.assertIsInstance(
+            asyncio.get_event_loop_policy(), asyncio.DefaultEventLoopPolicy
+        )
+
+    @unittest.skipIf(isinstance(utils.uvloop, ImportError), "uvloop not installed")
+    def test_uvloop(self):
+        self.assertEqual(utils.set_event_loop_policy("uvloop"), "uvloop")
+        self.assertIsInstance(
+            asyncio.get_event_loop_policy(), utils.uvloop.EventLoopPolicy
+        )
+
+    @patch.object(utils, "uvloop", ImportError("No module named 'uvloop'"))
+    def test_uvloop_not_installed(self):
+        logger = MagicMock()
+        self.assertEqual(utils.set_event_loop_policy("uvloop", logger), "asyncio")
+        self.assertIsInstance(
+            asyncio.get_event_loop_policy(), asyncio.DefaultEventLoopPolicy
+        )
+        logger.warning.assert_called_once()
+
+
 class TestHandleDNSTCPData(unittest.TestCase):
     def setUp(self):
         self._data = (
@@ -438,3 +488,53 @@ class TestDNSECS(unittest.TestCase):
         self.assertEqual(dnsq.edns, 0)
         self.assertEqual(dnsq.options[0].address, "2000::")
         self.assertEqual(dnsq.options[0].srclen, 56)
+
+
+def parse_upstream_source():
+    return [
+        ("10.0.0.1", ("10.0.0.1", 53)),
+        ("10.0.0.1:5353", ("10.0.0.1", 5353)),
+        ("::1", ("::1", 53)),
+        ("[::1]", ("::1", 53)),
+        ("[::1]:5353", ("::1", 5353)),
+        ("localhost:5353", ("localhost", 5353)),
+    ]
+
+
+class TestParseUpstream(unittest.TestCase):
+    @data_provider(parse_upstream_source)
+    def test_parse_upstream(self, upstream, output):
+        self.assertEqual(utils.parse_upstream(upstream, "53"), output)
+
+
+def parse_upstream_url_source():
+    return [
+        ("10.0.0.1", ("udp", "10.0.0.1", 53, None)),
+        ("[::1]:5353", ("udp", "::1", 5353, None)),
+        ("tls://10.0.0.1", ("tls", "10.0.0.1", 853, None)),
+        ("tls://[::1]:8853", ("tls", "::1", 8853, None)),
+        ("tls://dns.example.com", ("tls", "dns.example.com", 853, None)),
+        ("https://10.0.0.1", ("https", "10.0.0.1", 443, constants.DOH_URI)),
+        (
+            "https://[::1]:8443/resolve",
+            ("https", "::1", 8443, "/resolve"),
+        ),
+        (
+            "https://dns.example.com/dns-query",
+            ("https", "dns.example.com", 443, "/dns-query"),
+        ),
+    ]
+
+
+class TestParseUpstreamURL(unittest.TestCase):
+    @data_provider(parse_upstream_url_source)
+    def test_parse_upstream_url(self, upstream, output):
+        self.assertEqual(utils.parse_upstream_url(upstream, 53), output)
+
+    def test_unsupported_transport(self):
+        with self.assertRaises(ValueError):
+            utils.parse_upstream_url("quic://10.0.0.1", 53)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            utils.upstream_resolver("quic://10.0.0.1")
+        with self.assertRaises(ValueError):
+            utils.parse_upstream_url("https:///dns-query", 53)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2018-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import json
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from dohproxy import httpproxy, proxy, utils, workers
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+class InstanceStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stats_dir)
+
+    def test_not_workers(self):
+        stats = {"queries": 1}
+        self.assertIs(workers.instance_stats(stats), stats)
+
+    def test_sum_stats(self):
+        total = workers._sum_stats(
+            [
+                {"queries": 1, "upstreams": {"a": {"rtt": 0.5, "circuit": "open"}}},
+                {"queries": 2, "upstreams": {"a": {"rtt": 1}, "b": {"rtt": 2}}},
+            ]
+        )
+        self.assertEqual(
+            total, {"queries": 3, "upstreams": {"a": {"rtt": 1.5}, "b": {"rtt": 2}}}
+        )
+
+    def test_instance_stats(self):
+        with open(workers._stats_path(self.stats_dir, 1), "w") as f:
+            json.dump({"queries": 2}, f)
+        # Stale stats of this worker, and a publication in progress.
+        with open(workers._stats_path(self.stats_dir, 0), "w") as f:
+            json.dump({"queries": 100}, f)
+        with open(workers._stats_path(self.stats_dir, 2) + ".tmp", "w") as f:
+            f.write("{")
+        with patch.object(workers, "_stats_dir", self.stats_dir), patch.object(
+            workers, "_worker_id", 0
+        ):
+            stats = workers.instance_stats({"queries": 1})
+        self.assertEqual(
+            stats,
+            {
+                "total": {"queries": 3},
+                "workers": {"0": {"queries": 1}, "1": {"queries": 2}},
+            },
+        )
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def crash(self):
+        """Record a start, then crash, stopping the supervisor the second
+        time.
+        """
+        with open(self.path, "a") as f:
+            f.write("{}\n".format(workers._worker_id))
+        with open(self.path) as f:
+            if len(f.readlines()) == 2:
+                os.kill(os.getppid(), signal.SIGTERM)
+        os._exit(1)
+
+    @patch.object(workers.Supervisor, "RESTART_DELAY", 0)
+    def test_restart(self):
+        supervisor = workers.Supervisor(1, self.crash, MagicMock())
+        self.assertEqual(supervisor.run(), 0)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "0\n0\n")
+        self.assertFalse(os.path.exists(supervisor.stats_dir))
+
+    def supervise_sighup(self, target):
+        """Run 2 workers, send SIGHUP to the supervisor then stop it.
+        :return: the logger of the supervisor.
+        """
+        logger = MagicMock()
+        supervisor = workers.Supervisor(2, target, logger)
+        for delay, signum in ((1.0, signal.SIGHUP), (1.5, signal.SIGTERM)):
+            timer = threading.Timer(delay, os.kill, (os.getpid(), signum))
+            timer.start()
+            self.addCleanup(timer.cancel)
+        self.assertEqual(supervisor.run(), 0)
+        return logger
+
+    def test_proxy_sighup(self):
+        """Workers without forwarding rules survive SIGHUP."""
+        pem = os.path.join(DATA_DIR, "server.pem")
+        args = utils.proxy_parser_base(port=443).parse_args(
+            [
+                "--listen-address",
+                "127.0.0.1",
+                "--port",
+                "0",
+                "--certfile",
+                pem,
+                "--keyfile",
+                pem,
+                "--level",
+                "ERROR",
+            ]
+        )
+        logger = self.supervise_sighup(
+            lambda: proxy.serve(args, MagicMock(), reuse_port=True)
+        )
+        logger.error.assert_not_called()
+
+    def test_httpproxy_sighup(self):
+        """aiohttp workers without forwarding rules survive SIGHUP."""
+        parser, args = httpproxy.parse_args(
+            ["--listen-address", "127.0.0.1", "--port", "0", "--level", "ERROR"]
+        )
+        logger = self.supervise_sighup(
+            lambda: httpproxy.serve(args, None, reuse_port=True)
+        )
+        logger.error.assert_not_called()